@@ -1,31 +1,97 @@
-import { useState, useRef } from 'react'
+import { useRef } from 'react'
 import Editor from '@monaco-editor/react'
 import type { editor } from 'monaco-editor'
+import OutputArea, { CellOutput, SpilledOutput } from './OutputArea'
 import './CodeCell.css'
 
+// カーネル内の cProfile の結果（自身の実行時間の長い順）
+export interface ProfileSummary {
+  total_ms: number
+  functions: number
+  top: {
+    file: string
+    line: number
+    function: string
+    ncalls: number
+    primitive_calls: number
+    tottime_ms: number
+    cumtime_ms: number
+  }[]
+}
+
 interface Cell {
   id: string
   code: string
-  output: string
+  outputs: CellOutput[]
+  spill?: SpilledOutput
+  profile?: ProfileSummary
   error: string | null
+  status: 'idle' | 'queued' | 'running'
+  queuePosition?: number
+  timeoutSeconds?: number
 }
 
 interface Props {
   cell: Cell
   index: number
   onUpdate: (code: string) => void
-  onExecute: () => void
+  onExecute: (profile?: boolean) => void
+  onInterrupt: () => void
+  onTimeoutChange: (seconds?: number) => void
   onDelete: () => void
+  onLoadMore: () => void
+}
+
+const shortFile = (file: string) =>
+  file === '~' ? '' : file.split(/[\\/]/).pop()
+
+function ProfileTable({ profile }: { profile: ProfileSummary }) {
+  return (
+    <div className="cell-profile">
+      <div className="profile-label">
+        プロファイル: {profile.total_ms.toFixed(1)} ms（{profile.functions} 関数、上位 {profile.top.length} 件）
+      </div>
+      <table>
+        <thead>
+          <tr>
+            <th>自身 (ms)</th>
+            <th>累計 (ms)</th>
+            <th>呼び出し</th>
+            <th>関数</th>
+          </tr>
+        </thead>
+        <tbody>
+          {profile.top.map((entry, i) => (
+            <tr key={i}>
+              <td>{entry.tottime_ms.toFixed(2)}</td>
+              <td>{entry.cumtime_ms.toFixed(2)}</td>
+              <td>{entry.ncalls === entry.primitive_calls ? entry.ncalls : `${entry.ncalls}/${entry.primitive_calls}`}</td>
+              <td title={entry.file}>
+                {entry.function}
+                {entry.file !== '~' && <span className="profile-location"> {shortFile(entry.file)}:{entry.line}</span>}
+              </td>
+            </tr>
+          ))}
+        </tbody>
+      </table>
+    </div>
+  )
 }
 
-export default function CodeCell({ cell, index, onUpdate, onExecute, onDelete }: Props) {
-  const [isExecuting, setIsExecuting] = useState(false)
+export default function CodeCell({ cell, index, onUpdate, onExecute, onInterrupt, onTimeoutChange, onDelete, onLoadMore }: Props) {
   const editorRef = useRef<editor.IStandaloneCodeEditor | null>(null)
+  const isExecuting = cell.status !== 'idle'
 
   const handleExecute = () => {
-    setIsExecuting(true)
     onExecute()
-    setTimeout(() => setIsExecuting(false), 3000)
+  }
+
+  const executeLabel = () => {
+    if (cell.status === 'queued') {
+      return cell.queuePosition ? `待機中 (${cell.queuePosition}番目)` : '待機中...'
+    }
+    if (cell.status === 'running') return '実行中...'
+    return '実行 (Shift+Enter)'
   }
 
   const handleEditorDidMount = (editor: editor.IStandaloneCodeEditor) => {
@@ -53,8 +119,30 @@ export default function CodeCell({ cell, index, onUpdate, onExecute, onDelete }:
             disabled={isExecuting}
             className="btn-execute"
           >
-            {isExecuting ? '実行中...' : '実行 (Shift+Enter)'}
+            {executeLabel()}
           </button>
+          <button
+            onClick={() => onExecute(true)}
+            disabled={isExecuting}
+            className="btn-profile"
+            title="cProfile で計測して実行"
+          >
+            プロファイル
+          </button>
+          {isExecuting && (
+            <button onClick={onInterrupt} className="btn-interrupt" title="実行を中断（止まらなければカーネルを再起動）">
+              停止
+            </button>
+          )}
+          <input
+            type="number"
+            min={1}
+            value={cell.timeoutSeconds ?? ''}
+            onChange={(e) => onTimeoutChange(e.target.value ? parseInt(e.target.value) : undefined)}
+            placeholder="制限(秒)"
+            className="cell-timeout"
+            title="このセルの制限時間（秒）。超えると中断される"
+          />
           <button onClick={onDelete} className="btn-delete">
             削除
           </button>
@@ -104,16 +192,15 @@ export default function CodeCell({ cell, index, onUpdate, onExecute, onDelete }:
         />
       </div>
 
-      {(cell.output || cell.error) && (
+      {(cell.outputs.length > 0 || cell.spill || cell.error) && (
         <div className="cell-output">
           <div className="output-label">Out [{index + 1}]:</div>
-          {cell.error ? (
-            <pre className="output-error">{cell.error}</pre>
-          ) : (
-            <pre className="output-text">{cell.output || '(出力なし)'}</pre>
-          )}
+          <OutputArea outputs={cell.outputs} spill={cell.spill} onLoadMore={onLoadMore} />
+          {cell.error && <pre className="output-error">{cell.error}</pre>}
         </div>
       )}
+
+      {cell.profile && <ProfileTable profile={cell.profile} />}
     </div>
   )
 }
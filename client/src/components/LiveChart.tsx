@@ -0,0 +1,36 @@
+interface Props {
+  label: string
+  values: number[]
+  unit: string
+  // 縦軸の上限。未指定なら表示中の最大値に合わせる
+  max?: number
+  color?: string
+  // 横軸に並べる点の数（履歴のサイズ）
+  points: number
+}
+
+const WIDTH = 300
+const HEIGHT = 60
+
+// SVG の折れ線グラフ。右端が最新のサンプル
+export default function LiveChart({ label, values, unit, max, color = '#3498db', points }: Props) {
+  const top = max ?? Math.max(1, ...values) * 1.1
+  const step = WIDTH / Math.max(points - 1, 1)
+  const offset = points - values.length
+  const line = values
+    .map((value, i) => `${((offset + i) * step).toFixed(1)},${(HEIGHT - (Math.min(value, top) / top) * HEIGHT).toFixed(1)}`)
+    .join(' ')
+  const current = values.length > 0 ? values[values.length - 1] : null
+
+  return (
+    <div className="live-chart">
+      <div className="live-chart-label">
+        <span>{label}</span>
+        <strong>{current === null ? '-' : `${current.toFixed(1)} ${unit}`}</strong>
+      </div>
+      <svg viewBox={`0 0 ${WIDTH} ${HEIGHT}`} preserveAspectRatio="none">
+        {values.length > 1 && <polyline points={line} fill="none" stroke={color} strokeWidth="1.5" vectorEffect="non-scaling-stroke" />}
+      </svg>
+    </div>
+  )
+}
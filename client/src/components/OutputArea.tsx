@@ -0,0 +1,126 @@
+import { useEffect, useMemo } from 'react'
+
+export interface CellOutput {
+  output_type: string
+  name?: string
+  text?: string
+  data?: Record<string, any>
+  metadata?: Record<string, any>
+  display_id?: string
+  omitted?: Record<string, number>
+  ename?: string
+  evalue?: string
+  traceback?: string[]
+}
+
+// 大きすぎてサーバーのディスクに退避された出力（先頭と末尾だけが届く）
+export interface SpilledOutput {
+  handle: string
+  total_bytes: number
+  head_bytes: number
+  tail_offset: number
+  tail: string
+  // 「さらに読み込む」で取得済みの部分
+  loaded: string
+  next_offset: number
+}
+
+// 画像はバイナリ（ArrayBuffer）で届く
+const BINARY_IMAGE_TYPES = ['image/png', 'image/jpeg', 'image/gif', 'image/webp']
+
+// 表示に使う MIME タイプの優先順
+const MIME_ORDER = [...BINARY_IMAGE_TYPES, 'image/svg+xml', 'text/html', 'text/plain']
+
+const formatBytes = (bytes: number) =>
+  bytes >= 1024 * 1024
+    ? `${(bytes / 1024 / 1024).toFixed(1)} MB`
+    : `${(bytes / 1024).toFixed(1)} KB`
+
+function BinaryImage({ mime, payload }: { mime: string, payload: any }) {
+  const url = useMemo(
+    () => typeof payload === 'string'
+      ? `data:${mime};base64,${payload}`
+      : URL.createObjectURL(new Blob([payload], { type: mime })),
+    [mime, payload]
+  )
+
+  useEffect(() => () => {
+    if (url.startsWith('blob:')) URL.revokeObjectURL(url)
+  }, [url])
+
+  return <img src={url} className="output-image" alt={mime} />
+}
+
+function MimeOutput({ output }: { output: CellOutput }) {
+  const data = output.data || {}
+  const mime = MIME_ORDER.find(type => type in data)
+
+  let content = null
+  if (mime && BINARY_IMAGE_TYPES.includes(mime)) {
+    content = <BinaryImage mime={mime} payload={data[mime]} />
+  } else if (mime === 'image/svg+xml') {
+    content = (
+      <img
+        src={`data:image/svg+xml;charset=utf-8,${encodeURIComponent(data[mime])}`}
+        className="output-image"
+        alt={mime}
+      />
+    )
+  } else if (mime === 'text/html') {
+    content = <div className="output-html" dangerouslySetInnerHTML={{ __html: data[mime] }} />
+  } else if (mime === 'text/plain') {
+    content = <pre className="output-text">{data[mime]}</pre>
+  }
+
+  return (
+    <>
+      {content}
+      {output.omitted && Object.entries(output.omitted).map(([type, size]) => (
+        <div key={type} className="output-omitted">
+          [{type} の出力が大きすぎるため省略しました（{formatBytes(size)}）]
+        </div>
+      ))}
+    </>
+  )
+}
+
+interface Props {
+  outputs: CellOutput[]
+  spill?: SpilledOutput
+  onLoadMore?: () => void
+}
+
+export default function OutputArea({ outputs, spill, onLoadMore }: Props) {
+  return (
+    <>
+      {outputs.map((output, i) =>
+        output.output_type === 'stream' ? (
+          <pre
+            key={i}
+            className={output.name === 'stderr' ? 'output-text output-stderr' : 'output-text'}
+          >
+            {output.text}
+          </pre>
+        ) : (
+          <MimeOutput key={i} output={output} />
+        )
+      )}
+      {spill && (
+        <>
+          {spill.loaded && <pre className="output-text">{spill.loaded}</pre>}
+          {spill.next_offset < spill.tail_offset && (
+            <div className="output-omitted">
+              [... {formatBytes(spill.tail_offset - spill.next_offset)} の出力を省略 ...]
+              {onLoadMore && (
+                <button onClick={onLoadMore} className="btn-load-more">
+                  さらに読み込む
+                </button>
+              )}
+            </div>
+          )}
+          <pre className="output-text">{spill.tail}</pre>
+        </>
+      )}
+    </>
+  )
+}
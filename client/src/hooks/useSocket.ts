@@ -11,7 +11,9 @@ export function useSocket() {
 
     const serverUrl = window.location.origin
     const newSocket = io(serverUrl, {
-      auth: { token }
+      auth: { token },
+      // 複数ワーカー構成ではポーリングのリクエストが別のワーカーに届くため、WebSocket のみを使う
+      transports: ['websocket']
     })
 
     newSocket.on('connect', () => {
@@ -1,6 +1,8 @@
-import { useState, useEffect } from 'react'
+import { useState, useEffect, useRef } from 'react'
 import axios from 'axios'
 import { useAuthStore } from '../store/authStore'
+import { useSocket } from '../hooks/useSocket'
+import LiveChart from '../components/LiveChart'
 import './AdminDashboard.css'
 
 interface User {
@@ -16,6 +18,76 @@ interface ResourceLimit {
   memory_mb: number
   gpu_memory_mb: number
   storage_mb: number
+  // セルの実行時間の上限（秒）。null は既定値、0 は無制限
+  max_execution_seconds: number | null
+}
+
+// 時刻と系列（名前 → 値）。すべて同じ長さで、古い順
+interface History {
+  times: number[]
+  series: Record<string, number[]>
+}
+
+interface GpuStats {
+  index: number
+  name: string
+  load: number
+  memory_used_mb: number
+  memory_total_mb: number
+}
+
+interface SystemStats {
+  cpu_percent: number
+  cpu_count: number
+  memory_percent: number
+  memory_used_mb: number
+  memory_total_mb: number
+  disk_percent: number
+  disk_used_mb: number
+  disk_total_mb: number
+  gpus: GpuStats[]
+}
+
+interface UserUsage {
+  cpu_usage: number
+  memory_usage: number
+  gpu_usage: number
+  storage_usage: number
+  kernels: number
+}
+
+interface StatsSample {
+  time: number
+  system: SystemStats
+  users: Record<string, UserUsage>
+}
+
+const USER_SERIES = ['cpu_usage', 'memory_usage', 'gpu_usage'] as const
+
+const emptyHistory = (): History => ({ times: [], series: {} })
+
+// 新しいサンプルを追加し、古いものを size 件を超えた分だけ捨てる
+const appendSample = (history: History, time: number, values: Record<string, number>, size: number): History => {
+  const trim = (list: number[]) => list.slice(Math.max(list.length - size, 0))
+  const series: Record<string, number[]> = {}
+  for (const name of new Set([...Object.keys(history.series), ...Object.keys(values)])) {
+    const previous = history.series[name] ?? history.times.map(() => 0)
+    series[name] = trim([...previous, values[name] ?? 0])
+  }
+  return { times: trim([...history.times, time]), series }
+}
+
+const systemSeries = (system: SystemStats): Record<string, number> => {
+  const values: Record<string, number> = {
+    cpu_percent: system.cpu_percent,
+    memory_percent: system.memory_percent,
+    disk_percent: system.disk_percent
+  }
+  for (const gpu of system.gpus) {
+    values[`gpu${gpu.index}_load`] = gpu.load
+    values[`gpu${gpu.index}_memory_mb`] = gpu.memory_used_mb
+  }
+  return values
 }
 
 export default function AdminDashboard() {
@@ -25,14 +97,61 @@ export default function AdminDashboard() {
     cpu_percent: 50,
     memory_mb: 2048,
     gpu_memory_mb: 4096,
-    storage_mb: 5120
+    storage_mb: 5120,
+    max_execution_seconds: null
   })
   const token = useAuthStore((state) => state.token)
+  const socket = useSocket()
+  // サーバーが一定間隔で送ってくる計測値（ポーリングはしない）
+  const [historySize, setHistorySize] = useState(300)
+  const historySizeRef = useRef(300)
+  const [latest, setLatest] = useState<StatsSample | null>(null)
+  const [systemHistory, setSystemHistory] = useState<History>(emptyHistory())
+  const [userHistory, setUserHistory] = useState<Record<string, History>>({})
 
   useEffect(() => {
     loadUsers()
   }, [])
 
+  useEffect(() => {
+    if (!socket) return
+
+    // 再接続のたびに購読し直し、保持されている履歴から描き直す
+    const subscribe = () => socket.emit('subscribe_admin_stats')
+    socket.on('connect', subscribe)
+    if (socket.connected) subscribe()
+
+    socket.on('admin_stats_history', (data: any) => {
+      historySizeRef.current = data.history_size
+      setHistorySize(data.history_size)
+      setLatest(data.latest)
+      setSystemHistory(data.system)
+      setUserHistory(data.users)
+    })
+
+    socket.on('admin_stats', (sample: StatsSample) => {
+      const size = historySizeRef.current
+      setLatest(sample)
+      setSystemHistory(prev => appendSample(prev, sample.time, systemSeries(sample.system), size))
+      setUserHistory(prev => {
+        const next: Record<string, History> = {}
+        for (const userId of new Set([...Object.keys(prev), ...Object.keys(sample.users)])) {
+          const usage = sample.users[userId]
+          const values = usage ? Object.fromEntries(USER_SERIES.map(name => [name, usage[name]])) : {}
+          next[userId] = appendSample(prev[userId] ?? emptyHistory(), sample.time, values, size)
+        }
+        return next
+      })
+    })
+
+    return () => {
+      socket.emit('unsubscribe_admin_stats')
+      socket.off('connect', subscribe)
+      socket.off('admin_stats_history')
+      socket.off('admin_stats')
+    }
+  }, [socket])
+
   const loadUsers = async () => {
     try {
       const response = await axios.get('http://localhost:8000/api/admin/users', {
@@ -86,10 +205,62 @@ export default function AdminDashboard() {
     }
   }
 
+  const emailOf = (userId: string) => users.find(user => String(user.id) === userId)?.email ?? `ユーザー ${userId}`
+  const system = latest?.system
+
   return (
     <div className="admin-dashboard">
       <h1>管理者ダッシュボード</h1>
 
+      <div className="stats-panel">
+        <h2>リソース使用状況（リアルタイム）</h2>
+        <div className="stats-grid">
+          <LiveChart label={`CPU（${system?.cpu_count ?? '-'} コア）`} values={systemHistory.series.cpu_percent ?? []} unit="%" max={100} points={historySize} />
+          <LiveChart
+            label={`メモリ（${system ? (system.memory_total_mb / 1024).toFixed(1) : '-'} GB）`}
+            values={systemHistory.series.memory_percent ?? []}
+            unit="%"
+            max={100}
+            color="#27ae60"
+            points={historySize}
+          />
+          <LiveChart label="ディスク" values={systemHistory.series.disk_percent ?? []} unit="%" max={100} color="#8e44ad" points={historySize} />
+          {system?.gpus.map(gpu => (
+            <LiveChart
+              key={gpu.index}
+              label={`GPU ${gpu.index}: ${gpu.name}（メモリ ${gpu.memory_used_mb.toFixed(0)} / ${gpu.memory_total_mb.toFixed(0)} MB）`}
+              values={systemHistory.series[`gpu${gpu.index}_load`] ?? []}
+              unit="%"
+              max={100}
+              color="#e67e22"
+              points={historySize}
+            />
+          ))}
+        </div>
+
+        <h3>ユーザー別</h3>
+        {Object.keys(userHistory).length === 0 ? (
+          <p className="no-selection">実行中のカーネルはありません</p>
+        ) : (
+          <div className="user-stats">
+            {Object.entries(userHistory).map(([userId, history]) => {
+              const usage = latest?.users[userId]
+              return (
+                <div key={userId} className="user-stats-row">
+                  <div className="user-stats-name">
+                    <strong>{emailOf(userId)}</strong>
+                    <span>カーネル {usage?.kernels ?? 0}</span>
+                  </div>
+                  <LiveChart label="CPU" values={history.series.cpu_usage ?? []} unit="%" points={historySize} />
+                  <LiveChart label="メモリ" values={history.series.memory_usage ?? []} unit="MB" color="#27ae60" points={historySize} />
+                  <LiveChart label="GPU メモリ" values={history.series.gpu_usage ?? []} unit="MB" color="#e67e22" points={historySize} />
+                </div>
+              )
+            })}
+          </div>
+        )}
+      </div>
+
       <div className="dashboard-grid">
         <div className="users-panel">
           <h2>ユーザー一覧</h2>
@@ -173,6 +344,18 @@ export default function AdminDashboard() {
                 />
               </div>
 
+              <div className="form-group">
+                <label>セルの実行時間上限 (秒、空欄で既定値、0 で無制限)</label>
+                <input
+                  type="number"
+                  value={limits.max_execution_seconds ?? ''}
+                  onChange={(e) => setLimits({
+                    ...limits,
+                    max_execution_seconds: e.target.value === '' ? null : parseInt(e.target.value)
+                  })}
+                />
+              </div>
+
               <button onClick={updateLimits} className="btn-primary">
                 制限を更新
               </button>
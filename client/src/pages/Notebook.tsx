@@ -1,44 +1,381 @@
-import { useState, useEffect } from 'react'
+import { useState, useEffect, useRef } from 'react'
+import axios from 'axios'
 import { useSocket } from '../hooks/useSocket'
+import { useAuthStore } from '../store/authStore'
 import CodeCell from '../components/CodeCell'
+import type { ProfileSummary } from '../components/CodeCell'
+import type { CellOutput, SpilledOutput } from '../components/OutputArea'
 import './Notebook.css'
 
 interface Cell {
   id: string
   code: string
-  output: string
+  outputs: CellOutput[]
+  spill?: SpilledOutput
+  profile?: ProfileSummary
   error: string | null
+  status: 'idle' | 'queued' | 'running'
+  queuePosition?: number
+  // セルの制限時間（秒）。未指定ならユーザーの上限のみ
+  timeoutSeconds?: number
+}
+
+// 自動保存までの待ち時間（入力中は送らない）
+const AUTOSAVE_DELAY_MS = 1000
+
+// サーバーに保存済みの状態。差分（パッチ）の計算に使う
+interface SyncedNotebook {
+  name: string
+  order: string[]
+  cells: Record<string, { code: string, outputs: CellOutput[], error: string | null }>
+}
+
+const savedOutputs = (cell: Cell): CellOutput[] =>
+  cell.error
+    ? [...cell.outputs, { output_type: 'error', ename: '', evalue: '', traceback: cell.error.split('\n') }]
+    : cell.outputs
+
+const toSavedCell = (cell: Cell) => ({
+  id: cell.id,
+  cell_type: 'code',
+  source: cell.code,
+  outputs: savedOutputs(cell)
+})
+
+const snapshot = (name: string, cells: Cell[]): SyncedNotebook => ({
+  name,
+  order: cells.map(cell => cell.id),
+  cells: Object.fromEntries(cells.map(cell => [
+    cell.id,
+    { code: cell.code, outputs: cell.outputs, error: cell.error }
+  ]))
+})
+
+// 保存済みの状態から現在のセルへのパッチ（insert/update/delete/move）
+const diffCells = (prev: SyncedNotebook, cells: Cell[]) => {
+  const ops: any[] = []
+  const ids = cells.map(cell => cell.id)
+  const order = prev.order.filter(id => ids.includes(id))
+
+  for (const id of prev.order) {
+    if (!ids.includes(id)) ops.push({ op: 'delete', id })
+  }
+
+  cells.forEach((cell, index) => {
+    const before = prev.cells[cell.id]
+    if (!before) {
+      ops.push({ op: 'insert', index, cell: toSavedCell(cell) })
+      order.splice(index, 0, cell.id)
+      return
+    }
+    const update: Record<string, any> = {}
+    if (before.code !== cell.code) update.source = cell.code
+    if (before.outputs !== cell.outputs || before.error !== cell.error) update.outputs = savedOutputs(cell)
+    if (Object.keys(update).length > 0) ops.push({ op: 'update', id: cell.id, ...update })
+  })
+
+  if (order.join('\n') !== ids.join('\n')) {
+    ids.forEach((id, index) => ops.push({ op: 'move', id, index }))
+  }
+  return ops
+}
+
+// サーバーのノートブック一覧（メタデータのインデックスから）
+interface NotebookInfo {
+  name: string
+  size: number
+  mtime: number
+  cell_count: number
+  kernel_state: 'idle' | 'busy' | null
+}
+
+// .ipynb では文字列が行ごとの配列になっていることがある
+const joinText = (value: any) => Array.isArray(value) ? value.join('') : value
+
+// .ipynb のセルを画面のセルに変換（エラー出力はセルのエラーとして表示する）
+const fromSavedCell = (cell: any, index: number): Cell => {
+  const outputs: CellOutput[] = []
+  let error: string | null = null
+  for (const output of cell.outputs || []) {
+    if (output.output_type === 'error') {
+      error = (output.traceback || []).join('\n')
+    } else if (output.output_type === 'stream') {
+      outputs.push({ ...output, text: joinText(output.text) })
+    } else {
+      const data = Object.fromEntries(
+        Object.entries(output.data || {}).map(([mime, value]) => [mime, joinText(value)])
+      )
+      outputs.push({ ...output, data })
+    }
+  }
+  return {
+    id: cell.id || `${Date.now()}-${index}`,
+    code: joinText(cell.source || ''),
+    outputs,
+    error,
+    status: 'idle'
+  }
+}
+
+// ストリーム出力は直前の同じストリームにつなげる
+const appendOutputs = (current: CellOutput[], incoming: CellOutput[]) => {
+  const outputs = [...current]
+  for (const output of incoming) {
+    const last = outputs[outputs.length - 1]
+    if (output.output_type === 'stream' && last?.output_type === 'stream' && last.name === output.name) {
+      outputs[outputs.length - 1] = { ...last, text: (last.text || '') + (output.text || '') }
+    } else {
+      outputs.push(output)
+    }
+  }
+  return outputs
+}
+
+// update_display_data は同じ display_id の出力を置き換える（他のセルの出力も含む）
+const applyDisplayUpdates = (outputs: CellOutput[], updates: CellOutput[]) => {
+  if (updates.length === 0) return outputs
+  let changed = false
+  const updated = outputs.map(output => {
+    const update = output.display_id && updates.find(u => u.display_id === output.display_id)
+    if (!update) return output
+    changed = true
+    return { ...output, data: update.data, metadata: update.metadata, omitted: update.omitted }
+  })
+  return changed ? updated : outputs
 }
 
 export default function Notebook() {
   const [cells, setCells] = useState<Cell[]>([
-    { id: '1', code: '', output: '', error: null }
+    { id: '1', code: '', outputs: [], error: null, status: 'idle' }
   ])
   const [notebookName, setNotebookName] = useState('untitled.ipynb')
+  const [notebooks, setNotebooks] = useState<NotebookInfo[]>([])
   const socket = useSocket()
+  const token = useAuthStore((state) => state.token)
+  // 一度保存したノートブックだけを自動保存する（未保存のファイルを上書きしないため）
+  const synced = useRef<SyncedNotebook | null>(null)
+  const latest = useRef({ cells, notebookName })
+  latest.current = { cells, notebookName }
+  // 受け取ったカーネルのイベントの最後の番号（kernel_seq）
+  const lastSeq = useRef(0)
+  const replaying = useRef(false)
+  const pendingEvents = useRef<[string, any][]>([])
 
   useEffect(() => {
     if (!socket) return
 
-    socket.on('cell_output', (data: any) => {
+    const addOutputs = (cellId: string, incoming: CellOutput[]) => {
+      const updates = incoming.filter(o => o.output_type === 'update_display_data')
+      const added = incoming.filter(o => o.output_type !== 'update_display_data')
+      setCells(prev => prev.map(cell => {
+        const outputs = applyDisplayUpdates(cell.outputs, updates)
+        if (cell.id === cellId) return { ...cell, outputs: appendOutputs(outputs, added) }
+        return outputs === cell.outputs ? cell : { ...cell, outputs }
+      }))
+    }
+
+    const toSpill = (spill: any): SpilledOutput | undefined =>
+      spill ? { ...spill, loaded: '', next_offset: spill.head_bytes } : undefined
+
+    // カーネルのイベント（kernel_seq 付き）。再接続時に取りこぼした分はサーバーから再送される
+    const kernelHandlers: Record<string, (data: any) => void> = {
+      cell_output: (data) => {
+        addOutputs(data.cell_id, data.outputs)
+        setCells(prev => prev.map(cell =>
+          cell.id === data.cell_id
+            ? { ...cell, error: data.error, spill: toSpill(data.spill), profile: data.profile ?? undefined, status: 'idle' }
+            : cell
+        ))
+      },
+
+      // 実行待ちキューでの順番
+      cell_queued: (data) => {
+        setCells(prev => prev.map(cell =>
+          cell.id === data.cell_id
+            ? { ...cell, status: 'queued', queuePosition: data.position }
+            : cell
+        ))
+      },
+
+      cell_started: (data) => {
+        setCells(prev => prev.map(cell =>
+          cell.id === data.cell_id
+            ? { ...cell, status: 'running', queuePosition: undefined }
+            : cell
+        ))
+      },
+
+      // ストリーミング実行：チャンクごとに出力を追記
+      cell_output_chunk: (data) => {
+        const skipped: CellOutput[] = data.dropped_bytes
+          ? [{ output_type: 'stream', name: 'stdout', text: `\n[... ${data.dropped_bytes} bytes skipped ...]\n` }]
+          : []
+        addOutputs(data.cell_id, [...skipped, ...data.outputs])
+      },
+
+      cell_complete: (data) => {
+        setCells(prev => prev.map(cell =>
+          cell.id === data.cell_id
+            ? { ...cell, error: data.error, spill: toSpill(data.spill), profile: data.profile ?? undefined, status: 'idle' }
+            : cell
+        ))
+      }
+    }
+
+    // 同じイベントを二度適用しない。再送を待っている間に届いたイベントは再送の後に適用する
+    const applyKernelEvent = (event: string, data: any) => {
+      if (data.notebook_path && data.notebook_path !== latest.current.notebookName) return
+      if (data.kernel_seq) {
+        if (data.kernel_seq <= lastSeq.current) return
+        lastSeq.current = data.kernel_seq
+      }
+      kernelHandlers[event](data)
+    }
+
+    const onKernelEvent = (event: string) => (data: any, ack?: () => void) => {
+      // チャンクの受信をサーバーへ通知（ack）
+      if (ack) ack()
+      if (replaying.current) {
+        pendingEvents.current.push([event, data])
+        return
+      }
+      applyKernelEvent(event, data)
+    }
+    for (const event of Object.keys(kernelHandlers)) {
+      socket.on(event, onKernelEvent(event))
+    }
+
+    // 接続が切れて再接続したら、カーネルに再登録して続きを受け取る
+    const onConnect = () => {
+      replaying.current = true
+      socket.emit('resubscribe', {
+        notebook_path: latest.current.notebookName,
+        since_seq: lastSeq.current || null
+      })
+    }
+    socket.on('connect', onConnect)
+
+    socket.on('kernel_replay', (data: any) => {
+      const queued = pendingEvents.current
+      replaying.current = false
+      pendingEvents.current = []
+      if (data.notebook_path !== latest.current.notebookName) return
+
+      for (const { event, data: eventData } of data.events) {
+        applyKernelEvent(event, eventData)
+      }
+      if (!data.kernel || data.missed) {
+        // カーネルが失われた、または再送できる範囲を超えて切断されていた
+        setCells(prev => prev.map(cell =>
+          cell.status === 'idle'
+            ? cell
+            : data.kernel
+              ? { ...cell, outputs: appendOutputs(cell.outputs, [{ output_type: 'stream', name: 'stderr', text: '\n[切断中の出力の一部は失われました]\n' }]) }
+              : { ...cell, error: 'カーネルが停止したため、実行結果を受け取れませんでした', status: 'idle' }
+        ))
+      }
+      lastSeq.current = Math.max(lastSeq.current, data.last_seq)
+      for (const [event, eventData] of queued) {
+        applyKernelEvent(event, eventData)
+      }
+    })
+
+    // リソース制限などで実行できなかったセル
+    const onError = (data: any) => {
+      if (!data?.cell_id) return
       setCells(prev => prev.map(cell =>
         cell.id === data.cell_id
-          ? { ...cell, output: data.output, error: data.error }
+          ? { ...cell, error: data.message, status: 'idle' }
           : cell
       ))
+    }
+    socket.on('error', onError)
+
+    // パッチが適用できなかった場合は全体を保存し直す
+    socket.on('patch_result', (data: any) => {
+      if (data.success || data.notebook_path !== synced.current?.name) return
+      console.warn('Notebook patch rejected, saving the whole notebook:', data.error)
+      const { cells, notebookName } = latest.current
+      socket.emit('save_notebook', {
+        notebook_path: notebookName,
+        content: { cells: cells.map(toSavedCell) }
+      })
+      synced.current = snapshot(notebookName, cells)
     })
 
     return () => {
-      socket.off('cell_output')
+      socket.off('patch_result')
+      for (const event of Object.keys(kernelHandlers)) {
+        socket.off(event)
+      }
+      socket.off('connect', onConnect)
+      socket.off('kernel_replay')
+      socket.off('error', onError)
     }
   }, [socket])
 
+  // 変更をまとめてパッチとして送る
+  useEffect(() => {
+    if (!socket) return
+    const timer = setTimeout(() => {
+      const prev = synced.current
+      if (!prev || prev.name !== notebookName) return
+      const ops = diffCells(prev, cells)
+      if (ops.length === 0) return
+      socket.emit('notebook_patch', { notebook_path: notebookName, ops })
+      synced.current = snapshot(notebookName, cells)
+    }, AUTOSAVE_DELAY_MS)
+    return () => clearTimeout(timer)
+  }, [socket, cells, notebookName])
+
+  const fetchNotebooks = async () => {
+    try {
+      const response = await axios.get('/api/notebooks', {
+        headers: { Authorization: `Bearer ${token}` }
+      })
+      setNotebooks(response.data)
+    } catch (error) {
+      console.error('Failed to fetch notebooks:', error)
+    }
+  }
+
+  useEffect(() => {
+    if (token) fetchNotebooks()
+  }, [token])
+
+  const openNotebook = async (name: string) => {
+    if (!name) return
+    try {
+      const response = await axios.get(`/api/notebooks/${encodeURI(name)}`, {
+        headers: { Authorization: `Bearer ${token}` }
+      })
+      const opened: Cell[] = (response.data.cells || []).map(fromSavedCell)
+      const loaded = opened.length > 0
+        ? opened
+        : [{ id: Date.now().toString(), code: '', outputs: [], error: null, status: 'idle' } as Cell]
+      setCells(loaded)
+      setNotebookName(name)
+      // 開いたファイルはサーバーと同じ状態なので、以降の変更は自動保存する
+      synced.current = snapshot(name, opened)
+      // このノートブックのカーネルのイベントを、これから先の分だけ受け取る
+      lastSeq.current = 0
+      if (socket) {
+        latest.current = { cells: loaded, notebookName: name }
+        replaying.current = true
+        socket.emit('resubscribe', { notebook_path: name, since_seq: null })
+      }
+    } catch (error) {
+      console.error('Failed to open notebook:', error)
+    }
+  }
+
   const addCell = () => {
     const newCell: Cell = {
       id: Date.now().toString(),
       code: '',
-      output: '',
-      error: null
+      outputs: [],
+      error: null,
+      status: 'idle'
     }
     setCells([...cells, newCell])
   }
@@ -49,17 +386,81 @@ export default function Notebook() {
     ))
   }
 
-  const executeCell = (id: string) => {
+  const updateTimeout = (id: string, timeoutSeconds?: number) => {
+    setCells(prev => prev.map(cell =>
+      cell.id === id ? { ...cell, timeoutSeconds } : cell
+    ))
+  }
+
+  // profile: カーネル内で cProfile を使って計測し、結果をセルの下に表示する
+  const executeCell = (id: string, profile = false) => {
     const cell = cells.find(c => c.id === id)
     if (!cell || !socket) return
 
+    setCells(prev => prev.map(c =>
+      c.id === id ? { ...c, outputs: [], spill: undefined, profile: undefined, error: null, status: 'queued' } : c
+    ))
     socket.emit('execute_cell', {
       notebook_path: notebookName,
       code: cell.code,
-      cell_id: id
+      cell_id: id,
+      stream: true,
+      profile,
+      timeout_seconds: cell.timeoutSeconds ?? null
     })
   }
 
+  // 停止：実行中なら中断（止まらなければカーネルを再起動）、待機中なら取り消す。結果はセルのイベントで届く
+  const interruptCell = (id: string) => {
+    if (!socket) return
+    socket.emit('interrupt_cell', { notebook_path: notebookName, cell_id: id })
+  }
+
+  // すべて実行：全セルを1回のリクエストで送り、カーネルで続けて実行する（エラーが出たら以降は実行しない）
+  const runAll = () => {
+    if (!socket) return
+    const targets = cells.filter(cell => cell.code.trim() !== '')
+    if (targets.length === 0) return
+
+    const ids = new Set(targets.map(cell => cell.id))
+    setCells(prev => prev.map(c =>
+      ids.has(c.id) ? { ...c, outputs: [], spill: undefined, profile: undefined, error: null, status: 'queued' } : c
+    ))
+    socket.emit('execute_cells', {
+      notebook_path: notebookName,
+      cells: targets.map(cell => ({ cell_id: cell.id, code: cell.code, timeout_seconds: cell.timeoutSeconds ?? null })),
+      stop_on_error: true,
+      stream: true
+    })
+  }
+
+  // 退避された出力の続きをページ単位で取得
+  const loadMoreOutput = async (id: string) => {
+    const spill = cells.find(c => c.id === id)?.spill
+    if (!spill) return
+
+    try {
+      const response = await axios.get(`/api/outputs/${spill.handle}`, {
+        params: { offset: spill.next_offset, limit: Math.min(256 * 1024, spill.tail_offset - spill.next_offset) },
+        headers: { Authorization: `Bearer ${token}` }
+      })
+      setCells(prev => prev.map(cell =>
+        cell.id === id && cell.spill && cell.spill.handle === spill.handle
+          ? {
+              ...cell,
+              spill: {
+                ...cell.spill,
+                loaded: cell.spill.loaded + response.data.text,
+                next_offset: response.data.next_offset
+              }
+            }
+          : cell
+      ))
+    } catch (error) {
+      console.error('Failed to load output:', error)
+    }
+  }
+
   const deleteCell = (id: string) => {
     if (cells.length === 1) return
     setCells(prev => prev.filter(cell => cell.id !== id))
@@ -70,14 +471,10 @@ export default function Notebook() {
 
     socket.emit('save_notebook', {
       notebook_path: notebookName,
-      content: {
-        cells: cells.map(c => ({
-          cell_type: 'code',
-          source: c.code,
-          outputs: c.output ? [{ text: c.output }] : []
-        }))
-      }
+      content: { cells: cells.map(toSavedCell) }
     })
+    synced.current = snapshot(notebookName, cells)
+    fetchNotebooks()
   }
 
   return (
@@ -92,6 +489,22 @@ export default function Notebook() {
         <button onClick={saveNotebook} className="btn-save">
           保存
         </button>
+        <button onClick={runAll} className="btn-run-all">
+          すべて実行
+        </button>
+        <select
+          value=""
+          onFocus={fetchNotebooks}
+          onChange={(e) => openNotebook(e.target.value)}
+          className="notebook-list"
+        >
+          <option value="">開く...</option>
+          {notebooks.map(notebook => (
+            <option key={notebook.name} value={notebook.name}>
+              {notebook.name}（{notebook.cell_count} セル{notebook.kernel_state === 'busy' ? '・実行中' : ''}）
+            </option>
+          ))}
+        </select>
       </div>
 
       <div className="cells-container">
@@ -101,8 +514,11 @@ export default function Notebook() {
             cell={cell}
             index={index}
             onUpdate={(code) => updateCell(cell.id, code)}
-            onExecute={() => executeCell(cell.id)}
+            onExecute={(profile) => executeCell(cell.id, profile)}
+            onInterrupt={() => interruptCell(cell.id)}
+            onTimeoutChange={(seconds) => updateTimeout(cell.id, seconds)}
             onDelete={() => deleteCell(cell.id)}
+            onLoadMore={() => loadMoreOutput(cell.id)}
           />
         ))}
       </div>
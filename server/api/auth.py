@@ -1,8 +1,9 @@
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from jose import JWTError, jwt
-from sqlalchemy.orm import Session
-from database import get_db, User
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import get_async_db
+from cache import user_cache, CachedUser
 from config import settings
 from datetime import datetime, timedelta
 import logging
@@ -32,8 +33,8 @@ def verify_token(token: str):
 
 async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
-) -> User:
+    db: AsyncSession = Depends(get_async_db)
+) -> CachedUser:
     token = credentials.credentials
     payload = verify_token(token)
     
@@ -50,7 +51,7 @@ async def get_current_user(
             detail="Invalid authentication credentials"
         )
     
-    user = db.query(User).filter(User.id == int(user_id)).first()
+    user = await user_cache.get_user(int(user_id), db)
     if user is None:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -62,7 +63,7 @@ async def get_current_user(
     
     return user
 
-async def require_admin(current_user: User = Depends(get_current_user)) -> User:
+async def require_admin(current_user: CachedUser = Depends(get_current_user)) -> CachedUser:
     if not current_user.is_admin:
         raise HTTPException(status_code=403, detail="Admin access required")
     return current_user
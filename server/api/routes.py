@@ -1,37 +1,122 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+import asyncio
+from fastapi import APIRouter, Depends, HTTPException, Query, status
+from fastapi.responses import FileResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List
-from database import get_db, User, ResourceLimit, Session as DBSession
+from database import get_async_db, User, ResourceLimit, Session as DBSession
 from api.auth import get_current_user, require_admin
-from api.schemas import UserResponse, ResourceLimitUpdate, UserUpdate, SessionResponse
+from api.schemas import UserResponse, ResourceLimitUpdate, UserUpdate, SessionResponse, JobSubmitRequest, JobResponse
+from api.websocket import jupyter_manager, resource_monitor, scheduler
+from cache import CachedUser
+from tracing import tracer
+from jupyter.notebooks import NotebookPatchError
 from datetime import datetime
 
 router = APIRouter()
 
 @router.get("/users/me", response_model=UserResponse)
-async def get_me(current_user: User = Depends(get_current_user)):
+async def get_me(current_user: CachedUser = Depends(get_current_user)):
     return current_user
 
+@router.get("/notebooks")
+async def list_notebooks(current_user: CachedUser = Depends(get_current_user)):
+    return await jupyter_manager.list_notebooks(current_user.id)
+
+@router.get("/notebooks/{name:path}")
+async def open_notebook(name: str, current_user: CachedUser = Depends(get_current_user)):
+    try:
+        path = await jupyter_manager.notebooks.current_path(current_user.id, name)
+    except NotebookPatchError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not path.is_file():
+        raise HTTPException(status_code=404, detail="Notebook not found")
+    
+    # Sent from the file in chunks, the notebook is not parsed here
+    return FileResponse(path, media_type="application/x-ipynb+json")
+
+@router.get("/outputs/{handle}")
+async def read_spilled_output(
+    handle: str,
+    offset: int = Query(0, ge=0),
+    limit: int = Query(64 * 1024, gt=0),
+    current_user: CachedUser = Depends(get_current_user)
+):
+    spilled = jupyter_manager.spill.get(handle, current_user.id)
+    if spilled is None:
+        raise HTTPException(status_code=404, detail="Output not found")
+    if offset > spilled.total_bytes:
+        raise HTTPException(status_code=400, detail="Offset is past the end of the output")
+    
+    return await asyncio.to_thread(jupyter_manager.spill.read, spilled, offset, limit)
+
+@router.post("/jobs", response_model=JobResponse, status_code=status.HTTP_201_CREATED)
+async def submit_job(request: JobSubmitRequest, current_user: CachedUser = Depends(get_current_user)):
+    if not await resource_monitor.check_limits(current_user.id):
+        raise HTTPException(status_code=403, detail="Resource limit exceeded")
+    try:
+        return await jupyter_manager.jobs.submit(
+            current_user.id, request.notebook_path, request.output_path, request.stop_on_error
+        )
+    except NotebookPatchError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Notebook not found")
+
+@router.get("/jobs", response_model=List[JobResponse])
+async def list_jobs(current_user: CachedUser = Depends(get_current_user)):
+    return await jupyter_manager.jobs.list(current_user.id)
+
+@router.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: int, current_user: CachedUser = Depends(get_current_user)):
+    job = await jupyter_manager.jobs.get(current_user.id, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@router.get("/jobs/{job_id}/output")
+async def read_job_output(job_id: int, current_user: CachedUser = Depends(get_current_user)):
+    # The executed notebook as far as it has been written out
+    job = await jupyter_manager.jobs.get(current_user.id, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    try:
+        path = await jupyter_manager.notebooks.current_path(current_user.id, job.output_path)
+    except NotebookPatchError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if job.started_at is None or not path.is_file():
+        raise HTTPException(status_code=404, detail="The job has no output yet")
+    return FileResponse(path, media_type="application/x-ipynb+json")
+
+@router.post("/jobs/{job_id}/cancel", response_model=JobResponse)
+async def cancel_job(job_id: int, current_user: CachedUser = Depends(get_current_user)):
+    job = await jupyter_manager.jobs.cancel(current_user.id, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
 @router.get("/admin/users", response_model=List[UserResponse])
 async def list_users(
-    current_user: User = Depends(require_admin),
-    db: Session = Depends(get_db)
+    current_user: CachedUser = Depends(require_admin),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    users = db.query(User).all()
+    users = (await db.execute(select(User))).scalars().all()
     return users
 
 @router.put("/admin/users/{user_id}/limits")
 async def update_user_limits(
     user_id: int,
     limits: ResourceLimitUpdate,
-    current_user: User = Depends(require_admin),
-    db: Session = Depends(get_db)
+    current_user: CachedUser = Depends(require_admin),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    user = db.query(User).filter(User.id == user_id).first()
+    user = await db.get(User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    resource_limit = db.query(ResourceLimit).filter(ResourceLimit.user_id == user_id).first()
+    resource_limit = (await db.execute(
+        select(ResourceLimit).where(ResourceLimit.user_id == user_id)
+    )).scalars().first()
     if not resource_limit:
         resource_limit = ResourceLimit(user_id=user_id)
         db.add(resource_limit)
@@ -40,19 +125,23 @@ async def update_user_limits(
     resource_limit.memory_mb = limits.memory_mb
     resource_limit.gpu_memory_mb = limits.gpu_memory_mb
     resource_limit.storage_mb = limits.storage_mb
+    resource_limit.max_execution_seconds = limits.max_execution_seconds
+    
+    await db.commit()
+    await jupyter_manager.cluster.invalidate_user(user_id)
     
-    db.commit()
-    db.refresh(resource_limit)
+    # Apply the new limits to kernels that are already running
+    await jupyter_manager.apply_user_limits(user_id, limits.cpu_percent, limits.memory_mb)
     return {"message": "Limits updated successfully"}
 
 @router.put("/admin/users/{user_id}")
 async def update_user(
     user_id: int,
     user_update: UserUpdate,
-    current_user: User = Depends(require_admin),
-    db: Session = Depends(get_db)
+    current_user: CachedUser = Depends(require_admin),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    user = db.query(User).filter(User.id == user_id).first()
+    user = await db.get(User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -61,29 +150,86 @@ async def update_user(
     if user_update.is_whitelisted is not None:
         user.is_whitelisted = user_update.is_whitelisted
     
-    db.commit()
+    await db.commit()
+    await jupyter_manager.cluster.invalidate_user(user_id)
     return {"message": "User updated successfully"}
 
 @router.get("/admin/sessions", response_model=List[SessionResponse])
 async def list_sessions(
-    current_user: User = Depends(require_admin),
-    db: Session = Depends(get_db)
+    current_user: CachedUser = Depends(require_admin),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    sessions = db.query(DBSession).filter(DBSession.is_active == True).all()
+    sessions = (await db.execute(select(DBSession).where(DBSession.is_active == True))).scalars().all()
     return sessions
 
 @router.delete("/admin/sessions/{session_id}")
 async def terminate_session(
     session_id: int,
-    current_user: User = Depends(require_admin),
-    db: Session = Depends(get_db)
+    current_user: CachedUser = Depends(require_admin),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    session = db.query(DBSession).filter(DBSession.id == session_id).first()
+    session = await db.get(DBSession, session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
     session.is_active = False
     session.ended_at = datetime.utcnow()
-    db.commit()
+    await db.commit()
+    
+    # Stop the kernel behind the session as well, in whichever server
+    # worker owns it
+    await jupyter_manager.remove_kernel(session.kernel_id, session_id=session.id)
     
     return {"message": "Session terminated"}
+
+@router.post("/admin/sessions/{session_id}/interrupt")
+async def interrupt_session(
+    session_id: int,
+    restart: bool = False,
+    current_user: CachedUser = Depends(require_admin),
+    db: AsyncSession = Depends(get_async_db)
+):
+    # Stops the cell running in the session's kernel: an interrupt, then a
+    # restart if it does not stop (restart=true restarts right away). The
+    # kernel and session stay, its owner gets the cell back as interrupted.
+    session = await db.get(DBSession, session_id)
+    if not session or not session.is_active:
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    payload = {'key': session.kernel_id, 'restart': restart}
+    if await jupyter_manager.cluster.route(session.kernel_id, 'interrupt', payload, claim=False):
+        return {"message": "Interrupt sent"}
+    result = await jupyter_manager.interrupt(session.kernel_id, restart=restart)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Kernel not found")
+    return result
+
+@router.get("/admin/kernels/pool")
+async def kernel_pool_stats(current_user: CachedUser = Depends(require_admin)):
+    return jupyter_manager.pool.stats()
+
+@router.get("/admin/workers")
+async def worker_stats(current_user: CachedUser = Depends(require_admin)):
+    return jupyter_manager.placement.stats()
+
+@router.get("/admin/scheduler")
+async def scheduler_stats(current_user: CachedUser = Depends(require_admin)):
+    return scheduler.stats()
+
+@router.get("/admin/system")
+async def system_stats(current_user: CachedUser = Depends(require_admin)):
+    # The same data as the admin_stats_history socket event
+    return jupyter_manager.system.snapshot()
+
+@router.get("/admin/kernels")
+async def kernel_stats(current_user: CachedUser = Depends(require_admin)):
+    return {
+        **jupyter_manager.lifecycle.stats(),
+        'isolation': jupyter_manager.isolator.mode,
+        'usage_sampler': jupyter_manager.sampler.stats(),
+        'system_sampler': jupyter_manager.system.stats(),
+        'cluster': jupyter_manager.cluster.stats(),
+        'replay': jupyter_manager.replay.stats(),
+        'tracing': tracer.stats(),
+        'jobs': jupyter_manager.jobs.stats()
+    }
@@ -18,6 +18,8 @@ class ResourceLimitUpdate(BaseModel):
     memory_mb: int
     gpu_memory_mb: int
     storage_mb: int
+    # None = default_limits, 0 = no limit
+    max_execution_seconds: Optional[int] = None
 
 class UserUpdate(BaseModel):
     is_banned: Optional[bool] = None
@@ -45,3 +47,25 @@ class NotebookExecuteResponse(BaseModel):
     cell_id: str
     output: str
     error: Optional[str] = None
+
+class JobSubmitRequest(BaseModel):
+    notebook_path: str
+    # Defaults to <name>.out.ipynb next to the notebook
+    output_path: Optional[str] = None
+    stop_on_error: bool = True
+
+class JobResponse(BaseModel):
+    id: int
+    notebook_path: str
+    output_path: str
+    stop_on_error: bool
+    status: str
+    cells_total: int
+    cells_done: int
+    error: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    
+    class Config:
+        from_attributes = True
@@ -1,7 +1,8 @@
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
-from database import SessionLocal, User, ResourceLimit
+from sqlalchemy import select
+from database import AsyncSessionLocal, User, ResourceLimit
+from api.websocket import jupyter_manager
 from api.auth import create_access_token
 from config import settings
 import logging
@@ -32,10 +33,9 @@ async def login(request: LoginRequest):
     # Check if admin
     is_admin = email in settings.admin_emails
     
-    db = SessionLocal()
-    try:
+    async with AsyncSessionLocal() as db:
         # Get or create user
-        user = db.query(User).filter(User.email == email).first()
+        user = (await db.execute(select(User).where(User.email == email))).scalars().first()
         
         if not user:
             logger.info(f"Creating new user: {email}")
@@ -48,8 +48,8 @@ async def login(request: LoginRequest):
                 is_banned=False
             )
             db.add(user)
-            db.commit()
-            db.refresh(user)
+            await db.commit()
+            await db.refresh(user)
             
             # Create default resource limits
             limits = ResourceLimit(
@@ -60,7 +60,7 @@ async def login(request: LoginRequest):
                 storage_mb=settings.default_limits.storage_mb
             )
             db.add(limits)
-            db.commit()
+            await db.commit()
             logger.info(f"User created with default limits: {email}")
         
         # Check if banned
@@ -74,12 +74,13 @@ async def login(request: LoginRequest):
         # Update whitelist status if needed
         if not user.is_whitelisted:
             user.is_whitelisted = True
-            db.commit()
+            await db.commit()
         
         # Update admin status if needed
         if user.is_admin != is_admin:
             user.is_admin = is_admin
-            db.commit()
+            await db.commit()
+        await jupyter_manager.cluster.invalidate_user(user.id)
         
         # Create JWT token
         token = create_access_token(data={"sub": str(user.id), "email": user.email})
@@ -96,6 +97,4 @@ async def login(request: LoginRequest):
             },
             token=token
         )
-        
-    finally:
-        db.close()
+
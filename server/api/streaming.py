@@ -0,0 +1,199 @@
+import json
+import base64
+import binascii
+import asyncio
+import logging
+from typing import TYPE_CHECKING, List, Optional
+import socketio
+from config import StreamingConfig
+
+if TYPE_CHECKING:
+    from jupyter.replay import ReplayBuffer
+
+logger = logging.getLogger(__name__)
+
+# Sent as raw bytes, which Socket.IO carries as binary attachments
+BINARY_MIME_TYPES = ('image/png', 'image/jpeg', 'image/gif', 'image/webp')
+
+def payload_size(value) -> int:
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    return len(json.dumps(value))
+
+def output_size(output: dict) -> int:
+    if output.get('output_type') == 'stream':
+        return len(output.get('text', ''))
+    return sum(payload_size(value) for value in output.get('data', {}).values())
+
+def prepare_output(output: dict, max_output_bytes: int) -> dict:
+    # Decodes base64 images to bytes and leaves out MIME payloads over
+    # max_output_bytes, listing their sizes under 'omitted'
+    data = output.get('data')
+    if not data:
+        return output
+
+    prepared = {}
+    omitted = {}
+    for mime, value in data.items():
+        if mime in BINARY_MIME_TYPES and isinstance(value, str):
+            try:
+                value = base64.b64decode(value)
+            except (binascii.Error, ValueError):
+                pass
+        size = payload_size(value)
+        if size > max_output_bytes:
+            omitted[mime] = size
+            continue
+        prepared[mime] = value
+
+    result = dict(output, data=prepared)
+    if omitted:
+        result['omitted'] = omitted
+    return result
+
+class KernelChannel:
+    # Sends the events of one kernel's cells to its current subscriber and
+    # keeps them in the kernel's replay buffer, so a client that reconnects
+    # can catch up. With no subscriber the events are only buffered.
+    def __init__(self, sio: socketio.AsyncServer, buffer: 'ReplayBuffer'):
+        self.sio = sio
+        self.buffer = buffer
+
+    @property
+    def sid(self) -> Optional[str]:
+        return self.buffer.sid
+
+    def connected(self) -> bool:
+        return self.buffer.sid is not None and self.sio.manager.is_connected(self.buffer.sid, '/')
+
+    async def emit(self, event: str, data: dict, callback=None) -> bool:
+        # True when the event was sent to a subscriber
+        data = self.buffer.append(event, data)
+        if self.buffer.sid is None:
+            return False
+        await self.sio.emit(event, data, to=self.buffer.sid, callback=callback)
+        return True
+
+class CellOutputStreamer:
+    # Sends a cell's outputs as cell_output_chunk events while it runs.
+    # Small stream writes are coalesced into batches that are flushed either
+    # every flush_interval_ms or once max_batch_bytes is buffered. Every chunk
+    # is acknowledged by the client; with max_inflight_chunks unacknowledged
+    # the streamer keeps coalescing instead of sending, and once the buffer
+    # passes max_buffer_bytes the oldest stream text is dropped so a slow
+    # client cannot make the server hold an unbounded amount of output.
+    #
+    # Chunks go through the kernel's channel; when the subscriber changes
+    # the acknowledgements still owed by the previous one are written off.
+    def __init__(self, channel: KernelChannel, cell_id: str, config: StreamingConfig):
+        self.channel = channel
+        self.cell_id = cell_id
+        self.config = config
+        self._buffer: List[dict] = []
+        self._buffer_bytes = 0
+        self._dropped_bytes = 0
+        self._seq = 0
+        self._inflight = 0
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self._timer: Optional[asyncio.Task] = None
+        self._send_lock = asyncio.Lock()
+        channel.buffer.streamers.add(self)
+
+    async def feed(self, output: dict):
+        output = prepare_output(output, self.config.max_output_bytes)
+        last = self._buffer[-1] if self._buffer else None
+        if (
+            last is not None
+            and output.get('output_type') == 'stream'
+            and last.get('output_type') == 'stream'
+            and last.get('name') == output.get('name')
+        ):
+            last['text'] += output['text']
+        else:
+            self._buffer.append(dict(output))
+        self._buffer_bytes += output_size(output)
+
+        if self._buffer_bytes >= self.config.max_batch_bytes:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+
+    async def flush(self):
+        async with self._send_lock:
+            if not self._buffer:
+                return
+
+            if self._inflight >= self.config.max_inflight_chunks:
+                # The client is behind, keep coalescing until it acknowledges
+                self._trim()
+                return
+
+            outputs = self._buffer
+            dropped = self._dropped_bytes
+            self._buffer = []
+            self._buffer_bytes = 0
+            self._dropped_bytes = 0
+
+            self._seq += 1
+            self._inflight += 1
+            self._drained.clear()
+            sent = await self.channel.emit('cell_output_chunk', {
+                'cell_id': self.cell_id,
+                'seq': self._seq,
+                'outputs': outputs,
+                'dropped_bytes': dropped
+            }, callback=self._on_ack)
+            if not sent:
+                self._on_ack()
+
+    async def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        # Give the client a chance to catch up so the final chunk goes out
+        # in order; a client that never acknowledges only costs the timeout
+        if self._inflight and self.channel.connected():
+            try:
+                await asyncio.wait_for(self._drained.wait(), timeout=self.config.ack_timeout_seconds)
+            except asyncio.TimeoutError:
+                logger.warning(f"Client {self.channel.sid} did not acknowledge output of cell {self.cell_id}")
+        self._inflight = 0
+        await self.flush()
+        self.channel.buffer.streamers.discard(self)
+
+    def retarget(self):
+        # The subscriber changed or went away
+        self._inflight = 0
+        self._drained.set()
+        if self._buffer and self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later(0))
+
+    def _on_ack(self, *args):
+        self._inflight = max(self._inflight - 1, 0)
+        if self._inflight == 0:
+            self._drained.set()
+        if self._buffer and self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later(0))
+
+    async def _flush_later(self, delay: Optional[float] = None):
+        if delay is None:
+            delay = self.config.flush_interval_ms / 1000
+        await asyncio.sleep(delay)
+        self._timer = None
+        await self.flush()
+
+    def _trim(self):
+        # Drop the oldest stream text first, results and errors are kept
+        for output in self._buffer:
+            if self._buffer_bytes <= self.config.max_buffer_bytes:
+                break
+            if output.get('output_type') != 'stream' or not output['text']:
+                continue
+            excess = self._buffer_bytes - self.config.max_buffer_bytes
+            cut = min(excess, len(output['text']))
+            output['text'] = output['text'][cut:]
+            self._buffer_bytes -= cut
+            self._dropped_bytes += cut
+        self._buffer = [o for o in self._buffer if o.get('output_type') != 'stream' or o['text']]
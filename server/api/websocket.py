@@ -1,21 +1,64 @@
+import time
+import asyncio
 import socketio
 import logging
 from jupyter.manager import JupyterManager
+from jupyter.scheduler import ExecutionCancelled, ExecutionScheduler
 from resources.monitor import ResourceMonitor
 from api.auth import verify_token
-from database import SessionLocal, User
+from api.streaming import CellOutputStreamer, KernelChannel, prepare_output
+from cache import user_cache
+from config import settings
+import metrics
+from tracing import SpanContext, tracer
 
 logger = logging.getLogger(__name__)
 
+jupyter_manager = JupyterManager()
+
 sio = socketio.AsyncServer(
     async_mode='asgi',
+    # With several server workers, emits reach clients connected to any of them
+    client_manager=jupyter_manager.cluster.client_manager(),
     cors_allowed_origins='*',  # 開発用：すべてのオリジンを許可
     logger=True,
     engineio_logger=True
 )
 
-jupyter_manager = JupyterManager()
-resource_monitor = ResourceMonitor()
+resource_monitor = ResourceMonitor(jupyter_manager.sampler, jupyter_manager.storage)
+scheduler = ExecutionScheduler(settings.scheduler)
+
+# Sockets of admin dashboards, they get every system sample
+ADMIN_STATS_ROOM = 'admin_stats'
+
+async def publish_admin_stats(sample: dict) -> bool:
+    # Every server worker samples on its own and sends to the dashboards
+    # connected to it, nothing goes out while there are none
+    if next(sio.manager.get_participants('/', ADMIN_STATS_ROOM), None) is None:
+        return False
+    await sio.emit('admin_stats', sample, room=ADMIN_STATS_ROOM, ignore_queue=True)
+    return True
+
+jupyter_manager.system.on_sample = publish_admin_stats
+
+def cancelled_result(cell_id: str) -> dict:
+    # Result of a cell taken out of the queue by interrupt_cell
+    return {
+        'cell_id': cell_id,
+        'status': 'cancelled',
+        'output': '',
+        'outputs': [],
+        'error': 'The cell was cancelled before it ran',
+        'execution_count': None,
+        'spill': None,
+        'profile': None
+    }
+
+def kernel_channel(user_id, notebook_path: str, sid: str) -> KernelChannel:
+    # Cell events go to whoever ran a cell on the kernel last (or
+    # resubscribed to it), and are kept for replay
+    key = jupyter_manager.kernel_key(user_id, notebook_path)
+    return KernelChannel(sio, jupyter_manager.replay.subscribe(key, notebook_path, sid))
 
 @sio.event
 async def connect(sid, environ, auth):
@@ -34,34 +77,33 @@ async def connect(sid, environ, auth):
         return False
     
     user_id = payload.get('sub')
-    db = SessionLocal()
-    try:
-        user = db.query(User).filter(User.id == int(user_id)).first()
-        if not user or user.is_banned or not user.is_whitelisted:
-            logger.warning(f"[WebSocket] User {user_id} not authorized")
-            return False
-        
-        # Store user info in session
-        async with sio.session(sid) as session:
-            session['user_id'] = user_id
-            session['email'] = user.email
-        
-        logger.info(f"[WebSocket] Client connected successfully: {sid} (user: {user.email})")
-    finally:
-        db.close()
+    user = await user_cache.get_user(int(user_id))
+    if not user or user.is_banned or not user.is_whitelisted:
+        logger.warning(f"[WebSocket] User {user_id} not authorized")
+        return False
     
+    # Store user info in session
+    async with sio.session(sid) as session:
+        session['user_id'] = user_id
+        session['email'] = user.email
+    
+    metrics.CONNECTED_SOCKETS.inc()
+    logger.info(f"[WebSocket] Client connected successfully: {sid} (user: {user.email})")
     return True
 
 @sio.event
 async def disconnect(sid):
+    # Kernels are not tied to a socket; they are kept until the lifecycle
+    # manager culls them as idle, so a reconnecting client finds its state.
+    # Output of running cells is buffered until it resubscribes.
+    metrics.CONNECTED_SOCKETS.dec()
+    jupyter_manager.replay.detach(sid)
+    await jupyter_manager.cluster.broadcast('detach_socket', {'sid': sid})
     logger.info(f"[WebSocket] Client disconnected: {sid}")
-    # Clean up user session
-    await jupyter_manager.cleanup_session(sid)
 
 @sio.event
 async def execute_cell(sid, data):
     logger.info(f"[WebSocket] Execute cell request from {sid}")
-    logger.info(f"[WebSocket] Cell data: {data}")
     
     async with sio.session(sid) as session:
         user_id = session.get('user_id')
@@ -71,23 +113,354 @@ async def execute_cell(sid, data):
         await sio.emit('error', {'message': 'Unauthorized'}, room=sid)
         return
     
+    with tracer.span('execute_cell', user_id=str(user_id), cell_id=str(data.get('cell_id'))):
+        # The trace continues in whichever worker runs the cell
+        payload = {'sid': sid, 'user_id': user_id, 'data': data, 'trace': tracer.current()}
+        key = jupyter_manager.kernel_key(user_id, data.get('notebook_path'))
+        if await jupyter_manager.cluster.route(key, 'execute_cell', payload):
+            return
+        await run_execute_cell(payload)
+
+async def run_execute_cell(payload: dict):
+    # Runs in the server worker that owns the kernel, which need not be the
+    # one the client is connected to
+    trace = payload.get('trace')
+    with tracer.span('run_execute_cell', parent=SpanContext(*trace) if trace else None):
+        await _run_execute_cell(payload)
+
+async def _run_execute_cell(payload: dict):
+    sid, user_id, data = payload['sid'], payload['user_id'], payload['data']
+    notebook_path = data.get('notebook_path')
+    cell_id = data.get('cell_id')
+    
     # Check resource limits
-    if not await resource_monitor.check_limits(user_id):
+    with tracer.span('check_limits') as span:
+        allowed = await resource_monitor.check_limits(user_id)
+        span.set_attribute('allowed', allowed)
+    if not allowed:
         logger.warning(f"[WebSocket] Resource limit exceeded for user {user_id}")
-        await sio.emit('error', {'message': 'Resource limit exceeded. Waiting for session to end.'}, room=sid)
+        await sio.emit('error', {
+            'message': 'Resource limit exceeded. Waiting for session to end.',
+            'cell_id': cell_id
+        }, room=sid)
         return
     
-    # Execute code
-    logger.info(f"[WebSocket] Executing code for user {user_id}")
-    result = await jupyter_manager.execute_code(
-        user_id=user_id,
-        notebook_path=data.get('notebook_path'),
-        code=data.get('code'),
-        cell_id=data.get('cell_id')
-    )
+    channel = kernel_channel(user_id, notebook_path, sid)
+    
+    # The scheduler runs the cell in a task of its own
+    trace = tracer.current()
+    submitted_ns = time.time_ns()
+    
+    async def run():
+        tracer.record('queue', submitted_ns, time.time_ns(), parent=trace)
+        with tracer.span('execute', parent=trace):
+            return await execute()
+    
+    async def execute():
+        # Execute code
+        logger.info(f"[WebSocket] Executing code for user {user_id}")
+        if data.get('stream'):
+            # Streaming mode: cell_output_chunk events while running, then cell_complete
+            streamer = CellOutputStreamer(channel, cell_id, settings.streaming)
+            result = await jupyter_manager.execute_code(
+                user_id=user_id,
+                notebook_path=notebook_path,
+                code=data.get('code'),
+                cell_id=cell_id,
+                on_output=streamer.feed,
+                profile=bool(data.get('profile')),
+                timeout_seconds=data.get('timeout_seconds')
+            )
+            return result, streamer
+        
+        result = await jupyter_manager.execute_code(
+            user_id=user_id,
+            notebook_path=notebook_path,
+            code=data.get('code'),
+            cell_id=cell_id,
+            profile=bool(data.get('profile')),
+            timeout_seconds=data.get('timeout_seconds')
+        )
+        return result, None
+    
+    async def on_queued(position: int, queue_depth: int):
+        await channel.emit('cell_queued', {
+            'cell_id': cell_id,
+            'position': position,
+            'queue_depth': queue_depth
+        })
+    
+    async def on_start():
+        await channel.emit('cell_started', {'cell_id': cell_id})
+    
+    try:
+        result, streamer = await scheduler.submit(
+            user_id=user_id,
+            kernel_key=jupyter_manager.kernel_key(user_id, notebook_path),
+            weight=await resource_monitor.get_cpu_weight(user_id),
+            run=run,
+            on_queued=on_queued,
+            on_start=on_start,
+            cell_ids=[cell_id]
+        )
+    except ExecutionCancelled:
+        await channel.emit('cell_complete' if data.get('stream') else 'cell_output', cancelled_result(cell_id))
+        return
+    
+    # The scheduler slot is free again by now, waiting for a slow client to
+    # acknowledge the last chunks holds up nobody else's cells
+    with tracer.span('emit'):
+        if streamer is not None:
+            await streamer.close()
+            await channel.emit('cell_complete', result)
+            return
+        result['outputs'] = [
+            prepare_output(output, settings.streaming.max_output_bytes)
+            for output in result['outputs']
+        ]
+        await channel.emit('cell_output', result)
+
+@sio.event
+async def execute_cells(sid, data):
+    # Run all: {notebook_path, cells: [{cell_id, code, timeout_seconds}],
+    # stop_on_error, stream}.
+    # One session lookup, limit check and scheduler slot for the whole batch;
+    # every cell gets the same events as with execute_cell, then
+    # cells_complete once the batch is done.
+    async with sio.session(sid) as session:
+        user_id = session.get('user_id')
+    
+    if not user_id:
+        await sio.emit('error', {'message': 'Unauthorized'}, room=sid)
+        return
+    
+    with tracer.span('execute_cells', user_id=str(user_id), cells=len(data.get('cells') or [])):
+        payload = {'sid': sid, 'user_id': user_id, 'data': data, 'trace': tracer.current()}
+        key = jupyter_manager.kernel_key(user_id, data.get('notebook_path'))
+        if await jupyter_manager.cluster.route(key, 'execute_cells', payload):
+            return
+        await run_execute_cells(payload)
+
+async def run_execute_cells(payload: dict):
+    trace = payload.get('trace')
+    with tracer.span('run_execute_cells', parent=SpanContext(*trace) if trace else None):
+        await _run_execute_cells(payload)
+
+async def _run_execute_cells(payload: dict):
+    sid, user_id, data = payload['sid'], payload['user_id'], payload['data']
+    notebook_path = data.get('notebook_path')
+    cells = [
+        {'cell_id': cell.get('cell_id'), 'code': cell.get('code') or '', 'timeout_seconds': cell.get('timeout_seconds')}
+        for cell in data.get('cells') or []
+    ]
+    if not cells:
+        return
+    
+    with tracer.span('check_limits') as span:
+        allowed = await resource_monitor.check_limits(user_id)
+        span.set_attribute('allowed', allowed)
+    if not allowed:
+        logger.warning(f"[WebSocket] Resource limit exceeded for user {user_id}")
+        for cell in cells:
+            await sio.emit('error', {
+                'message': 'Resource limit exceeded. Waiting for session to end.',
+                'cell_id': cell['cell_id']
+            }, room=sid)
+        return
+    
+    channel = kernel_channel(user_id, notebook_path, sid)
+    stream = bool(data.get('stream'))
+    trace = tracer.current()
+    submitted_ns = time.time_ns()
+    
+    # Waiting for a streamer's last acknowledgement must not hold up
+    # collecting the next cell, each cell is finished in its own task
+    finishing = []
+    
+    async def run():
+        tracer.record('queue', submitted_ns, time.time_ns(), parent=trace)
+        with tracer.span('execute', parent=trace):
+            return await execute()
+    
+    async def execute():
+        streamers = {}
+        
+        async def on_cell_start(cell_id: str):
+            if stream:
+                streamers[cell_id] = CellOutputStreamer(channel, cell_id, settings.streaming)
+            await channel.emit('cell_started', {'cell_id': cell_id})
+        
+        async def on_output(cell_id: str, output: dict):
+            await streamers[cell_id].feed(output)
+        
+        async def finish(result: dict):
+            streamer = streamers.pop(result['cell_id'], None)
+            if streamer is not None:
+                await streamer.close()
+            if stream:
+                await channel.emit('cell_complete', result)
+                return
+            result['outputs'] = [
+                prepare_output(output, settings.streaming.max_output_bytes)
+                for output in result['outputs']
+            ]
+            await channel.emit('cell_output', result)
+        
+        async def on_cell_done(result: dict):
+            finishing.append(asyncio.create_task(finish(result)))
+        
+        return await jupyter_manager.execute_cells(
+            user_id=user_id,
+            notebook_path=notebook_path,
+            cells=cells,
+            stop_on_error=data.get('stop_on_error', True),
+            on_cell_start=on_cell_start,
+            on_output=on_output if stream else None,
+            on_cell_done=on_cell_done
+        )
     
-    logger.info(f"[WebSocket] Execution result: {result}")
-    await sio.emit('cell_output', result, room=sid)
+    async def on_queued(position: int, queue_depth: int):
+        # Position of the batch, reported on its first cell
+        await channel.emit('cell_queued', {
+            'cell_id': cells[0]['cell_id'],
+            'position': position,
+            'queue_depth': queue_depth
+        })
+    
+    try:
+        results = await scheduler.submit(
+            user_id=user_id,
+            kernel_key=jupyter_manager.kernel_key(user_id, notebook_path),
+            weight=await resource_monitor.get_cpu_weight(user_id),
+            run=run,
+            on_queued=on_queued,
+            cell_ids=[cell['cell_id'] for cell in cells]
+        )
+    except ExecutionCancelled:
+        for cell in cells:
+            await channel.emit('cell_complete' if stream else 'cell_output', cancelled_result(cell['cell_id']))
+        await channel.emit('cells_complete', {
+            'notebook_path': notebook_path,
+            'statuses': {cell['cell_id']: 'cancelled' for cell in cells}
+        })
+        return
+    
+    # As with a single cell, the last acknowledgements are waited for once
+    # the scheduler slot is free
+    with tracer.span('emit'):
+        await asyncio.gather(*finishing)
+        await channel.emit('cells_complete', {
+            'notebook_path': notebook_path,
+            'statuses': {result['cell_id']: result['status'] for result in results}
+        })
+
+@sio.event
+async def interrupt_cell(sid, data):
+    # {notebook_path, cell_id}: a running cell is interrupted, and its kernel
+    # restarted if it does not stop within interrupt_grace_seconds; a queued
+    # one is taken out of the queue together with the rest of its batch.
+    # The cell's own result comes with status interrupted or cancelled,
+    # interrupt_result tells what was done.
+    async with sio.session(sid) as session:
+        user_id = session.get('user_id')
+    
+    if not user_id:
+        await sio.emit('error', {'message': 'Unauthorized'}, room=sid)
+        return
+    
+    payload = {'sid': sid, 'user_id': user_id, 'data': data}
+    key = jupyter_manager.kernel_key(user_id, data.get('notebook_path'))
+    if await jupyter_manager.cluster.route(key, 'interrupt_cell', payload, claim=False):
+        return
+    await run_interrupt_cell(payload)
+
+async def run_interrupt_cell(payload: dict):
+    sid, user_id, data = payload['sid'], payload['user_id'], payload['data']
+    notebook_path = data.get('notebook_path')
+    cell_id = data.get('cell_id')
+    key = jupyter_manager.kernel_key(user_id, notebook_path)
+    if scheduler.cancel(key, cell_id):
+        outcome = 'cancelled'
+    else:
+        result = await jupyter_manager.interrupt(key, cell_id)
+        outcome = result['outcome'] if result is not None else 'not_running'
+    logger.info(f"[WebSocket] Interrupt of cell {cell_id} on {key}: {outcome}")
+    await sio.emit('interrupt_result', {
+        'notebook_path': notebook_path,
+        'cell_id': cell_id,
+        'outcome': outcome
+    }, room=sid)
+
+@sio.event
+async def resubscribe(sid, data):
+    # After a reconnect: {notebook_path, since_seq}. This socket becomes the
+    # subscriber of the notebook's kernel and gets kernel_replay with the
+    # cell events after since_seq (none for a since_seq of null), then the
+    # live events that follow.
+    async with sio.session(sid) as session:
+        user_id = session.get('user_id')
+    
+    if not user_id:
+        await sio.emit('error', {'message': 'Unauthorized'}, room=sid)
+        return
+    
+    payload = {'sid': sid, 'user_id': user_id, 'data': data}
+    key = jupyter_manager.kernel_key(user_id, data.get('notebook_path'))
+    if await jupyter_manager.cluster.route(key, 'resubscribe', payload, claim=False):
+        return
+    await run_resubscribe(payload)
+
+async def run_resubscribe(payload: dict):
+    sid, user_id, data = payload['sid'], payload['user_id'], payload['data']
+    notebook_path = data.get('notebook_path')
+    key = jupyter_manager.kernel_key(user_id, notebook_path)
+    kernel = jupyter_manager.kernels.get(key)
+    if kernel is None:
+        # Culled, or lost with its server worker; so is its output
+        await sio.emit('kernel_replay', {
+            'notebook_path': notebook_path,
+            'kernel': False,
+            'busy': False,
+            'events': [],
+            'missed': bool(data.get('since_seq')),
+            'last_seq': 0
+        }, room=sid)
+        return
+    
+    buffer = jupyter_manager.replay.subscribe(key, notebook_path, sid)
+    events, missed = buffer.since(data.get('since_seq'))
+    jupyter_manager.replay.replayed += len(events)
+    logger.info(f"[WebSocket] {sid} resubscribed to {key}, replaying {len(events)} events")
+    await sio.emit('kernel_replay', {
+        'notebook_path': notebook_path,
+        'kernel': True,
+        'busy': kernel.busy,
+        'events': [{'event': event, 'data': event_data} for event, event_data in events],
+        'missed': missed,
+        'last_seq': buffer.seq
+    }, room=sid)
+
+async def run_detach_socket(payload: dict):
+    jupyter_manager.replay.detach(payload['sid'])
+
+@sio.event
+async def subscribe_admin_stats(sid, data=None):
+    # Admin dashboard: admin_stats_history with the samples kept so far,
+    # then admin_stats ({time, system, users}) every interval_seconds
+    async with sio.session(sid) as session:
+        user_id = session.get('user_id')
+    
+    user = await user_cache.get_user(int(user_id)) if user_id else None
+    if not user or not user.is_admin:
+        await sio.emit('error', {'message': 'Unauthorized'}, room=sid)
+        return
+    
+    await sio.enter_room(sid, ADMIN_STATS_ROOM)
+    await sio.emit('admin_stats_history', jupyter_manager.system.snapshot(), room=sid)
+
+@sio.event
+async def unsubscribe_admin_stats(sid, data=None):
+    await sio.leave_room(sid, ADMIN_STATS_ROOM)
 
 @sio.event
 async def save_notebook(sid, data):
@@ -100,6 +473,15 @@ async def save_notebook(sid, data):
         await sio.emit('error', {'message': 'Unauthorized'}, room=sid)
         return
     
+    # The worker owning the notebook's kernel also holds its open model
+    payload = {'sid': sid, 'user_id': user_id, 'data': data}
+    key = jupyter_manager.kernel_key(user_id, data.get('notebook_path'))
+    if await jupyter_manager.cluster.route(key, 'save_notebook', payload):
+        return
+    await run_save_notebook(payload)
+
+async def run_save_notebook(payload: dict):
+    sid, user_id, data = payload['sid'], payload['user_id'], payload['data']
     result = await jupyter_manager.save_notebook(
         user_id=user_id,
         notebook_path=data.get('notebook_path'),
@@ -108,3 +490,36 @@ async def save_notebook(sid, data):
     
     logger.info(f"[WebSocket] Save result: {result}")
     await sio.emit('save_result', result, room=sid)
+
+@sio.event
+async def notebook_patch(sid, data):
+    # Cell-level changes: {notebook_path, ops: [{op: insert|update|delete|move, ...}]}
+    async with sio.session(sid) as session:
+        user_id = session.get('user_id')
+    
+    if not user_id:
+        await sio.emit('error', {'message': 'Unauthorized'}, room=sid)
+        return
+    
+    payload = {'sid': sid, 'user_id': user_id, 'data': data}
+    key = jupyter_manager.kernel_key(user_id, data.get('notebook_path'))
+    if await jupyter_manager.cluster.route(key, 'notebook_patch', payload):
+        return
+    await run_notebook_patch(payload)
+
+async def run_notebook_patch(payload: dict):
+    sid, user_id, data = payload['sid'], payload['user_id'], payload['data']
+    result = await jupyter_manager.patch_notebook(
+        user_id=user_id,
+        notebook_path=data.get('notebook_path'),
+        ops=data.get('ops') or []
+    )
+    await sio.emit('patch_result', {'notebook_path': data.get('notebook_path'), **result}, room=sid)
+
+jupyter_manager.cluster.register('execute_cell', run_execute_cell)
+jupyter_manager.cluster.register('execute_cells', run_execute_cells)
+jupyter_manager.cluster.register('interrupt_cell', run_interrupt_cell)
+jupyter_manager.cluster.register('resubscribe', run_resubscribe)
+jupyter_manager.cluster.register('detach_socket', run_detach_socket)
+jupyter_manager.cluster.register('save_notebook', run_save_notebook)
+jupyter_manager.cluster.register('notebook_patch', run_notebook_patch)
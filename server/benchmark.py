@@ -0,0 +1,325 @@
+import sys
+import json
+import math
+import time
+import uuid
+import socket
+import asyncio
+import logging
+import argparse
+import platform
+import subprocess
+from datetime import datetime
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+import httpx
+import socketio
+
+# Load benchmark for the WebSocket execution path. Starts the server in this
+# process (or uses a running one with --url), connects many Socket.IO
+# clients that log in through /api/auth/login like the browser client, and
+# runs each workload on all of them at once. Latencies are measured on the
+# client side:
+#
+#   connect       login request + Socket.IO connect
+#   first_output  execute_cell sent -> first cell_output_chunk
+#   completion    execute_cell sent -> cell_complete (save_notebook -> save_result)
+#
+# The in-process server uses config/config.yaml as it is, including its
+# database and storage. Every client works on its own notebook
+# (bench-<run>-<n>.ipynb), so each one gets its own kernel; one untimed cell
+# per client starts the kernels before the first workload. The notebooks
+# written by the save workload are left in the users' directories.
+#
+# Clients log in as different users so the per-user fair share of the
+# scheduler is part of what is measured. The in-process server whitelists
+# bench-<n>@benchmark.local, one per client; against a running server the
+# clients take turns over the addresses given with --emails.
+#
+# The Socket.IO client needs aiohttp (pip install -r requirements-dev.txt).
+
+WORKLOADS: Dict[str, dict] = {
+    'trivial': {'code': '1 + 1'},
+    'cpu': {'code': 'sum(i * i for i in range(3_000_000))'},
+    'output': {'code': "for i in range(2000):\n    print('x' * 500)"},
+    'save': {'cells': 50, 'cell_bytes': 2000}
+}
+
+PERCENTILES = (50, 95, 99)
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    # Nearest-rank on an already sorted list
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(p / 100 * len(sorted_values)) - 1, 0)
+    return sorted_values[rank]
+
+def summarize(values: List[float]) -> dict:
+    values = sorted(values)
+    summary = {'count': len(values)}
+    if not values:
+        return summary
+    summary.update({f'p{p}_ms': round(percentile(values, p) * 1000, 2) for p in PERCENTILES})
+    summary['mean_ms'] = round(sum(values) / len(values) * 1000, 2)
+    summary['max_ms'] = round(values[-1] * 1000, 2)
+    return summary
+
+class BenchClient:
+    def __init__(self, base_url: str, email: str, notebook_path: str, timeout: float):
+        self.base_url = base_url
+        self.email = email
+        self.notebook_path = notebook_path
+        self.timeout = timeout
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self._cells: Dict[str, dict] = {}
+        self._saves: List[asyncio.Future] = []
+        self.sio.on('cell_output_chunk', self._on_chunk)
+        self.sio.on('cell_output', self._on_complete)
+        self.sio.on('cell_complete', self._on_complete)
+        self.sio.on('save_result', self._on_save)
+        self.sio.on('error', self._on_error)
+
+    async def connect(self, http: httpx.AsyncClient) -> float:
+        started = time.perf_counter()
+        response = await http.post(f'{self.base_url}/api/auth/login', json={'email': self.email})
+        response.raise_for_status()
+        token = response.json()['token']
+        await self.sio.connect(self.base_url, auth={'token': token}, transports=['websocket'])
+        return time.perf_counter() - started
+
+    async def close(self):
+        await self.sio.disconnect()
+
+    async def execute(self, code: str) -> dict:
+        # Returns first_output (None for a cell without output) and completion
+        cell_id = uuid.uuid4().hex
+        cell = {
+            'sent': time.perf_counter(),
+            'first_output': None,
+            'done': asyncio.get_running_loop().create_future()
+        }
+        self._cells[cell_id] = cell
+        try:
+            await self.sio.emit('execute_cell', {
+                'notebook_path': self.notebook_path,
+                'code': code,
+                'cell_id': cell_id,
+                'stream': True
+            })
+            result = await asyncio.wait_for(cell['done'], timeout=self.timeout)
+        finally:
+            self._cells.pop(cell_id, None)
+        if result.get('error'):
+            raise RuntimeError(result['error'].splitlines()[-1] if result['error'] else 'error')
+        return {
+            'first_output': cell['first_output'],
+            'completion': cell['completed'] - cell['sent']
+        }
+
+    async def save(self, cells: List[dict]) -> dict:
+        done = asyncio.get_running_loop().create_future()
+        self._saves.append(done)
+        sent = time.perf_counter()
+        await self.sio.emit('save_notebook', {
+            'notebook_path': self.notebook_path,
+            'content': {'cells': cells}
+        })
+        result = await asyncio.wait_for(done, timeout=self.timeout)
+        if not result.get('success'):
+            raise RuntimeError(result.get('error', 'save failed'))
+        return {'first_output': None, 'completion': time.perf_counter() - sent}
+
+    async def _on_chunk(self, data):
+        cell = self._cells.get(data.get('cell_id'))
+        if cell is not None and cell['first_output'] is None:
+            cell['first_output'] = time.perf_counter() - cell['sent']
+        # Acknowledge like the browser client, or the server stops sending
+        return True
+
+    async def _on_complete(self, data):
+        cell = self._cells.get(data.get('cell_id'))
+        if cell is None or cell['done'].done():
+            return
+        cell['completed'] = time.perf_counter()
+        if cell['first_output'] is None and data.get('outputs'):
+            cell['first_output'] = cell['completed'] - cell['sent']
+        cell['done'].set_result(data)
+
+    async def _on_save(self, data):
+        while self._saves:
+            done = self._saves.pop(0)
+            if not done.done():
+                done.set_result(data)
+                return
+
+    async def _on_error(self, data):
+        cell = self._cells.get((data or {}).get('cell_id'))
+        if cell is not None and not cell['done'].done():
+            cell['completed'] = time.perf_counter()
+            cell['done'].set_result({'error': data.get('message', 'error')})
+
+def save_cells(count: int, cell_bytes: int) -> List[dict]:
+    line = 'x = 1  # ' + 'a' * 70 + '\n'
+    source = (line * (cell_bytes // len(line) + 1))[:cell_bytes]
+    return [
+        {'id': f'cell-{n}', 'cell_type': 'code', 'source': source, 'outputs': []}
+        for n in range(count)
+    ]
+
+async def run_workload(
+    clients: List[BenchClient], name: str, iterations: int
+) -> dict:
+    spec = WORKLOADS[name]
+    if name == 'save':
+        cells = save_cells(spec['cells'], spec['cell_bytes'])
+        operation: Callable[[BenchClient], Awaitable[dict]] = lambda client: client.save(cells)
+    else:
+        operation = lambda client: client.execute(spec['code'])
+
+    first_output: List[float] = []
+    completion: List[float] = []
+    errors: List[str] = []
+
+    async def drive(client: BenchClient):
+        for _ in range(iterations):
+            try:
+                timing = await operation(client)
+            except Exception as e:
+                errors.append(f'{type(e).__name__}: {e}')
+                continue
+            if timing['first_output'] is not None:
+                first_output.append(timing['first_output'])
+            completion.append(timing['completion'])
+
+    started = time.perf_counter()
+    await asyncio.gather(*(drive(client) for client in clients))
+    elapsed = time.perf_counter() - started
+    return {
+        'operations': len(completion),
+        'errors': len(errors),
+        'error_samples': sorted(set(errors))[:5],
+        'duration_s': round(elapsed, 3),
+        'throughput_per_s': round(len(completion) / elapsed, 2) if elapsed else 0.0,
+        'first_output': summarize(first_output),
+        'completion': summarize(completion)
+    }
+
+async def start_server(port: int):
+    import uvicorn
+    from main import socket_app
+
+    # The server logs every Socket.IO packet at INFO
+    for name in ('', 'socketio.server', 'engineio.server'):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    server = uvicorn.Server(uvicorn.Config(socket_app, host='127.0.0.1', port=port, log_level='warning'))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        if task.done():
+            task.result()
+            raise RuntimeError('Server exited during startup')
+        await asyncio.sleep(0.05)
+    return server, task
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def git_revision() -> Optional[str]:
+    try:
+        result = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=Path(__file__).parent, capture_output=True, text=True, timeout=5
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return result.stdout.strip() or None
+
+async def run(args) -> dict:
+    server = task = None
+    base_url = args.url
+    emails = args.emails
+    if base_url is None:
+        if not emails:
+            from config import settings
+            emails = [f'bench-{n}@benchmark.local' for n in range(args.clients)]
+            settings.whitelist_emails.extend(email for email in emails if email not in settings.whitelist_emails)
+        server, task = await start_server(args.port or free_port())
+        base_url = f'http://127.0.0.1:{server.config.port}'
+    base_url = base_url.rstrip('/')
+
+    run_id = uuid.uuid4().hex[:6]
+    clients = [
+        BenchClient(base_url, emails[n % len(emails)], f'bench-{run_id}-{n}.ipynb', args.timeout)
+        for n in range(args.clients)
+    ]
+    report = {
+        'revision': git_revision(),
+        'started_at': datetime.utcnow().isoformat() + 'Z',
+        'host': {'platform': platform.platform(), 'python': platform.python_version()},
+        'config': {
+            'url': args.url,
+            'clients': args.clients,
+            'users': min(len(emails), args.clients),
+            'iterations': args.iterations,
+            'workloads': args.workloads
+        }
+    }
+
+    try:
+        async with httpx.AsyncClient(timeout=args.timeout) as http:
+            connect_started = time.perf_counter()
+            connect = await asyncio.gather(*(client.connect(http) for client in clients))
+            report['connect'] = {
+                **summarize(list(connect)),
+                'duration_s': round(time.perf_counter() - connect_started, 3)
+            }
+
+        # Kernel start-up is not part of any workload
+        warmup_started = time.perf_counter()
+        await asyncio.gather(*(client.execute('pass') for client in clients))
+        report['warmup_s'] = round(time.perf_counter() - warmup_started, 3)
+
+        report['workloads'] = {}
+        for name in args.workloads:
+            print(f'Running {name} on {len(clients)} clients...', file=sys.stderr)
+            report['workloads'][name] = await run_workload(clients, name, args.iterations)
+    finally:
+        await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
+        if server is not None:
+            server.should_exit = True
+            await task
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the WebSocket execution path")
+    parser.add_argument('--url', default=None,
+                        help="Benchmark a running server instead of starting one in this process")
+    parser.add_argument('--port', type=int, default=None, help="Port of the in-process server")
+    parser.add_argument('--emails', default=None,
+                        help="Comma-separated whitelisted emails the clients log in with, in turn "
+                             "(default for the in-process server: one generated user per client)")
+    parser.add_argument('--clients', type=int, default=10)
+    parser.add_argument('--iterations', type=int, default=10, help="Operations per client and workload")
+    parser.add_argument('--workloads', default=','.join(WORKLOADS),
+                        help=f"Comma-separated, from {', '.join(WORKLOADS)}")
+    parser.add_argument('--timeout', type=float, default=300.0, help="Per operation, in seconds")
+    parser.add_argument('--output', default=None, help="Write the JSON report here as well as to stdout")
+    args = parser.parse_args()
+
+    args.workloads = [name.strip() for name in args.workloads.split(',') if name.strip()]
+    unknown = [name for name in args.workloads if name not in WORKLOADS]
+    if unknown:
+        parser.error(f"Unknown workloads: {', '.join(unknown)}")
+    args.emails = [email.strip() for email in (args.emails or '').split(',') if email.strip()]
+    if args.url is not None and not args.emails:
+        parser.error("--url needs --emails, whitelisted on that server")
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        Path(args.output).write_text(text + '\n', encoding='utf-8')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import time
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from database import AsyncSessionLocal, User, ResourceLimit
+from config import settings
+
+class CachedUser:
+    # Copy of a User row that stays usable after its DB session is closed
+    def __init__(self, user: User):
+        self.id: int = user.id
+        self.email: str = user.email
+        self.oauth_provider: Optional[str] = user.oauth_provider
+        self.oauth_id: Optional[str] = user.oauth_id
+        self.is_admin: bool = bool(user.is_admin)
+        self.is_banned: bool = bool(user.is_banned)
+        self.is_whitelisted: bool = bool(user.is_whitelisted)
+        self.created_at: datetime = user.created_at
+
+class CachedLimits:
+    def __init__(self, limits: ResourceLimit):
+        self.cpu_percent: Optional[int] = limits.cpu_percent
+        self.memory_mb: Optional[int] = limits.memory_mb
+        self.gpu_memory_mb: Optional[int] = limits.gpu_memory_mb
+        self.storage_mb: Optional[int] = limits.storage_mb
+        self.max_execution_seconds: Optional[int] = limits.max_execution_seconds
+
+class UserCache:
+    # Users and their resource limits are read on every request and every
+    # cell, but change only through the admin endpoints and login. Entries
+    # live for user_ttl_seconds; the code paths that change a user call
+    # invalidate() so bans and new limits apply on the next request. The TTL
+    # bounds how stale another server process can be.
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._users: Dict[int, Tuple[float, CachedUser]] = {}
+        self._limits: Dict[int, Tuple[float, Optional[CachedLimits]]] = {}
+
+    async def get_user(self, user_id: int, db: Optional[AsyncSession] = None) -> Optional[CachedUser]:
+        user_id = int(user_id)
+        entry = self._users.get(user_id)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        user = await self._first(db, select(User).where(User.id == user_id))
+        if user is None:
+            # Unknown users are not cached, they may be created by the next login
+            self._users.pop(user_id, None)
+            return None
+        cached = CachedUser(user)
+        self._users[user_id] = (time.monotonic() + self.ttl_seconds, cached)
+        return cached
+
+    async def get_limits(self, user_id: int, db: Optional[AsyncSession] = None) -> Optional[CachedLimits]:
+        user_id = int(user_id)
+        entry = self._limits.get(user_id)
+        if entry is not None and entry[0] > time.monotonic():
+            return entry[1]
+
+        limits = await self._first(db, select(ResourceLimit).where(ResourceLimit.user_id == user_id))
+        cached = CachedLimits(limits) if limits is not None else None
+        self._limits[user_id] = (time.monotonic() + self.ttl_seconds, cached)
+        return cached
+
+    def invalidate(self, user_id: int):
+        self._users.pop(int(user_id), None)
+        self._limits.pop(int(user_id), None)
+
+    async def _first(self, db: Optional[AsyncSession], statement):
+        if db is not None:
+            return (await db.execute(statement)).scalars().first()
+        async with AsyncSessionLocal() as db:
+            return (await db.execute(statement)).scalars().first()
+
+user_cache = UserCache(settings.cache.user_ttl_seconds)
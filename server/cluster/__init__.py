@@ -0,0 +1 @@
+# Cluster module
@@ -0,0 +1,250 @@
+import hmac
+import pickle
+import struct
+import asyncio
+import hashlib
+import logging
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# Frames on the local relay: 4-byte length, then HMAC-SHA256 of the payload
+# and the pickled (channel, message) payload
+HEADER = struct.Struct('!I')
+DIGEST_SIZE = hashlib.sha256().digest_size
+
+# A worker whose connection to the relay has this much unsent data is
+# disconnected rather than buffered for without bound
+RELAY_MAX_BUFFER_BYTES = 32 * 1024 * 1024
+
+def sign(key: bytes, payload: bytes) -> bytes:
+    return hmac.new(key, payload, hashlib.sha256).digest() + payload
+
+def verify(key: bytes, data: bytes) -> Optional[bytes]:
+    # The payload of signed data, None if the signature does not match
+    digest, payload = data[:DIGEST_SIZE], data[DIGEST_SIZE:]
+    if not hmac.compare_digest(digest, hmac.new(key, payload, hashlib.sha256).digest()):
+        return None
+    return payload
+
+class MessageBus(ABC):
+    # Pub/sub between the server worker processes. Messages are dicts and
+    # may carry bytes (binary Socket.IO attachments). Subscribers get an
+    # asyncio.Queue per channel; every subscriber sees every message
+    # published on its channel, including the publisher's own.
+    def __init__(self):
+        self._subscribers: Dict[str, List[asyncio.Queue]] = {}
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    def subscribe(self, channel: str) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers.setdefault(channel, []).append(queue)
+        return queue
+
+    @abstractmethod
+    async def publish(self, channel: str, message: dict):
+        ...
+
+    def _deliver(self, channel: str, message: dict):
+        for queue in self._subscribers.get(channel, ()):
+            queue.put_nowait(message)
+
+class MemoryBus(MessageBus):
+    # Buses created with the same name in one process share their messages.
+    # Stand-in for tests that run several server instances in one process.
+    _hubs: Dict[str, Set['MemoryBus']] = {}
+
+    def __init__(self, name: str):
+        super().__init__()
+        self.name = name
+
+    async def start(self):
+        self._hubs.setdefault(self.name, set()).add(self)
+
+    async def close(self):
+        self._hubs.get(self.name, set()).discard(self)
+
+    async def publish(self, channel: str, message: dict):
+        for bus in list(self._hubs.get(self.name, ())):
+            bus._deliver(channel, message)
+
+class LocalBus(MessageBus):
+    # Client of the relay that main.py starts next to the uvicorn workers
+    # (see BusRelay). For a single host without Redis. Frames are signed
+    # with the server secret and checked before they are unpickled.
+    def __init__(self, host: str, port: int, secret: str):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.key = secret.encode('utf-8')
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._write_lock = asyncio.Lock()
+
+    async def start(self):
+        reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        self._reader_task = asyncio.create_task(self._read(reader))
+
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+            self._reader_task = None
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    async def publish(self, channel: str, message: dict):
+        frame = sign(self.key, pickle.dumps((channel, message)))
+        async with self._write_lock:
+            self._writer.write(HEADER.pack(len(frame)) + frame)
+            await self._writer.drain()
+
+    async def _read(self, reader: asyncio.StreamReader):
+        while True:
+            try:
+                frame = await read_frame(reader)
+            except asyncio.IncompleteReadError:
+                logger.error("Connection to the message relay closed")
+                return
+            payload = verify(self.key, frame)
+            if payload is None:
+                logger.warning("Dropping message with an invalid signature")
+                continue
+            channel, message = pickle.loads(payload)
+            self._deliver(channel, message)
+
+class RedisBus(MessageBus):
+    # Redis pub/sub, for workers on several hosts. Needs the redis package.
+    # All channels live under one prefix so a single pattern subscription
+    # covers them. Messages are signed like those of LocalBus, anyone else
+    # who can publish to the Redis server cannot get them unpickled.
+    prefix = 'distributed-jupyter:'
+
+    def __init__(self, url: str, secret: str):
+        super().__init__()
+        self.url = url
+        self.key = secret.encode('utf-8')
+        self._redis = None
+        self._pubsub = None
+        self._reader_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        try:
+            import redis.asyncio as aioredis
+        except ImportError:
+            raise RuntimeError("cluster.message_queue uses Redis, install the redis package")
+        self._redis = aioredis.Redis.from_url(self.url)
+        self._pubsub = self._redis.pubsub()
+        await self._pubsub.psubscribe(self.prefix + '*')
+        self._reader_task = asyncio.create_task(self._read())
+
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+            self._reader_task = None
+        if self._pubsub is not None:
+            await self._pubsub.aclose()
+        if self._redis is not None:
+            await self._redis.aclose()
+
+    async def publish(self, channel: str, message: dict):
+        await self._redis.publish(self.prefix + channel, sign(self.key, pickle.dumps(message)))
+
+    async def _read(self):
+        async for item in self._pubsub.listen():
+            if item['type'] != 'pmessage':
+                continue
+            payload = verify(self.key, item['data'])
+            if payload is None:
+                logger.warning("Dropping message with an invalid signature")
+                continue
+            channel = item['channel'].decode('utf-8')[len(self.prefix):]
+            self._deliver(channel, pickle.loads(payload))
+
+async def read_frame(reader: asyncio.StreamReader) -> bytes:
+    (size,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return await reader.readexactly(size)
+
+def create_bus(url: str, secret: str) -> MessageBus:
+    parsed = urlparse(url)
+    if parsed.scheme == 'memory':
+        return MemoryBus(parsed.netloc or 'default')
+    if parsed.scheme == 'local':
+        return LocalBus(parsed.hostname or '127.0.0.1', parsed.port or 8765, secret)
+    if parsed.scheme in ('redis', 'rediss'):
+        return RedisBus(url, secret)
+    raise ValueError(f"Unsupported message queue: {url}")
+
+class BusRelay:
+    # Fan-out relay for LocalBus: every frame a worker sends is passed on to
+    # all connected workers. Runs in its own thread in the process that
+    # starts the uvicorn workers. The relay does not look inside frames,
+    # signatures are checked by the receiving workers. A worker that does
+    # not keep up (RELAY_MAX_BUFFER_BYTES unsent) is disconnected instead of
+    # holding up the others or growing the relay's memory without bound.
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._writers: Set[asyncio.StreamWriter] = set()
+        self._ready = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start_in_thread(self):
+        self._thread = threading.Thread(target=self._run, name='bus-relay', daemon=True)
+        self._thread.start()
+        self._ready.wait(10)
+
+    def _run(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"Message relay listening on {self.host}:{self.port}")
+        self._ready.set()
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._writers.add(writer)
+        try:
+            while True:
+                frame = await read_frame(reader)
+                data = HEADER.pack(len(frame)) + frame
+                for other in list(self._writers):
+                    try:
+                        other.write(data)
+                    except Exception:
+                        self._writers.discard(other)
+                        continue
+                    if other.transport.get_write_buffer_size() > RELAY_MAX_BUFFER_BYTES:
+                        logger.warning("Disconnecting a worker that does not keep up with the message relay")
+                        self._writers.discard(other)
+                        other.close()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._writers.discard(writer)
+            writer.close()
+
+def relay_address(url: str) -> Optional[Tuple[str, int]]:
+    # Where main.py should start a relay for this message queue, if anywhere
+    parsed = urlparse(url)
+    if parsed.scheme != 'local':
+        return None
+    return parsed.hostname or '127.0.0.1', parsed.port or 8765
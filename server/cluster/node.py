@@ -0,0 +1,170 @@
+import os
+import uuid
+import socket
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+import socketio
+from socketio.async_pubsub_manager import AsyncPubSubManager
+from config import ClusterConfig
+from cache import user_cache
+from cluster.bus import MessageBus, create_bus
+from cluster.registry import KernelRegistry
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[dict], Awaitable[None]]
+
+# A forwarded event is passed on at most this many times, in case ownership
+# changes while it is in flight
+MAX_HOPS = 2
+
+class BusClientManager(AsyncPubSubManager):
+    # Socket.IO client manager on the cluster message bus, so an emit to a
+    # sid reaches the worker holding that client's connection
+    name = 'bus'
+
+    def __init__(self, bus: MessageBus, channel: str = 'socketio'):
+        super().__init__(channel=channel)
+        self.bus = bus
+
+    async def _publish(self, data):
+        await self.bus.publish(self.channel, data)
+
+    async def _listen(self):
+        queue = self.bus.subscribe(self.channel)
+        while True:
+            yield await queue.get()
+
+class ClusterNode:
+    # This server worker process's place among the uvicorn workers. Kernels
+    # live in the worker that started them, so an event for a kernel (cell
+    # execution, notebook saves) is sent over the message bus to its owner
+    # in the KernelRegistry, which handles it as if its own client had sent
+    # it. Replies go to the client through the Socket.IO client manager.
+    # Changes that every worker must see (cached users, limits) are
+    # broadcast.
+    #
+    # Without cluster.message_queue the server runs as a single process and
+    # every call here is a no-op.
+    def __init__(self, config: ClusterConfig, secret: str, owns: Callable[[str], bool]):
+        self.config = config
+        self.enabled = config.message_queue is not None
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.bus: Optional[MessageBus] = create_bus(config.message_queue, secret) if self.enabled else None
+        self.registry = KernelRegistry(self.worker_id, config)
+        self.forwarded = 0
+        self.received = 0
+        self._owns = owns
+        self._handlers: Dict[str, Handler] = {}
+        self._tasks: List[asyncio.Task] = []
+        # Events being handled, forwarded cells among them
+        self._dispatching: Set[asyncio.Task] = set()
+        self.register('invalidate_user', self._invalidate_user)
+
+    def client_manager(self) -> Optional[socketio.AsyncManager]:
+        return BusClientManager(self.bus) if self.enabled else None
+
+    def register(self, event: str, handler: Handler):
+        self._handlers[event] = handler
+
+    async def start(self):
+        if not self.enabled or self._tasks:
+            return
+        await self.bus.start()
+        await self.registry.register()
+        self._tasks = [
+            asyncio.create_task(self._heartbeat_loop()),
+            asyncio.create_task(self._listen(self.bus.subscribe(f'worker:{self.worker_id}'))),
+            asyncio.create_task(self._listen(self.bus.subscribe('broadcast')))
+        ]
+
+    async def stop(self):
+        for task in [*self._tasks, *self._dispatching]:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        await asyncio.gather(*self._dispatching, return_exceptions=True)
+        if self.enabled:
+            await self.registry.unregister()
+            await self.bus.close()
+
+    async def route(self, key: str, event: str, payload: dict, claim: bool = True, hops: int = 0) -> bool:
+        # True when the event was sent to the worker owning the kernel and
+        # must not be handled here. With claim, a kernel nobody owns yet
+        # becomes this worker's.
+        if not self.enabled or self._owns(key):
+            return False
+        owner = await (self.registry.claim(key) if claim else self.registry.owner(key))
+        if owner is None or owner == self.worker_id:
+            return False
+        await self.bus.publish(f'worker:{owner}', {
+            'event': event,
+            'key': key,
+            'claim': claim,
+            'payload': payload,
+            'hops': hops
+        })
+        self.forwarded += 1
+        return True
+
+    async def broadcast(self, event: str, payload: dict):
+        if self.enabled:
+            await self.bus.publish('broadcast', {'event': event, 'payload': payload, 'origin': self.worker_id})
+
+    async def invalidate_user(self, user_id: int):
+        # Drop the cached user and limits in every worker
+        user_cache.invalidate(user_id)
+        await self.broadcast('invalidate_user', {'user_id': user_id})
+
+    async def _invalidate_user(self, payload: dict):
+        user_cache.invalidate(payload['user_id'])
+
+    async def release(self, key: str):
+        if self.enabled:
+            await self.registry.release(key)
+
+    def stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'worker_id': self.worker_id,
+            'forwarded': self.forwarded,
+            'received': self.received
+        }
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.config.heartbeat_interval_seconds)
+            try:
+                await self.registry.heartbeat()
+            except Exception as e:
+                logger.error(f"Cluster heartbeat failed: {e}", exc_info=True)
+
+    async def _listen(self, queue: asyncio.Queue):
+        while True:
+            message = await queue.get()
+            if message.get('origin') == self.worker_id:
+                continue
+            task = asyncio.create_task(self._dispatch(message))
+            self._dispatching.add(task)
+            task.add_done_callback(self._dispatching.discard)
+
+    async def _dispatch(self, message: dict):
+        handler = self._handlers.get(message['event'])
+        if handler is None:
+            logger.warning(f"No handler for cluster event {message['event']}")
+            return
+        try:
+            key = message.get('key')
+            if key is not None:
+                self.received += 1
+                hops = message['hops'] + 1
+                if hops <= MAX_HOPS and await self.route(key, message['event'], message['payload'], message['claim'], hops):
+                    return
+            await handler(message['payload'])
+        except Exception as e:
+            logger.error(f"Failed to handle cluster event {message['event']}: {e}", exc_info=True)
@@ -0,0 +1,105 @@
+import logging
+from datetime import datetime, timedelta
+from typing import List, Optional
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from config import ClusterConfig
+from database import AsyncSessionLocal, ClusterWorker, KernelOwner
+
+logger = logging.getLogger(__name__)
+
+class KernelRegistry:
+    # Which server worker process owns each kernel, shared through the
+    # database. Every worker keeps a heartbeat row in cluster_workers; a
+    # worker whose heartbeat is older than worker_timeout_seconds is taken
+    # as dead, and its kernels (which died with it) can be claimed by
+    # another worker. Heartbeats use the database clock of each worker's
+    # host, so hosts need roughly synchronized clocks.
+    def __init__(self, worker_id: str, config: ClusterConfig):
+        self.worker_id = worker_id
+        self.config = config
+
+    async def register(self):
+        async with AsyncSessionLocal() as db:
+            await db.merge(ClusterWorker(id=self.worker_id))
+            await db.commit()
+        logger.info(f"Worker {self.worker_id} registered")
+
+    async def heartbeat(self):
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(ClusterWorker)
+                .where(ClusterWorker.id == self.worker_id)
+                .values(heartbeat_at=datetime.utcnow())
+            )
+            # Kernels of dead workers no longer exist
+            dead = select(ClusterWorker.id).where(ClusterWorker.heartbeat_at < self._deadline())
+            await db.execute(delete(KernelOwner).where(KernelOwner.worker_id.in_(dead)))
+            await db.execute(delete(ClusterWorker).where(ClusterWorker.heartbeat_at < self._deadline()))
+            await db.commit()
+
+    async def unregister(self):
+        async with AsyncSessionLocal() as db:
+            await db.execute(delete(KernelOwner).where(KernelOwner.worker_id == self.worker_id))
+            await db.execute(delete(ClusterWorker).where(ClusterWorker.id == self.worker_id))
+            await db.commit()
+
+    async def owner(self, key: str) -> Optional[str]:
+        async with AsyncSessionLocal() as db:
+            row = await db.get(KernelOwner, key)
+            if row is None or not await self._alive(db, row.worker_id):
+                return None
+            return row.worker_id
+
+    async def claim(self, key: str) -> str:
+        # Owner of the kernel, which becomes this worker if nobody (alive)
+        # owns it yet
+        owner = None
+        for _ in range(3):
+            async with AsyncSessionLocal() as db:
+                row = await db.get(KernelOwner, key)
+                if row is None:
+                    db.add(KernelOwner(kernel_key=key, worker_id=self.worker_id))
+                    try:
+                        await db.commit()
+                        return self.worker_id
+                    except IntegrityError:
+                        # Claimed by another worker at the same moment
+                        continue
+
+                owner = row.worker_id
+                if owner == self.worker_id or await self._alive(db, owner):
+                    return owner
+
+                # Take over from a dead worker, unless someone else just did
+                result = await db.execute(
+                    update(KernelOwner)
+                    .where(KernelOwner.kernel_key == key, KernelOwner.worker_id == owner)
+                    .values(worker_id=self.worker_id, created_at=datetime.utcnow())
+                )
+                await db.commit()
+                if result.rowcount == 1:
+                    logger.info(f"Kernel {key} taken over from dead worker {owner}")
+                    return self.worker_id
+        return owner
+
+    async def release(self, key: str):
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                delete(KernelOwner)
+                .where(KernelOwner.kernel_key == key, KernelOwner.worker_id == self.worker_id)
+            )
+            await db.commit()
+
+    async def alive_workers(self) -> List[str]:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(select(ClusterWorker.id).where(ClusterWorker.heartbeat_at >= self._deadline()))
+            return list(result.scalars())
+
+    async def _alive(self, db: AsyncSession, worker_id: str) -> bool:
+        worker = await db.get(ClusterWorker, worker_id)
+        return worker is not None and worker.heartbeat_at >= self._deadline()
+
+    def _deadline(self) -> datetime:
+        return datetime.utcnow() - timedelta(seconds=self.config.worker_timeout_seconds)
@@ -1,15 +1,23 @@
 import yaml
 from pathlib import Path
 from pydantic import BaseModel
-from typing import List
+from typing import Dict, List, Optional
 
 class ServerConfig(BaseModel):
     host: str
     port: int
     secret_key: str
+    # Number of uvicorn worker processes in production mode
+    workers: int = 1
 
 class DatabaseConfig(BaseModel):
     url: str
+    # Derived from url when not set (sqlite -> aiosqlite, postgresql -> asyncpg)
+    async_url: Optional[str] = None
+    pool_size: int = 10
+    max_overflow: int = 20
+    pool_timeout_seconds: float = 30.0
+    sqlite_busy_timeout_ms: int = 5000
 
 class StorageConfig(BaseModel):
     base_path: str
@@ -20,6 +28,138 @@ class DefaultLimits(BaseModel):
     memory_mb: int
     gpu_memory_mb: int
     storage_mb: int
+    # Longest a single cell may run, None = no limit
+    max_execution_seconds: Optional[int] = None
+
+class KernelPoolSpecConfig(BaseModel):
+    size: int = 2
+    max_age_seconds: int = 3600
+
+class KernelPoolConfig(BaseModel):
+    enabled: bool = True
+    refill_interval_seconds: float = 5.0
+    kernel_specs: Dict[str, KernelPoolSpecConfig] = {"python3": KernelPoolSpecConfig()}
+
+class StreamingConfig(BaseModel):
+    flush_interval_ms: int = 100
+    max_batch_bytes: int = 64 * 1024
+    max_inflight_chunks: int = 4
+    max_buffer_bytes: int = 4 * 1024 * 1024
+    ack_timeout_seconds: float = 10.0
+    # Larger MIME payloads in a single output are replaced by a notice
+    max_output_bytes: int = 2 * 1024 * 1024
+
+class SchedulerConfig(BaseModel):
+    # None = number of CPU cores
+    max_concurrent_executions: Optional[int] = None
+
+class ExecutionConfig(BaseModel):
+    # Time a cell gets to stop after an interrupt before its kernel is
+    # restarted
+    interrupt_grace_seconds: float = 5.0
+    restart_timeout_seconds: float = 60.0
+
+class KernelLifecycleConfig(BaseModel):
+    idle_timeout_seconds: int = 3600
+    check_interval_seconds: int = 60
+    memory_high_water_percent: float = 90.0
+    memory_low_water_percent: float = 80.0
+
+class IsolationConfig(BaseModel):
+    enabled: bool = True
+    cgroup_root: str = "/sys/fs/cgroup"
+    cgroup_name: str = "distributed-jupyter"
+    cpu_period_us: int = 100000
+
+class UsageSamplerConfig(BaseModel):
+    interval_seconds: float = 5.0
+    gpu_enabled: bool = True
+    # Per-user totals as the jupyter_user_usage metric
+    export_metrics: bool = True
+
+class SystemSamplerConfig(BaseModel):
+    interval_seconds: float = 2.0
+    # Samples kept for the admin charts, history_size * interval_seconds
+    history_size: int = 300
+    gpu_enabled: bool = True
+
+class StorageAccountingConfig(BaseModel):
+    reconcile_interval_seconds: int = 300
+
+class CacheConfig(BaseModel):
+    user_ttl_seconds: float = 60.0
+
+class OutputSpillConfig(BaseModel):
+    # Stream output of a single cell beyond threshold_bytes is written to
+    # disk; the client gets the head, the last tail_bytes and a handle
+    threshold_bytes: int = 1024 * 1024
+    tail_bytes: int = 16 * 1024
+    max_page_bytes: int = 256 * 1024
+
+class ReplayConfig(BaseModel):
+    # Cell events kept per kernel for clients that reconnect
+    max_events: int = 2000
+    max_bytes: int = 4 * 1024 * 1024
+
+class NotebookSaveConfig(BaseModel):
+    debounce_ms: int = 1000
+    idle_seconds: int = 600
+
+class WorkerNodeConfig(BaseModel):
+    name: str
+    url: str
+
+class PlacementConfig(BaseModel):
+    workers: List[WorkerNodeConfig] = []
+    # Also place kernels on the server host itself
+    local_kernels: bool = True
+    # Shared secret between the server and the worker agents
+    token: Optional[str] = None
+    poll_interval_seconds: float = 5.0
+    request_timeout_seconds: float = 60.0
+
+class ClusterConfig(BaseModel):
+    # Message queue between the server workers: memory://<name> (one
+    # process, for tests), local://127.0.0.1:8765 (relay started by main.py)
+    # or redis://host:6379/0. None runs a single server process.
+    message_queue: Optional[str] = None
+    heartbeat_interval_seconds: float = 5.0
+    worker_timeout_seconds: float = 20.0
+
+class NotebookIndexConfig(BaseModel):
+    rescan_interval_seconds: int = 60
+
+class MetricsConfig(BaseModel):
+    enabled: bool = True
+
+class TracingConfig(BaseModel):
+    enabled: bool = False
+    # file (JSON lines) or otlp (OTLP/HTTP JSON)
+    exporter: str = "file"
+    # Defaults to <storage.base_path>/traces.jsonl
+    file_path: Optional[str] = None
+    otlp_endpoint: str = "http://localhost:4318/v1/traces"
+    service_name: str = "distributed-jupyter"
+    sample_rate: float = 1.0
+    flush_interval_seconds: float = 1.0
+    max_queued_spans: int = 10000
+
+class ProfilingConfig(BaseModel):
+    # Functions listed in the summary of a profiled cell
+    top_n: int = 20
+    timeout_seconds: float = 30.0
+
+class JobsConfig(BaseModel):
+    # Notebooks run at once by each server worker, each on a kernel of its own
+    max_concurrent_jobs: int = 2
+    max_jobs_per_user: int = 1
+    poll_interval_seconds: float = 2.0
+    # The executed notebook is written out at most this often while it runs
+    checkpoint_interval_seconds: float = 10.0
+    # Stream output of a cell beyond this is left out of the notebook
+    max_cell_output_bytes: int = 4 * 1024 * 1024
+    # None = no limit
+    max_runtime_seconds: Optional[int] = None
 
 class Settings(BaseModel):
     server: ServerConfig
@@ -28,6 +168,26 @@ class Settings(BaseModel):
     database: DatabaseConfig
     storage: StorageConfig
     default_limits: DefaultLimits
+    kernel_pool: KernelPoolConfig = KernelPoolConfig()
+    streaming: StreamingConfig = StreamingConfig()
+    scheduler: SchedulerConfig = SchedulerConfig()
+    execution: ExecutionConfig = ExecutionConfig()
+    kernel_lifecycle: KernelLifecycleConfig = KernelLifecycleConfig()
+    isolation: IsolationConfig = IsolationConfig()
+    usage_sampler: UsageSamplerConfig = UsageSamplerConfig()
+    system_sampler: SystemSamplerConfig = SystemSamplerConfig()
+    storage_accounting: StorageAccountingConfig = StorageAccountingConfig()
+    cache: CacheConfig = CacheConfig()
+    output_spill: OutputSpillConfig = OutputSpillConfig()
+    replay: ReplayConfig = ReplayConfig()
+    notebook_saves: NotebookSaveConfig = NotebookSaveConfig()
+    notebook_index: NotebookIndexConfig = NotebookIndexConfig()
+    placement: PlacementConfig = PlacementConfig()
+    cluster: ClusterConfig = ClusterConfig()
+    metrics: MetricsConfig = MetricsConfig()
+    tracing: TracingConfig = TracingConfig()
+    profiling: ProfilingConfig = ProfilingConfig()
+    jobs: JobsConfig = JobsConfig()
 
 def load_settings() -> Settings:
     config_path = Path(__file__).parent.parent / "config" / "config.yaml"
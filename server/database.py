@@ -1,11 +1,70 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean, DateTime, ForeignKey
+from sqlalchemy import create_engine, event, inspect, text, Column, Integer, String, Float, Boolean, DateTime, ForeignKey
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from datetime import datetime
+from typing import AsyncIterator
 from config import settings
 
-engine = create_engine(settings.database.url, connect_args={"check_same_thread": False})
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+    'postgres': 'postgresql+asyncpg',
+}
+
+def async_database_url(url: str) -> str:
+    scheme, sep, rest = url.partition('://')
+    if '+' in scheme or scheme not in ASYNC_DRIVERS:
+        return url
+    return ASYNC_DRIVERS[scheme] + sep + rest
+
+def _is_sqlite(url: str) -> bool:
+    return url.startswith('sqlite')
+
+def _engine_options(url: str, is_async: bool = False) -> dict:
+    options = {}
+    if _is_sqlite(url):
+        options['connect_args'] = {'check_same_thread': False}
+        if ':memory:' in url or url.endswith('://'):
+            return options
+        if is_async:
+            # aiosqlite defaults to opening a connection (and a thread) per
+            # session, keep a pool like the sync driver does
+            options['poolclass'] = AsyncAdaptedQueuePool
+    else:
+        options['pool_pre_ping'] = True
+    options.update(
+        pool_size=settings.database.pool_size,
+        max_overflow=settings.database.max_overflow,
+        pool_timeout=settings.database.pool_timeout_seconds
+    )
+    return options
+
+def _configure_sqlite(dbapi_connection, connection_record):
+    # WAL lets readers run alongside the writer, NORMAL only syncs at
+    # checkpoints, and busy_timeout makes a writer wait for the lock instead
+    # of failing with "database is locked"
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={settings.database.sqlite_busy_timeout_ms}")
+    cursor.close()
+
+# The sync engine is kept for schema setup and scripts, request handlers
+# use the async engine
+engine = create_engine(settings.database.url, **_engine_options(settings.database.url))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+ASYNC_DATABASE_URL = settings.database.async_url or async_database_url(settings.database.url)
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **_engine_options(ASYNC_DATABASE_URL, is_async=True))
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+if _is_sqlite(settings.database.url):
+    event.listen(engine, 'connect', _configure_sqlite)
+if _is_sqlite(ASYNC_DATABASE_URL):
+    event.listen(async_engine.sync_engine, 'connect', _configure_sqlite)
+
 Base = declarative_base()
 
 class User(Base):
@@ -32,6 +91,8 @@ class ResourceLimit(Base):
     memory_mb = Column(Integer)
     gpu_memory_mb = Column(Integer)
     storage_mb = Column(Integer)
+    # Per-cell deadline, None = default_limits, 0 = no limit
+    max_execution_seconds = Column(Integer, nullable=True)
     
     user = relationship("User", back_populates="resource_limits")
 
@@ -52,9 +113,63 @@ class Session(Base):
     
     user = relationship("User", back_populates="sessions")
 
+class ClusterWorker(Base):
+    __tablename__ = "cluster_workers"
+    
+    id = Column(String, primary_key=True)
+    started_at = Column(DateTime, default=datetime.utcnow)
+    heartbeat_at = Column(DateTime, default=datetime.utcnow)
+
+class KernelOwner(Base):
+    __tablename__ = "kernel_owners"
+    
+    # user_id:notebook_path, the same key as JupyterManager.kernels
+    kernel_key = Column(String, primary_key=True)
+    worker_id = Column(String, index=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class NotebookJob(Base):
+    __tablename__ = "notebook_jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    notebook_path = Column(String)
+    # Where the executed notebook is written, relative to the user's directory
+    output_path = Column(String)
+    stop_on_error = Column(Boolean, default=True)
+    # queued, running, completed, failed or cancelled
+    status = Column(String, default="queued", index=True)
+    # Server worker running the job
+    worker_id = Column(String, nullable=True)
+    cells_total = Column(Integer, default=0)
+    cells_done = Column(Integer, default=0)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+
+def add_missing_columns(bind):
+    # create_all() only creates tables that are missing. Nullable columns
+    # added to a model later are added to existing databases here.
+    inspector = inspect(bind)
+    with bind.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing or not column.nullable:
+                    continue
+                column_type = column.type.compile(dialect=bind.dialect)
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+async def get_async_db() -> AsyncIterator[AsyncSession]:
+    async with AsyncSessionLocal() as db:
+        yield db
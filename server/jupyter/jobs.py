@@ -0,0 +1,394 @@
+import re
+import time
+import asyncio
+import logging
+from datetime import datetime
+from pathlib import PurePosixPath
+from typing import TYPE_CHECKING, Dict, List, Optional
+import nbformat
+from sqlalchemy import func, select, update
+from config import JobsConfig
+from database import AsyncSessionLocal, NotebookJob
+from jupyter.kernel import ManagedKernel
+from jupyter.notebooks import NotebookPatchError, to_nbformat_output
+from api.streaming import output_size
+
+if TYPE_CHECKING:
+    from jupyter.manager import JupyterManager
+
+logger = logging.getLogger(__name__)
+
+FINISHED = ('completed', 'failed', 'cancelled')
+
+# Colours in IPython tracebacks
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;]*m')
+
+def default_output_path(notebook_path: str) -> str:
+    # train.ipynb -> train.out.ipynb, next to the notebook, so a job does not
+    # write over a notebook that may be open in the editor
+    return str(PurePosixPath(notebook_path).with_suffix('.out.ipynb'))
+
+class RunningJob:
+    def __init__(self, job_id: int, user_id: int):
+        self.job_id = job_id
+        self.user_id = user_id
+        self.kernel: Optional[ManagedKernel] = None
+        self.task: Optional[asyncio.Task] = None
+        # Set when the job is cancelled on purpose, as opposed to the server
+        # shutting down
+        self.cancel_requested = False
+
+class NotebookJobRunner:
+    # Runs saved notebooks headless, top to bottom, on a kernel of their own
+    # that no client connection owns: closing the browser or losing the
+    # socket does not touch a job. Jobs are rows in notebook_jobs; every
+    # server worker polls for queued jobs and claims them with a conditional
+    # update, so a job runs exactly once and any worker can report on it.
+    #
+    # A worker runs at most max_concurrent_jobs at once and a user at most
+    # max_jobs_per_user (checked per claim, so only approximately across
+    # workers). Job kernels are created like notebook kernels, under the
+    # user's CPU and memory limits, and count towards them together with
+    # the user's notebooks.
+    #
+    # Cell outputs go into the notebook as the cells finish; the executed
+    # notebook is written to output_path through the NotebookStore every
+    # checkpoint_interval_seconds and when the job ends, however it ends.
+    def __init__(self, manager: 'JupyterManager', config: JobsConfig):
+        self.manager = manager
+        self.config = config
+        self.running: Dict[int, RunningJob] = {}
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        manager.cluster.register('cancel_job', lambda payload: self._cancel_local(payload['job_id']))
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        tasks = [running.task for running in self.running.values() if running.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def submit(
+        self, user_id: int, notebook_path: str, output_path: Optional[str] = None, stop_on_error: bool = True
+    ) -> NotebookJob:
+        # Raises NotebookPatchError for a path outside the user's directory
+        # and FileNotFoundError for a notebook that does not exist
+        source = self.manager.notebooks.resolve(user_id, notebook_path)
+        output_path = output_path or default_output_path(notebook_path)
+        self.manager.notebooks.resolve(user_id, output_path)
+        if not source.is_file():
+            raise FileNotFoundError(notebook_path)
+
+        async with AsyncSessionLocal() as db:
+            job = NotebookJob(
+                user_id=user_id,
+                notebook_path=notebook_path,
+                output_path=output_path,
+                stop_on_error=stop_on_error
+            )
+            db.add(job)
+            await db.commit()
+        logger.info(f"Job {job.id} queued: user {user_id}, notebook {notebook_path}")
+        self._wake.set()
+        return job
+
+    async def get(self, user_id: int, job_id: int) -> Optional[NotebookJob]:
+        async with AsyncSessionLocal() as db:
+            job = await db.get(NotebookJob, job_id)
+        if job is None or job.user_id != user_id:
+            return None
+        return job
+
+    async def list(self, user_id: int, limit: int = 100) -> List[NotebookJob]:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(NotebookJob)
+                .where(NotebookJob.user_id == user_id)
+                .order_by(NotebookJob.id.desc())
+                .limit(limit)
+            )
+            return list(result.scalars())
+
+    async def cancel(self, user_id: int, job_id: int) -> Optional[NotebookJob]:
+        job = await self.get(user_id, job_id)
+        if job is None or job.status in FINISHED:
+            return job
+
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                update(NotebookJob)
+                .where(NotebookJob.id == job_id, NotebookJob.status == 'queued')
+                .values(status='cancelled', finished_at=datetime.utcnow())
+            )
+            await db.commit()
+        if result.rowcount == 1:
+            self.cancelled += 1
+            logger.info(f"Job {job_id} cancelled before it started")
+        elif job_id in self.running:
+            task = self.running[job_id].task
+            await self._cancel_local(job_id)
+            # Long enough for the kernel to go and the output to be written
+            await asyncio.wait({task}, timeout=10)
+        else:
+            # Running on another server worker
+            await self.manager.cluster.broadcast('cancel_job', {'job_id': job_id})
+        return await self.get(user_id, job_id)
+
+    def kernels(self) -> List[ManagedKernel]:
+        return [running.kernel for running in self.running.values() if running.kernel is not None]
+
+    def stats(self) -> dict:
+        return {
+            'running': len(self.running),
+            'max_concurrent_jobs': self.config.max_concurrent_jobs,
+            'completed': self.completed,
+            'failed': self.failed,
+            'cancelled': self.cancelled
+        }
+
+    async def _cancel_local(self, job_id: int) -> bool:
+        running = self.running.get(job_id)
+        if running is None or running.task is None:
+            return False
+        running.cancel_requested = True
+        running.task.cancel()
+        return True
+
+    async def _loop(self):
+        while True:
+            try:
+                await self._fail_orphans()
+                while len(self.running) < self.config.max_concurrent_jobs:
+                    job = await self._claim()
+                    if job is None:
+                        break
+                    running = RunningJob(job.id, job.user_id)
+                    self.running[job.id] = running
+                    running.task = asyncio.create_task(self._run(job, running))
+            except Exception as e:
+                logger.error(f"Failed to start queued jobs: {e}", exc_info=True)
+
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.config.poll_interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+    async def _claim(self) -> Optional[NotebookJob]:
+        # Oldest queued job of a user below max_jobs_per_user
+        async with AsyncSessionLocal() as db:
+            busy_users = (
+                select(NotebookJob.user_id)
+                .where(NotebookJob.status == 'running')
+                .group_by(NotebookJob.user_id)
+                .having(func.count() >= self.config.max_jobs_per_user)
+            )
+            candidates = (await db.execute(
+                select(NotebookJob)
+                .where(NotebookJob.status == 'queued', NotebookJob.user_id.not_in(busy_users))
+                .order_by(NotebookJob.id)
+                .limit(10)
+            )).scalars().all()
+            for job in candidates:
+                result = await db.execute(
+                    update(NotebookJob)
+                    .where(NotebookJob.id == job.id, NotebookJob.status == 'queued')
+                    .values(status='running', worker_id=self.manager.cluster.worker_id, started_at=datetime.utcnow())
+                )
+                await db.commit()
+                if result.rowcount == 1:
+                    job.status = 'running'
+                    return job
+        return None
+
+    async def _fail_orphans(self):
+        # Jobs marked running by a server worker that is gone; their kernels
+        # went with it
+        alive = [self.manager.cluster.worker_id]
+        if self.manager.cluster.enabled:
+            alive += await self.manager.cluster.registry.alive_workers()
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                update(NotebookJob)
+                .where(NotebookJob.status == 'running', NotebookJob.worker_id.not_in(alive))
+                .values(status='failed', error='The server stopped while the job was running', finished_at=datetime.utcnow())
+            )
+            await db.commit()
+        if result.rowcount:
+            logger.warning(f"Marked {result.rowcount} jobs of stopped server workers as failed")
+
+    async def _run(self, job: NotebookJob, running: RunningJob):
+        logger.info(f"Job {job.id} started: user {job.user_id}, notebook {job.notebook_path}")
+        execution = _JobExecution(self, job)
+        status, error = 'completed', None
+        try:
+            if self.config.max_runtime_seconds is None:
+                error = await execution.run(running)
+            else:
+                error = await asyncio.wait_for(execution.run(running), timeout=self.config.max_runtime_seconds)
+            if error is not None:
+                status = 'failed'
+        except asyncio.CancelledError:
+            if running.cancel_requested:
+                status, error = 'cancelled', None
+            else:
+                status, error = 'failed', 'The server stopped while the job was running'
+        except asyncio.TimeoutError:
+            status, error = 'failed', f'Exceeded the maximum run time of {self.config.max_runtime_seconds}s'
+        except Exception as e:
+            logger.error(f"Job {job.id} failed: {e}", exc_info=True)
+            status, error = 'failed', str(e)
+        finally:
+            self.running.pop(job.id, None)
+            if running.kernel is not None:
+                await self.manager.release_user_kernel(running.kernel)
+
+        # Whatever ran is kept, also for failed and cancelled jobs
+        try:
+            await execution.checkpoint()
+        except Exception as e:
+            logger.error(f"Failed to write the output of job {job.id}: {e}", exc_info=True)
+            if status == 'completed':
+                status, error = 'failed', f'Failed to write the output: {e}'
+        await self._finish(job.id, status, error, execution.cells_done)
+        logger.info(f"Job {job.id} {status}")
+        self._wake.set()
+
+    async def _finish(self, job_id: int, status: str, error: Optional[str], cells_done: int):
+        if status == 'completed':
+            self.completed += 1
+        elif status == 'failed':
+            self.failed += 1
+        else:
+            self.cancelled += 1
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(NotebookJob)
+                .where(NotebookJob.id == job_id)
+                .values(status=status, error=error, cells_done=cells_done, finished_at=datetime.utcnow())
+            )
+            await db.commit()
+
+    async def _progress(self, job_id: int, **values):
+        async with AsyncSessionLocal() as db:
+            await db.execute(update(NotebookJob).where(NotebookJob.id == job_id).values(**values))
+            await db.commit()
+
+class _JobExecution:
+    # One run of one job: the notebook being filled in and its progress
+    def __init__(self, runner: NotebookJobRunner, job: NotebookJob):
+        self.runner = runner
+        self.job = job
+        self.cells: List[nbformat.NotebookNode] = []
+        self.metadata: Optional[dict] = None
+        self.positions: Dict[str, int] = {}
+        self.outputs: Dict[str, List[dict]] = {}
+        self.output_bytes: Dict[str, int] = {}
+        self.cells_done = 0
+        self.last_checkpoint = time.monotonic()
+
+    async def run(self, running: RunningJob) -> Optional[str]:
+        # Error message for a notebook that stopped at a failing cell
+        manager = self.runner.manager
+        user_id = self.job.user_id
+        if not manager.notebooks.resolve(user_id, self.job.notebook_path).is_file():
+            raise NotebookPatchError(f"Notebook not found: {self.job.notebook_path}")
+        source = await manager.notebooks.open(user_id, self.job.notebook_path)
+        self.metadata = dict(source.notebook.metadata)
+
+        # Cells are never modified in place, a finished cell replaces its
+        # node. Earlier outputs do not belong to this run.
+        timeout_seconds = await manager.cell_timeout(user_id)
+        cells = []
+        for position, cell in enumerate(source.notebook.cells):
+            if cell.cell_type == 'code':
+                cell = nbformat.v4.new_code_cell(source=cell.source, id=cell.get('id'), metadata=cell.metadata)
+                if cell.source.strip():
+                    self.positions[cell.id] = position
+                    cells.append({'cell_id': cell.id, 'code': cell.source, 'timeout_seconds': timeout_seconds})
+            self.cells.append(cell)
+        await self.runner._progress(self.job.id, cells_total=len(cells))
+
+        running.kernel, node, _ = await manager.create_user_kernel(user_id)
+        running.kernel.key = f'job:{self.job.id}'
+        running.kernel.notebook_path = self.job.notebook_path
+        logger.info(f"Job {self.job.id} running {len(cells)} cells on {node.name}")
+
+        results = await manager.run_cells(
+            running.kernel,
+            cells,
+            stop_on_error=self.job.stop_on_error,
+            on_output=self._on_output,
+            on_cell_done=self._on_cell_done,
+            spill=False
+        )
+        for result in results:
+            if result['status'] in ('crashed', 'timeout'):
+                return result['error']
+            if result['status'] == 'error' and self.job.stop_on_error:
+                lines = ANSI_ESCAPE.sub('', result['error'] or '').strip().splitlines()
+                return f"Cell {result['cell_id']} failed: {lines[-1] if lines else 'error'}"
+        return None
+
+    async def checkpoint(self):
+        if not self.cells:
+            return
+        await self.runner.manager.notebooks.replace_cells(
+            self.job.user_id, self.job.output_path, list(self.cells), self.metadata
+        )
+        self.last_checkpoint = time.monotonic()
+
+    async def _on_output(self, cell_id: str, item: dict):
+        outputs = self.outputs.setdefault(cell_id, [])
+        if item['output_type'] == 'update_display_data':
+            for n, output in enumerate(outputs):
+                if output.get('display_id') == item.get('display_id'):
+                    outputs[n] = dict(output, data=item['data'], metadata=item['metadata'])
+            return
+
+        size = output_size(item)
+        used = self.output_bytes.get(cell_id, 0)
+        limit = self.runner.config.max_cell_output_bytes
+        if used + size > limit:
+            if used <= limit:
+                outputs.append({'output_type': 'stream', 'name': 'stderr', 'text': '\n[Output truncated]\n'})
+            self.output_bytes[cell_id] = limit + 1
+            return
+        self.output_bytes[cell_id] = used + size
+        outputs.append(item)
+
+    async def _on_cell_done(self, result: dict):
+        cell_id = result['cell_id']
+        position = self.positions[cell_id]
+        outputs = self.outputs.pop(cell_id, [])
+        if result['error']:
+            # Like the client, which keeps only the joined traceback
+            outputs.append({'output_type': 'error', 'ename': '', 'evalue': '', 'traceback': result['error'].split('\n')})
+        old = self.cells[position]
+        self.cells[position] = nbformat.v4.new_code_cell(
+            source=old.source,
+            id=old.id,
+            metadata=old.metadata,
+            execution_count=result['execution_count'],
+            outputs=[to_nbformat_output(output) for output in outputs]
+        )
+        if result['status'] != 'aborted':
+            self.cells_done += 1
+
+        if time.monotonic() - self.last_checkpoint >= self.runner.config.checkpoint_interval_seconds:
+            await self.checkpoint()
+            await self.runner._progress(self.job.id, cells_done=self.cells_done)
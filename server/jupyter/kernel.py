@@ -0,0 +1,179 @@
+import asyncio
+import time
+import logging
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+from jupyter_client import AsyncKernelManager
+from jupyter_client.asynchronous import AsyncKernelClient
+from resources.isolation import KernelIsolator
+import metrics
+
+if TYPE_CHECKING:
+    from jupyter.placement import RemoteKernelManager
+
+logger = logging.getLogger(__name__)
+
+class IsolatedKernelManager(AsyncKernelManager):
+    # Launches the kernel through the cgroup launcher when cgroups are available
+    isolator: Optional[KernelIsolator] = None
+
+    def format_kernel_cmd(self, extra_arguments: Optional[List[str]] = None) -> List[str]:
+        cmd = super().format_kernel_cmd(extra_arguments)
+        if self.isolator is None:
+            return cmd
+        return self.isolator.wrap_command(self.kernel_id, cmd)
+
+class CellExecution:
+    # The cell a kernel is working on, while its messages are collected.
+    # stop_reason is set by whoever stops it (interrupted or timeout), and
+    # restarted once stopping it took a kernel restart.
+    def __init__(self, cell_id: str, msg_id: str):
+        self.cell_id = cell_id
+        self.msg_id = msg_id
+        self.started = time.monotonic()
+        self.stop_reason: Optional[str] = None
+        self.restarted = False
+        self.done = asyncio.Event()
+
+class ManagedKernel:
+    # A kernel together with one long-lived client. A single reader task
+    # drains iopub and routes each message to the execution that caused it
+    # (parent_header.msg_id), so cells never share or lose messages.
+    def __init__(self, km: 'AsyncKernelManager | RemoteKernelManager'):
+        self.km = km
+        self.client: Optional[AsyncKernelClient] = None
+        # Set when the kernel is handed to a user_id:notebook_path key
+        self.key: Optional[str] = None
+        self.user_id: Optional[str] = None
+        self.notebook_path: Optional[str] = None
+        self.session_id: Optional[int] = None
+        self.last_activity = time.monotonic()
+        self.current: Optional[CellExecution] = None
+        self.restarts = 0
+        # Cleared while the kernel restarts
+        self.ready = asyncio.Event()
+        self.ready.set()
+        self._listeners: Dict[str, asyncio.Queue] = {}
+        self._reader: Optional[asyncio.Task] = None
+
+    @property
+    def kernel_id(self) -> str:
+        return self.km.kernel_id
+
+    async def start_channels(self, timeout: float = 60):
+        self.client = self.km.client()
+        self.client.start_channels()
+        try:
+            await self.client.wait_for_ready(timeout=timeout)
+        except Exception:
+            # A kernel that is still there did not answer in time
+            if await self.km.is_alive():
+                metrics.KERNEL_TIMEOUTS.labels('start').inc()
+            else:
+                metrics.KERNEL_CRASHES.labels('start').inc()
+            raise
+        self._reader = asyncio.create_task(self._read_iopub())
+
+    @property
+    def pid(self) -> Optional[int]:
+        return getattr(self.km.provisioner, 'pid', None)
+
+    @property
+    def worker(self) -> Optional[str]:
+        # Name of the worker agent running the kernel, None on the server host
+        return getattr(self.km, 'worker_name', None)
+
+    @property
+    def busy(self) -> bool:
+        return bool(self._listeners)
+
+    def touch(self):
+        self.last_activity = time.monotonic()
+
+    async def is_alive(self) -> bool:
+        return await self.km.is_alive()
+
+    def execute(self, code: str, silent: bool = False, stop_on_error: bool = True) -> Tuple[str, asyncio.Queue]:
+        # execute() only queues the request on the shell socket, the listener
+        # is registered before the reader task can see any reply. With
+        # stop_on_error, requests queued behind one that fails are aborted
+        # by the kernel.
+        msg_id = self.client.execute(code, silent=silent, store_history=not silent, stop_on_error=stop_on_error)
+        queue: asyncio.Queue = asyncio.Queue()
+        self._listeners[msg_id] = queue
+        self.touch()
+        return msg_id, queue
+
+    async def run_silent(self, code: str, timeout: float) -> str:
+        # Runs code outside the history and execution count (for helpers
+        # around a cell) and returns what it printed
+        msg_id, messages = self.execute(code, silent=True)
+        text = []
+        try:
+            while True:
+                msg = await asyncio.wait_for(messages.get(), timeout=timeout)
+                if msg is None:
+                    raise RuntimeError('The kernel stopped while running the code')
+                msg_type = msg['header']['msg_type']
+                if msg_type == 'stream':
+                    text.append(msg['content']['text'])
+                elif msg_type == 'status' and msg['content']['execution_state'] == 'idle':
+                    return ''.join(text)
+        finally:
+            self.discard(msg_id)
+
+    def discard(self, msg_id: str):
+        self._listeners.pop(msg_id, None)
+
+    async def restart(self, timeout: float = 60):
+        # Replaces the kernel process, its state is lost. Executions still
+        # waiting for messages get None, they will not see any more.
+        self.ready.clear()
+        try:
+            await self._stop_channels()
+            await self.km.restart_kernel(now=True)
+            self.restarts += 1
+            await self.start_channels(timeout)
+        finally:
+            self.ready.set()
+
+    async def shutdown(self):
+        await self._stop_channels()
+        await self.km.shutdown_kernel(now=True)
+
+    async def _stop_channels(self):
+        if self._reader is not None:
+            self._reader.cancel()
+            try:
+                await self._reader
+            except asyncio.CancelledError:
+                pass
+            self._reader = None
+
+        if self.client is not None:
+            self.client.stop_channels()
+        for queue in self._listeners.values():
+            queue.put_nowait(None)
+        self._listeners.clear()
+
+    async def _read_iopub(self):
+        while True:
+            try:
+                msg = await self.client.get_iopub_msg()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if not self.client.channels_running:
+                    break
+                logger.warning(f"Failed to read iopub message from kernel {self.kernel_id}: {e}")
+                continue
+
+            metrics.count_iopub(msg['header']['msg_type'])
+            parent_id = msg['parent_header'].get('msg_id')
+            queue = self._listeners.get(parent_id)
+            if queue is None:
+                continue
+
+            self.touch()
+            queue.put_nowait(msg)
+            if msg['header']['msg_type'] == 'status' and msg['content']['execution_state'] == 'idle':
+                self._listeners.pop(parent_id, None)
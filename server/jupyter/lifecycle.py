@@ -0,0 +1,82 @@
+import asyncio
+import time
+import logging
+from typing import TYPE_CHECKING, Optional
+import psutil
+from config import KernelLifecycleConfig
+
+if TYPE_CHECKING:
+    from jupyter.manager import JupyterManager
+
+logger = logging.getLogger(__name__)
+
+class KernelLifecycleManager:
+    # Reclaims kernels that nobody uses any more. Kernels idle for longer
+    # than idle_timeout_seconds are culled; when host memory crosses the
+    # high-water mark, idle kernels are evicted least recently used first
+    # until memory drops under the low-water mark. Busy kernels are never
+    # touched.
+    def __init__(self, manager: 'JupyterManager', config: KernelLifecycleConfig):
+        self.manager = manager
+        self.config = config
+        self.culled = 0
+        self.evicted = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.config.check_interval_seconds)
+            try:
+                await self.check()
+            except Exception as e:
+                logger.error(f"Kernel lifecycle check failed: {e}", exc_info=True)
+
+    async def check(self):
+        await self.cull_idle()
+        await self.relieve_memory_pressure()
+
+    async def cull_idle(self):
+        now = time.monotonic()
+        for key, kernel in list(self.manager.kernels.items()):
+            if kernel.busy or now - kernel.last_activity < self.config.idle_timeout_seconds:
+                continue
+            logger.info(f"Culling kernel {key}, idle for {now - kernel.last_activity:.0f}s")
+            await self.manager.remove_kernel(key)
+            self.culled += 1
+
+    async def relieve_memory_pressure(self):
+        memory_percent = psutil.virtual_memory().percent
+        if memory_percent < self.config.memory_high_water_percent:
+            return
+
+        logger.warning(f"Host memory at {memory_percent}%, evicting least recently used kernels")
+        candidates = sorted(
+            (kernel for kernel in self.manager.kernels.values() if not kernel.busy),
+            key=lambda kernel: kernel.last_activity
+        )
+        for kernel in candidates:
+            logger.info(f"Evicting kernel {kernel.key} under memory pressure")
+            await self.manager.remove_kernel(kernel.key)
+            self.evicted += 1
+            if psutil.virtual_memory().percent < self.config.memory_low_water_percent:
+                break
+
+    def stats(self) -> dict:
+        return {
+            'kernels': len(self.manager.kernels),
+            'culled': self.culled,
+            'evicted': self.evicted
+        }
@@ -1,155 +1,686 @@
 import os
 import json
+import math
+import time
+import asyncio
 import logging
+from datetime import datetime
 from pathlib import Path
-from typing import Dict, Optional
-from jupyter_client import KernelManager
-import nbformat
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
 from config import settings
-from database import SessionLocal, Session as DBSession, User
+from sqlalchemy import update
+from database import AsyncSessionLocal, Session as DBSession
+from cache import user_cache
+from jupyter.pool import KernelPool
+from jupyter.kernel import CellExecution, ManagedKernel, IsolatedKernelManager
+from resources.isolation import KernelIsolator
+from resources.sampler import UsageSampler
+from resources.system import SystemSampler
+from resources.storage import StorageAccountant
+from jupyter.lifecycle import KernelLifecycleManager
+from jupyter.spill import CellSpill, OutputSpillStore
+from jupyter.replay import ReplayStore
+from jupyter.notebooks import NotebookStore, NotebookPatchError
+from jupyter.notebook_index import NotebookIndex
+from jupyter.placement import KernelPlacement, WorkerNode, LOCAL_NODE
+from jupyter.jobs import NotebookJobRunner
+from jupyter import profiler
+from cluster.node import ClusterNode
+from api.streaming import output_size
+import metrics
+from tracing import tracer
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_KERNEL_NAME = 'python3'
+
+# A cell that has been quiet this long is checked on: is the kernel still there
+QUIET_SECONDS = 30
+
 class JupyterManager:
     def __init__(self):
-        self.kernels: Dict[str, KernelManager] = {}
-        self.user_sessions: Dict[int, list] = {}
+        self.kernels: Dict[str, ManagedKernel] = {}
+        self._kernel_locks: Dict[str, asyncio.Lock] = {}
+        # stop_cell calls for cells past their deadline
+        self._stopping: Set[asyncio.Task] = set()
+        self.isolator = KernelIsolator(settings.isolation)
+        self.placement = KernelPlacement(settings.placement)
+        self.sampler = UsageSampler(self, settings.usage_sampler)
+        self.storage = StorageAccountant(settings.storage_accounting)
+        self.spill = OutputSpillStore(settings.output_spill)
+        self.replay = ReplayStore(settings.replay)
+        self.notebook_index = NotebookIndex(settings.notebook_index)
+        self.notebooks = NotebookStore(self.storage, self.notebook_index, settings.notebook_saves)
+        self.pool = KernelPool(
+            settings.kernel_pool,
+            start_kernel=self._start_kernel,
+            shutdown_kernel=self._shutdown_kernel,
+            is_alive=lambda kernel: kernel.is_alive()
+        )
+        self.lifecycle = KernelLifecycleManager(self, settings.kernel_lifecycle)
+        self.cluster = ClusterNode(settings.cluster, settings.server.secret_key, owns=lambda key: key in self.kernels)
+        self.cluster.register('remove_kernel', lambda payload: self.remove_kernel(payload['key'], payload.get('session_id')))
+        self.cluster.register('apply_user_limits', lambda payload: self._apply_local_limits(**payload))
+        self.cluster.register('interrupt', lambda payload: self.interrupt(payload['key'], restart=payload['restart']))
+        self.jobs = NotebookJobRunner(self, settings.jobs)
+        self.system = SystemSampler(self, settings.system_sampler)
         
         # Create notebooks directory
         Path(settings.storage.notebooks_path).mkdir(parents=True, exist_ok=True)
         logger.info(f"Jupyter Manager initialized. Notebooks path: {settings.storage.notebooks_path}")
     
-    def get_user_notebook_path(self, user_id: int, notebook_name: str) -> Path:
-        user_dir = Path(settings.storage.notebooks_path) / str(user_id)
-        user_dir.mkdir(parents=True, exist_ok=True)
-        return user_dir / notebook_name
+    async def start(self):
+        await self.cluster.start()
+        self.spill.start(clear=not self.cluster.enabled)
+        await self.placement.start()
+        await self.pool.start()
+        await self.lifecycle.start()
+        await self.sampler.start()
+        await self.system.start()
+        await self.storage.start()
+        await self.jobs.start()
+    
+    async def shutdown(self):
+        await self.jobs.stop()
+        await self.notebooks.close()
+        await self.storage.stop()
+        await self.system.stop()
+        await self.sampler.stop()
+        await self.lifecycle.stop()
+        await self.pool.stop()
+        # Their kernels are about to go anyway
+        for task in self._stopping:
+            task.cancel()
+        await asyncio.gather(*self._stopping, return_exceptions=True)
+        keys = list(self.kernels)
+        await asyncio.gather(*(self.remove_kernel(key) for key in keys), return_exceptions=True)
+        await self.placement.stop()
+        await self.cluster.stop()
+        logger.info(f"Jupyter Manager shut down, {len(keys)} kernels stopped")
     
-    async def get_or_create_kernel(self, user_id: int, notebook_path: str) -> KernelManager:
-        key = f"{user_id}:{notebook_path}"
+    async def _start_kernel(self, kernel_name: str) -> ManagedKernel:
+        km = IsolatedKernelManager(kernel_name=kernel_name)
+        km.isolator = self.isolator
+        try:
+            await km.start_kernel()
+        except Exception as e:
+            logger.warning(f"Failed to start {kernel_name} kernel, trying default: {e}")
+            # Fallback to default kernel
+            km = IsolatedKernelManager()
+            km.isolator = self.isolator
+            await km.start_kernel()
         
-        if key not in self.kernels:
-            logger.info(f"Creating new kernel for user {user_id}, notebook {notebook_path}")
-            km = KernelManager(kernel_name='python3')
-            try:
-                km.start_kernel()
-            except Exception as e:
-                logger.warning(f"Failed to start python3 kernel, trying default: {e}")
-                # Fallback to default kernel
-                km = KernelManager()
-                km.start_kernel()
-            self.kernels[key] = km
-            logger.info(f"Kernel started: {key}")
-            
-            # Create session in database
-            db = SessionLocal()
-            try:
-                session = DBSession(
-                    user_id=user_id,
-                    notebook_path=notebook_path,
-                    kernel_id=key
-                )
-                db.add(session)
-                db.commit()
+        kernel = ManagedKernel(km)
+        try:
+            await kernel.start_channels()
+        except Exception:
+            await km.shutdown_kernel(now=True)
+            raise
+        return kernel
+    
+    async def _start_remote_kernel(
+        self, node: WorkerNode, kernel_name: str, user_id: int, cpu_percent: int, memory_mb: int
+    ) -> ManagedKernel:
+        # The agent applies the user's limits on its own host
+        km = await self.placement.start_kernel(node, kernel_name, str(user_id), cpu_percent, memory_mb)
+        kernel = ManagedKernel(km)
+        try:
+            await kernel.start_channels()
+        except Exception:
+            await km.shutdown_kernel(now=True)
+            raise
+        return kernel
+    
+    async def _shutdown_kernel(self, kernel: ManagedKernel):
+        try:
+            await kernel.shutdown()
+        except Exception as e:
+            logger.warning(f"Failed to shut down kernel: {e}")
+        if kernel.worker is None:
+            self.isolator.release(kernel.kernel_id)
+    
+    async def create_user_kernel(self, user_id: int) -> Tuple[ManagedKernel, WorkerNode, str]:
+        # A kernel under the user's limits on the node placement picks, and
+        # where it came from (pool, fresh or remote)
+        cpu_percent, memory_mb = await self._kernel_limits(user_id)
+        node = self.placement.choose(cpu_percent, memory_mb)
+        if node.is_local:
+            kernel = await self.pool.acquire(DEFAULT_KERNEL_NAME)
+            source = 'pool'
+            if kernel is None:
+                kernel = await self._start_kernel(DEFAULT_KERNEL_NAME)
+                source = 'fresh'
+            # Put the kernel process under the user's limits
+            self.isolator.assign(kernel.kernel_id, kernel.pid, str(user_id), cpu_percent, memory_mb)
+        else:
+            kernel = await self._start_remote_kernel(
+                node, DEFAULT_KERNEL_NAME, user_id, cpu_percent, memory_mb
+            )
+            source = 'remote'
+        self.placement.placed(node, cpu_percent, memory_mb)
+        kernel.user_id = str(user_id)
+        return kernel, node, source
+    
+    @staticmethod
+    async def _kernel_limits(user_id) -> Tuple[int, int]:
+        limits = await user_cache.get_limits(user_id)
+        cpu_percent = limits.cpu_percent if limits else settings.default_limits.cpu_percent
+        memory_mb = limits.memory_mb if limits else settings.default_limits.memory_mb
+        return cpu_percent, memory_mb
+    
+    async def cell_timeout(self, user_id, requested: Optional[float] = None) -> Optional[float]:
+        # Deadline of a cell: the one asked for, capped by the user's
+        # max_execution_seconds (default_limits unless set per user, 0 there
+        # lifts the limit). None = no deadline. requested comes from the
+        # client, anything but a positive finite number is ignored.
+        try:
+            requested = float(requested) if requested is not None else None
+        except (TypeError, ValueError):
+            requested = None
+        if requested is not None and not (math.isfinite(requested) and requested > 0):
+            requested = None
+        limits = await user_cache.get_limits(user_id)
+        user_max = limits.max_execution_seconds if limits else None
+        if user_max is None:
+            user_max = settings.default_limits.max_execution_seconds
+        timeouts = [t for t in (requested, user_max) if t]
+        return min(timeouts) if timeouts else None
+    
+    async def release_user_kernel(self, kernel: ManagedKernel):
+        # Counterpart of create_user_kernel for kernels that never went into
+        # self.kernels
+        await self._shutdown_kernel(kernel)
+        self.placement.released(kernel.worker or LOCAL_NODE)
+    
+    @staticmethod
+    def kernel_key(user_id: int, notebook_path: str) -> str:
+        return f"{user_id}:{notebook_path}"
+    
+    async def get_or_create_kernel(self, user_id: int, notebook_path: str) -> ManagedKernel:
+        key = self.kernel_key(user_id, notebook_path)
+        
+        if key in self.kernels:
+            return self.kernels[key]
+        
+        lock = self._kernel_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            if key not in self.kernels:
+                logger.info(f"Creating new kernel for user {user_id}, notebook {notebook_path}")
+                started = time.monotonic()
+                kernel, node, source = await self.create_user_kernel(user_id)
+                kernel.key = key
+                kernel.notebook_path = notebook_path
+                kernel.touch()
+                self.kernels[key] = kernel
+                metrics.LIVE_KERNELS.set(len(self.kernels))
+                logger.info(f"Kernel started: {key} on {node.name}")
+                
+                # Create session in database
+                async with AsyncSessionLocal() as db:
+                    session = DBSession(
+                        user_id=int(user_id),
+                        notebook_path=notebook_path,
+                        kernel_id=key
+                    )
+                    db.add(session)
+                    await db.commit()
+                    kernel.session_id = session.id
                 logger.info(f"Session created in database for kernel {key}")
-            finally:
-                db.close()
+                metrics.KERNEL_START_SECONDS.labels(source).observe(time.monotonic() - started)
         
+        self._kernel_locks.pop(key, None)
         return self.kernels[key]
     
-    async def execute_code(self, user_id: int, notebook_path: str, code: str, cell_id: str) -> dict:
+    async def execute_code(
+        self,
+        user_id: int,
+        notebook_path: str,
+        code: str,
+        cell_id: str,
+        on_output: Optional[Callable[[dict], Awaitable[None]]] = None,
+        profile: bool = False,
+        timeout_seconds: Optional[float] = None
+    ) -> dict:
+        # With on_output every output is handed over as soon as it arrives
+        # and the returned result carries no output of its own. With profile
+        # the cell runs under cProfile in the kernel and the result has a
+        # summary of its hottest functions. timeout_seconds asks for a
+        # deadline, see cell_timeout.
         logger.info(f"Executing code for user {user_id}, cell {cell_id}")
-        logger.info(f"Code: {code[:100]}...")  # Log first 100 chars
+        logger.debug(f"Code: {code[:100]}...")  # Log first 100 chars
         
+        spill = None
         try:
-            km = await self.get_or_create_kernel(user_id, notebook_path)
-            kc = km.client()
-            kc.start_channels()
+            with tracer.span('get_or_create_kernel', notebook_path=notebook_path) as span:
+                kernel = await self.get_or_create_kernel(user_id, notebook_path)
+                span.set_attribute('kernel_id', kernel.kernel_id)
+            timeout_seconds = await self.cell_timeout(user_id, timeout_seconds)
+            await kernel.ready.wait()
+            spill = self.spill.open_cell(str(user_id), kernel.session_id)
             
-            # Execute code
-            logger.info("Sending code to kernel...")
-            msg_id = kc.execute(code)
+            if profile:
+                profile = await self._start_profile(kernel)
             
-            # Collect output
-            output = []
-            error = None
+            # Execute code
+            msg_id, messages = kernel.execute(code)
+            result = await self._collect_cell(kernel, cell_id, msg_id, messages, spill, on_output, timeout_seconds)
+            result['profile'] = (
+                await self._stop_profile(kernel) if profile and result['status'] in ('ok', 'error') else None
+            )
+            return result
             
-            logger.info("Waiting for execution results...")
+        except Exception as e:
+            logger.error(f"Error executing code: {e}", exc_info=True)
+            if spill is not None:
+                await spill.finish()
+            return self._failed_cell(cell_id, str(e))
+    
+    async def execute_cells(
+        self,
+        user_id: int,
+        notebook_path: str,
+        cells: List[dict],
+        stop_on_error: bool = True,
+        on_cell_start: Optional[Callable[[str], Awaitable[None]]] = None,
+        on_output: Optional[Callable[[str, dict], Awaitable[None]]] = None,
+        on_cell_done: Optional[Callable[[dict], Awaitable[None]]] = None
+    ) -> List[dict]:
+        # Runs cells ({cell_id, code}) in order in one go. All execute
+        # requests are queued on the kernel's shell channel up front, so the
+        # kernel moves from one cell to the next without waiting for the
+        # server; results are collected in order and handed to on_cell_done
+        # as each cell finishes. With stop_on_error the kernel skips the
+        # cells after the first error, they come back with status 'aborted'.
+        # A cell's timeout_seconds asks for a deadline, see cell_timeout.
+        logger.info(f"Executing {len(cells)} cells for user {user_id}, notebook {notebook_path}")
+        try:
+            with tracer.span('get_or_create_kernel', notebook_path=notebook_path) as span:
+                kernel = await self.get_or_create_kernel(user_id, notebook_path)
+                span.set_attribute('kernel_id', kernel.kernel_id)
+            timed_cells = [
+                dict(cell, timeout_seconds=await self.cell_timeout(user_id, cell.get('timeout_seconds')))
+                for cell in cells
+            ]
+        except Exception as e:
+            logger.error(f"Error executing cells: {e}", exc_info=True)
+            results = [self._failed_cell(cell['cell_id'], str(e)) for cell in cells]
+            if on_cell_done is not None:
+                for result in results:
+                    await on_cell_done(result)
+            return results
+        
+        cells = timed_cells
+        return await self.run_cells(kernel, cells, stop_on_error, on_cell_start, on_output, on_cell_done)
+    
+    async def run_cells(
+        self,
+        kernel: ManagedKernel,
+        cells: List[dict],
+        stop_on_error: bool = True,
+        on_cell_start: Optional[Callable[[str], Awaitable[None]]] = None,
+        on_output: Optional[Callable[[str, dict], Awaitable[None]]] = None,
+        on_cell_done: Optional[Callable[[dict], Awaitable[None]]] = None,
+        spill: bool = True
+    ) -> List[dict]:
+        # execute_cells on a given kernel, each cell's timeout_seconds is
+        # its deadline as it stands. Without spill every output is handed
+        # over whole, for callers that keep the outputs themselves.
+        await kernel.ready.wait()
+        pending = [
+            (cell['cell_id'], cell.get('timeout_seconds'), *kernel.execute(cell['code'], stop_on_error=stop_on_error))
+            for cell in cells
+        ]
+        results = []
+        crashed = False
+        for cell_id, timeout_seconds, msg_id, messages in pending:
+            if crashed:
+                # Whatever was queued died with the kernel
+                kernel.discard(msg_id)
+                result = self._failed_cell(cell_id, None, status='aborted')
+            else:
+                if on_cell_start is not None:
+                    await on_cell_start(cell_id)
+                cell_spill = self.spill.open_cell(kernel.user_id, kernel.session_id) if spill else None
+                cell_output = (lambda item, cell_id=cell_id: on_output(cell_id, item)) if on_output else None
+                try:
+                    result = await self._collect_cell(
+                        kernel, cell_id, msg_id, messages, cell_spill, cell_output, timeout_seconds
+                    )
+                except Exception as e:
+                    logger.error(f"Error executing cell {cell_id}: {e}", exc_info=True)
+                    kernel.discard(msg_id)
+                    if cell_spill is not None:
+                        await cell_spill.finish()
+                    result = self._failed_cell(cell_id, str(e))
+                crashed = result['status'] == 'crashed'
+            results.append(result)
+            if on_cell_done is not None:
+                await on_cell_done(result)
+        return results
+    
+    async def _collect_cell(
+        self,
+        kernel: ManagedKernel,
+        cell_id: str,
+        msg_id: str,
+        messages: asyncio.Queue,
+        spill: Optional[CellSpill],
+        on_output: Optional[Callable[[dict], Awaitable[None]]],
+        timeout_seconds: Optional[float] = None
+    ) -> dict:
+        # Reads one execution's messages until the kernel is idle again. A
+        # cell still running at its deadline is stopped through stop_cell;
+        # it goes on being read until the interrupt (or the restart) ends it.
+        started = time.monotonic()
+        started_ns = time.time_ns()
+        execution = kernel.current = CellExecution(cell_id, msg_id)
+        deadline = started + timeout_seconds if timeout_seconds else None
+        outputs = []
+        output_bytes = 0
+        error = None
+        execution_count = None
+        status = 'ok'
+        
+        try:
             while True:
+                wait = QUIET_SECONDS
+                if deadline is not None and execution.stop_reason is None:
+                    wait = min(wait, max(deadline - time.monotonic(), 0))
                 try:
-                    msg = kc.get_iopub_msg(timeout=30)
+                    msg = await asyncio.wait_for(messages.get(), timeout=wait)
+                    if msg is None:
+                        # The kernel was restarted or shut down under the cell;
+                        # one that never started was skipped
+                        if execution_count is None:
+                            status = 'aborted'
+                        else:
+                            status = 'crashed'
+                            error = 'The kernel stopped while executing the cell'
+                        break
                     msg_type = msg['header']['msg_type']
                     content = msg['content']
                     
-                    logger.info(f"Received message type: {msg_type}")
+                    logger.debug(f"Received message type: {msg_type}")
                     
+                    item = None
                     if msg_type == 'stream':
-                        output.append(content['text'])
-                        logger.info(f"Stream output: {content['text']}")
-                    elif msg_type == 'execute_result':
-                        data = content.get('data', {})
-                        if 'text/plain' in data:
-                            output.append(data['text/plain'])
-                            logger.info(f"Execute result: {data['text/plain']}")
-                    elif msg_type == 'display_data':
-                        data = content.get('data', {})
-                        if 'text/plain' in data:
-                            output.append(data['text/plain'])
+                        item = {'output_type': 'stream', 'name': content['name'], 'text': content['text']}
+                    elif msg_type in ('execute_result', 'display_data', 'update_display_data'):
+                        # Full MIME bundle; display_id lets update_display_data
+                        # replace an earlier output in place
+                        item = {
+                            'output_type': msg_type,
+                            'data': content.get('data', {}),
+                            'metadata': content.get('metadata', {})
+                        }
+                        display_id = content.get('transient', {}).get('display_id')
+                        if display_id:
+                            item['display_id'] = display_id
+                        if msg_type == 'execute_result':
+                            item['execution_count'] = content.get('execution_count')
+                    elif msg_type == 'execute_input':
+                        execution_count = content.get('execution_count')
                     elif msg_type == 'error':
                         error = '\n'.join(content['traceback'])
+                        status = 'error'
                         logger.error(f"Execution error: {error}")
                     elif msg_type == 'status' and content['execution_state'] == 'idle':
-                        logger.info("Execution completed")
+                        # A request the kernel skipped after an earlier error
+                        # never gets as far as execute_input
+                        if execution_count is None and status == 'ok':
+                            status = 'aborted'
                         break
-                except Exception as e:
-                    logger.warning(f"Timeout or error waiting for message: {e}")
+                    
+                    if item is not None:
+                        output_bytes += output_size(item)
+                        # Past the spill threshold stream text goes to disk
+                        if spill is not None:
+                            item = await spill.feed(item)
+                    if item is not None:
+                        if on_output is not None:
+                            await on_output(item)
+                        else:
+                            outputs.append(item)
+                except asyncio.TimeoutError:
+                    if deadline is not None and execution.stop_reason is None and time.monotonic() >= deadline:
+                        logger.warning(f"Cell {cell_id} exceeded its deadline of {timeout_seconds:g}s, interrupting")
+                        metrics.KERNEL_TIMEOUTS.labels('execute').inc()
+                        task = asyncio.create_task(self.stop_cell(kernel, execution, 'timeout'))
+                        self._stopping.add(task)
+                        task.add_done_callback(self._stopping.discard)
+                        continue
+                    # A quiet cell is not a finished cell, keep listening
+                    # as long as the kernel is still there
+                    if await kernel.is_alive():
+                        logger.info(f"Cell {cell_id} is still running, waiting for more output")
+                        continue
+                    logger.warning(f"Kernel died while executing cell {cell_id}")
+                    kernel.discard(msg_id)
+                    error = 'Kernel died while executing the cell'
+                    status = 'crashed'
+                    metrics.KERNEL_CRASHES.labels('execute').inc()
                     break
             
-            kc.stop_channels()
-            
-            result = {
-                'cell_id': cell_id,
-                'output': '\n'.join(output) if output else '',
-                'error': error
-            }
-            logger.info(f"Execution result: {result}")
-            return result
-            
+            if execution.stop_reason is not None and (status != 'ok' or execution.restarted):
+                status = execution.stop_reason
+                error = self._stop_message(execution, timeout_seconds)
+                if execution.restarted:
+                    # The next cell must not go to the kernel before it is back
+                    await kernel.ready.wait()
+        finally:
+            if kernel.current is execution:
+                kernel.current = None
+            execution.done.set()
+        
+        if status != 'aborted':
+            metrics.EXECUTION_SECONDS.labels(status).observe(time.monotonic() - started)
+            metrics.OUTPUT_BYTES.observe(output_bytes)
+            tracer.record(
+                'execute_code', started_ns, time.time_ns(),
+                cell_id=cell_id, status=status, output_bytes=output_bytes
+            )
+        
+        text = [
+            item['text'] if item['output_type'] == 'stream' else item['data']['text/plain']
+            for item in outputs
+            if item['output_type'] == 'stream' or 'text/plain' in item['data']
+        ]
+        result = {
+            'cell_id': cell_id,
+            'status': status,
+            'output': '\n'.join(text) if text else '',
+            'outputs': outputs,
+            'error': error,
+            'execution_count': execution_count,
+            'spill': await spill.finish() if spill is not None else None,
+            'profile': None
+        }
+        logger.info(f"Cell {cell_id} finished, status: {status}, spilled: {result['spill'] is not None}")
+        return result
+    
+    @staticmethod
+    def _stop_message(execution: CellExecution, timeout_seconds: Optional[float]) -> str:
+        if execution.stop_reason == 'timeout':
+            message = f'The cell exceeded its time limit of {timeout_seconds:g}s and was interrupted'
+        else:
+            message = 'The cell was interrupted'
+        if execution.restarted:
+            message += '. It did not stop, so the kernel was restarted and its variables are lost'
+        return message
+    
+    async def stop_cell(
+        self, kernel: ManagedKernel, execution: CellExecution, reason: str, restart: bool = False
+    ) -> str:
+        # Interrupts the running cell (reason: interrupted or timeout). If it
+        # is still running interrupt_grace_seconds later, or right away with
+        # restart, the kernel is restarted. Returns interrupted, restarted or
+        # finished (the cell was over before anything happened).
+        if execution.done.is_set() or kernel.current is not execution:
+            return 'finished'
+        if execution.stop_reason is not None:
+            # Already being stopped
+            await execution.done.wait()
+            return 'restarted' if execution.restarted else 'interrupted'
+        execution.stop_reason = reason
+        
+        outcome = 'interrupted'
+        if not restart:
+            try:
+                await kernel.km.interrupt_kernel()
+            except Exception as e:
+                logger.warning(f"Failed to interrupt kernel {kernel.key}: {e}")
+            try:
+                await asyncio.wait_for(execution.done.wait(), timeout=settings.execution.interrupt_grace_seconds)
+            except asyncio.TimeoutError:
+                outcome = 'restarted'
+        else:
+            outcome = 'restarted'
+        
+        if outcome == 'restarted':
+            logger.warning(f"Cell {execution.cell_id} did not stop, restarting kernel {kernel.key}")
+            execution.restarted = True
+            await self.restart_kernel(kernel)
+        metrics.CELL_INTERRUPTS.labels(reason, outcome).inc()
+        logger.info(f"Cell {execution.cell_id} on kernel {kernel.key}: {reason}, {outcome}")
+        return outcome
+    
+    async def restart_kernel(self, kernel: ManagedKernel):
+        # A kernel that does not come back is removed, the next cell gets a
+        # new one
+        try:
+            await kernel.restart(settings.execution.restart_timeout_seconds)
         except Exception as e:
-            logger.error(f"Error executing code: {e}", exc_info=True)
-            return {
-                'cell_id': cell_id,
-                'output': '',
-                'error': str(e)
-            }
+            logger.error(f"Failed to restart kernel {kernel.key}: {e}", exc_info=True)
+            if self.kernels.get(kernel.key) is kernel:
+                await self.remove_kernel(kernel.key)
+            return
+        if kernel.key is not None:
+            self.sampler.forget(kernel.key)
+        if kernel.worker is None and kernel.user_id is not None:
+            # Restarted kernels are launched in their cgroup already, the
+            # rlimit fallback has to be applied to the new process
+            cpu_percent, memory_mb = await self._kernel_limits(kernel.user_id)
+            self.isolator.assign(kernel.kernel_id, kernel.pid, kernel.user_id, cpu_percent, memory_mb)
+    
+    async def interrupt(self, key: str, cell_id: Optional[str] = None, restart: bool = False) -> Optional[dict]:
+        # Stops the cell running on a kernel owned by this worker, if it is
+        # cell_id (whichever it is without one). None if the kernel is not
+        # here.
+        kernel = self.kernels.get(key)
+        if kernel is None:
+            return None
+        execution = kernel.current
+        if execution is None or (cell_id is not None and execution.cell_id != cell_id):
+            return {'cell_id': cell_id, 'outcome': 'not_running'}
+        outcome = await self.stop_cell(kernel, execution, 'interrupted', restart=restart)
+        return {'cell_id': execution.cell_id, 'outcome': outcome}
+    
+    @staticmethod
+    def _failed_cell(cell_id: str, error: Optional[str], status: str = 'error') -> dict:
+        return {
+            'cell_id': cell_id,
+            'status': status,
+            'output': '',
+            'outputs': [],
+            'error': error,
+            'execution_count': None,
+            'spill': None,
+            'profile': None
+        }
+    
+    async def _start_profile(self, kernel: ManagedKernel) -> bool:
+        try:
+            await kernel.run_silent(profiler.START_CODE, settings.profiling.timeout_seconds)
+            return True
+        except Exception as e:
+            logger.warning(f"Failed to start the profiler in kernel {kernel.key}: {e}")
+            return False
+    
+    async def _stop_profile(self, kernel: ManagedKernel) -> Optional[dict]:
+        try:
+            text = await kernel.run_silent(profiler.stop_code(settings.profiling.top_n), settings.profiling.timeout_seconds)
+        except Exception as e:
+            logger.warning(f"Failed to collect the profile from kernel {kernel.key}: {e}")
+            return None
+        return profiler.parse_summary(text)
     
     async def save_notebook(self, user_id: int, notebook_path: str, content: dict) -> dict:
+        # Full save: replaces the notebook and writes it out right away
         try:
-            file_path = self.get_user_notebook_path(user_id, notebook_path)
-            logger.info(f"Saving notebook to {file_path}")
-            
-            # Create notebook from content
-            nb = nbformat.v4.new_notebook()
-            nb['cells'] = content.get('cells', [])
-            
-            # Save to file
-            with open(file_path, 'w', encoding='utf-8') as f:
-                nbformat.write(nb, f)
-            
-            logger.info(f"Notebook saved successfully: {file_path}")
-            return {'success': True, 'message': 'Notebook saved'}
+            version = await self.notebooks.replace(user_id, notebook_path, content)
+            return {'success': True, 'message': 'Notebook saved', 'version': version}
         except Exception as e:
             logger.error(f"Error saving notebook: {e}", exc_info=True)
             return {'success': False, 'error': str(e)}
     
-    async def cleanup_session(self, sid: str):
-        logger.info(f"Cleaning up session: {sid}")
-        # Stop kernels for this session
-        keys_to_remove = []
-        for key, km in self.kernels.items():
-            if sid in key:
-                km.shutdown_kernel()
-                keys_to_remove.append(key)
+    async def list_notebooks(self, user_id: int) -> list:
+        # From the notebook index, with the state of each notebook's kernel
+        notebooks = []
+        for entry in await self.notebook_index.list(user_id):
+            kernel = self.kernels.get(self.kernel_key(user_id, entry.name))
+            if kernel is None:
+                kernel_state = None
+            else:
+                kernel_state = 'busy' if kernel.busy else 'idle'
+            notebooks.append({**entry.to_dict(), 'kernel_state': kernel_state})
+        return notebooks
+    
+    async def patch_notebook(self, user_id: int, notebook_path: str, ops: list) -> dict:
+        # Cell-level changes, written out after the debounce
+        try:
+            version = await self.notebooks.apply_patch(user_id, notebook_path, ops)
+            return {'success': True, 'version': version}
+        except NotebookPatchError as e:
+            logger.warning(f"Rejected patch for {notebook_path}: {e}")
+            return {'success': False, 'error': str(e)}
+        except Exception as e:
+            logger.error(f"Error patching notebook: {e}", exc_info=True)
+            return {'success': False, 'error': str(e)}
+    
+    async def apply_user_limits(self, user_id: int, cpu_percent: int, memory_mb: int):
+        await self._apply_local_limits(user_id, cpu_percent, memory_mb)
+        await self.placement.update_user_limits(str(user_id), cpu_percent, memory_mb)
+        # Kernels owned by the other server workers
+        await self.cluster.broadcast('apply_user_limits', {
+            'user_id': user_id,
+            'cpu_percent': cpu_percent,
+            'memory_mb': memory_mb
+        })
+    
+    async def _apply_local_limits(self, user_id: int, cpu_percent: int, memory_mb: int):
+        pids = [
+            kernel.pid for kernel in [*self.kernels.values(), *self.jobs.kernels()]
+            if kernel.user_id == str(user_id) and kernel.pid is not None
+        ]
+        self.isolator.update_user_limits(str(user_id), cpu_percent, memory_mb, pids)
+    
+    async def remove_kernel(self, key: str, session_id: Optional[int] = None):
+        # With session_id only the kernel of that session is removed, not a
+        # newer one that has taken over the key
+        kernel = self.kernels.get(key)
+        if kernel is None:
+            # The kernel may belong to another server worker
+            await self.cluster.route(key, 'remove_kernel', {'key': key, 'session_id': session_id}, claim=False)
+            return
+        if session_id is not None and kernel.session_id != session_id:
+            return
+        del self.kernels[key]
+        metrics.LIVE_KERNELS.set(len(self.kernels))
+        self.sampler.forget(key)
+        self.replay.forget(key)
+        self.spill.release_session(kernel.user_id, kernel.session_id)
         
-        for key in keys_to_remove:
-            del self.kernels[key]
-            logger.info(f"Kernel removed: {key}")
+        await self._shutdown_kernel(kernel)
+        self.placement.released(kernel.worker or LOCAL_NODE)
+        await self.cluster.release(key)
+        logger.info(f"Kernel removed: {key}")
+        
+        # Mark the session as ended in database
+        if kernel.session_id is not None:
+            async with AsyncSessionLocal() as db:
+                await db.execute(
+                    update(DBSession)
+                    .where(DBSession.id == kernel.session_id)
+                    .values(is_active=False, ended_at=datetime.utcnow())
+                )
+                await db.commit()
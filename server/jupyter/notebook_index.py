@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import tempfile
+from pathlib import Path
+from typing import Dict, List
+from config import NotebookIndexConfig, settings
+
+logger = logging.getLogger(__name__)
+
+class NotebookEntry:
+    def __init__(self, name: str, size: int, mtime: float, cell_count: int):
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.cell_count = cell_count
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'size': self.size,
+            'mtime': self.mtime,
+            'cell_count': self.cell_count
+        }
+
+class UserIndex:
+    def __init__(self):
+        self.entries: Dict[str, NotebookEntry] = {}
+        self.scanned_at = 0.0
+        self.lock = asyncio.Lock()
+
+class NotebookIndex:
+    # Per-user metadata of the notebooks under notebooks_path/<user_id>, so
+    # listing them does not open every .ipynb. Saves through NotebookStore
+    # update the index directly. Notebooks written some other way (by kernel
+    # code, or copied in) are picked up by a rescan at most every
+    # rescan_interval_seconds; the rescan only stats files and re-reads those
+    # whose size or mtime changed. The index is kept on disk under
+    # <storage.base_path>/notebook_index so a restart does not re-read
+    # everything either.
+    def __init__(self, config: NotebookIndexConfig):
+        self.config = config
+        self.root = Path(settings.storage.notebooks_path)
+        self.index_dir = Path(settings.storage.base_path) / 'notebook_index'
+        self._users: Dict[str, UserIndex] = {}
+
+    async def list(self, user_id: int) -> List[NotebookEntry]:
+        index = await self._index(user_id)
+        return sorted(index.entries.values(), key=lambda entry: entry.name)
+
+    async def update(self, user_id: int, name: str, size: int, mtime: float, cell_count: int):
+        index = await self._index(user_id)
+        index.entries[name] = NotebookEntry(name, size, mtime, cell_count)
+        await asyncio.to_thread(self._persist, str(user_id), list(index.entries.values()))
+
+    async def _index(self, user_id: int) -> UserIndex:
+        key = str(user_id)
+        index = self._users.setdefault(key, UserIndex())
+        if time.monotonic() - index.scanned_at >= self.config.rescan_interval_seconds:
+            async with index.lock:
+                if time.monotonic() - index.scanned_at >= self.config.rescan_interval_seconds:
+                    index.entries = await asyncio.to_thread(self._scan, key, index.entries)
+                    index.scanned_at = time.monotonic()
+                    await asyncio.to_thread(self._persist, key, list(index.entries.values()))
+        return index
+
+    def _scan(self, user_id: str, known: Dict[str, NotebookEntry]) -> Dict[str, NotebookEntry]:
+        if not known:
+            known = self._load(user_id)
+
+        user_dir = self.root / user_id
+        entries: Dict[str, NotebookEntry] = {}
+        reread = 0
+        for path in user_dir.rglob('*.ipynb') if user_dir.exists() else ():
+            name = path.relative_to(user_dir).as_posix()
+            if any(part.startswith('.') for part in path.relative_to(user_dir).parts):
+                continue
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entry = known.get(name)
+            if entry is None or entry.size != stat.st_size or entry.mtime != stat.st_mtime:
+                entry = NotebookEntry(name, stat.st_size, stat.st_mtime, self._count_cells(path))
+                reread += 1
+            entries[name] = entry
+        if reread:
+            logger.info(f"Notebook index for user {user_id}: {len(entries)} notebooks, {reread} re-read")
+        return entries
+
+    def _count_cells(self, path: Path) -> int:
+        try:
+            with open(path, encoding='utf-8') as f:
+                return len(json.load(f).get('cells', []))
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to read notebook {path}: {e}")
+            return 0
+
+    def _load(self, user_id: str) -> Dict[str, NotebookEntry]:
+        path = self.index_dir / f'{user_id}.json'
+        try:
+            with open(path, encoding='utf-8') as f:
+                return {item['name']: NotebookEntry(**item) for item in json.load(f)}
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable notebook index {path}: {e}")
+            return {}
+
+    def _persist(self, user_id: str, entries: List[NotebookEntry]):
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.index_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump([entry.to_dict() for entry in entries], f)
+            os.replace(tmp, self.index_dir / f'{user_id}.json')
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
@@ -0,0 +1,284 @@
+import os
+import time
+import base64
+import asyncio
+import logging
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import nbformat
+from nbformat.corpus.words import generate_corpus_id
+from config import NotebookSaveConfig, settings
+from resources.storage import StorageAccountant
+from jupyter.notebook_index import NotebookIndex
+
+logger = logging.getLogger(__name__)
+
+class NotebookPatchError(Exception):
+    pass
+
+def to_nbformat_output(output: dict) -> nbformat.NotebookNode:
+    # Outputs as the client holds them: binary image payloads come back as
+    # bytes and are stored base64 encoded, transient fields are dropped
+    output_type = output.get('output_type')
+    if output_type in ('display_data', 'execute_result'):
+        data = {
+            mime: base64.b64encode(value).decode('ascii') if isinstance(value, bytes) else value
+            for mime, value in (output.get('data') or {}).items()
+        }
+        if output_type == 'execute_result':
+            return nbformat.v4.new_output(
+                'execute_result',
+                data=data,
+                metadata=output.get('metadata') or {},
+                execution_count=output.get('execution_count')
+            )
+        return nbformat.v4.new_output('display_data', data=data, metadata=output.get('metadata') or {})
+    if output_type == 'error':
+        return nbformat.v4.new_output(
+            'error',
+            ename=output.get('ename', ''),
+            evalue=output.get('evalue', ''),
+            traceback=output.get('traceback', [])
+        )
+    # Streams, and plain {text} outputs from older clients
+    return nbformat.v4.new_output('stream', name=output.get('name', 'stdout'), text=output.get('text', ''))
+
+def to_nbformat_cell(cell: dict) -> nbformat.NotebookNode:
+    cell_type = cell.get('cell_type', 'code')
+    options = {'source': cell.get('source', '')}
+    if cell.get('id'):
+        options['id'] = str(cell['id'])
+    if cell_type == 'markdown':
+        return nbformat.v4.new_markdown_cell(**options)
+    if cell_type == 'raw':
+        return nbformat.v4.new_raw_cell(**options)
+    return nbformat.v4.new_code_cell(
+        execution_count=cell.get('execution_count'),
+        outputs=[to_nbformat_output(output) for output in cell.get('outputs') or []],
+        **options
+    )
+
+class OpenNotebook:
+    def __init__(self, user_id: str, name: str, path: Path, notebook: nbformat.NotebookNode):
+        self.user_id = user_id
+        self.name = name
+        self.path = path
+        self.notebook = notebook
+        self.version = 0
+        self.saved_version = 0
+        self.last_access = time.monotonic()
+        self.flush_task: Optional[asyncio.Task] = None
+        self.flush_lock = asyncio.Lock()
+
+    @property
+    def dirty(self) -> bool:
+        return self.version != self.saved_version
+
+class NotebookStore:
+    # In-memory model of the notebooks being edited. Clients send cell-level
+    # patches (insert/update/delete/move by cell id) that are applied to the
+    # model; changes are written to disk debounce_ms after the last patch,
+    # serialized in a worker thread and written to a temporary file that
+    # replaces the notebook atomically.
+    #
+    # Cells are never modified in place: an update replaces the cell with a
+    # new node, so a flush can serialize a shallow copy of the cell list in
+    # its thread while further patches are applied on the event loop.
+    #
+    # Every write also updates the notebook index with the new size, mtime
+    # and cell count.
+    def __init__(self, storage: StorageAccountant, index: NotebookIndex, config: NotebookSaveConfig):
+        self.storage = storage
+        self.index = index
+        self.config = config
+        self.root = Path(settings.storage.notebooks_path)
+        self._open: Dict[Tuple[str, str], OpenNotebook] = {}
+        self._load_locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+
+    def resolve(self, user_id: int, name: str) -> Path:
+        user_dir = (self.root / str(user_id)).resolve()
+        path = (user_dir / name).resolve()
+        if not name or user_dir not in path.parents:
+            raise NotebookPatchError(f"Invalid notebook path: {name}")
+        return path
+
+    async def current_path(self, user_id: int, name: str) -> Path:
+        # Path of the notebook file with any pending patches written out,
+        # for reading the file directly
+        path = self.resolve(user_id, name)
+        notebook = self._open.get((str(user_id), name))
+        if notebook is not None:
+            await self.flush(notebook)
+        return path
+
+    async def open(self, user_id: int, name: str) -> OpenNotebook:
+        key = (str(user_id), name)
+        notebook = self._open.get(key)
+        if notebook is None:
+            lock = self._load_locks.setdefault(key, asyncio.Lock())
+            async with lock:
+                notebook = self._open.get(key)
+                if notebook is None:
+                    path = self.resolve(user_id, name)
+                    content = await asyncio.to_thread(self._read, path)
+                    notebook = OpenNotebook(str(user_id), name, path, content)
+                    self._open[key] = notebook
+            self._load_locks.pop(key, None)
+        notebook.last_access = time.monotonic()
+        return notebook
+
+    async def apply_patch(self, user_id: int, name: str, ops: List[dict]) -> int:
+        notebook = await self.open(user_id, name)
+        # Validate against a copy of the cell list so a bad op leaves the
+        # model untouched
+        cells = list(notebook.notebook.cells)
+        for op in ops:
+            self._apply(cells, op)
+        notebook.notebook.cells = cells
+        notebook.version += 1
+        self._schedule_flush(notebook)
+        return notebook.version
+
+    async def replace(self, user_id: int, name: str, content: dict) -> int:
+        return await self.replace_cells(user_id, name, [to_nbformat_cell(cell) for cell in content.get('cells', [])])
+
+    async def replace_cells(
+        self, user_id: int, name: str, cells: List[nbformat.NotebookNode], metadata: Optional[dict] = None
+    ) -> int:
+        # The caller hands the cells over and must not modify them afterwards
+        notebook = await self.open(user_id, name)
+        notebook.notebook.cells = cells
+        if metadata is not None:
+            notebook.notebook.metadata = nbformat.from_dict(metadata)
+        notebook.version += 1
+        await self.flush(notebook)
+        return notebook.version
+
+    async def flush(self, notebook: OpenNotebook):
+        # A debounced flush that is still waiting is no longer needed
+        if notebook.flush_task is not None:
+            notebook.flush_task.cancel()
+            notebook.flush_task = None
+
+        async with notebook.flush_lock:
+            if not notebook.dirty:
+                return
+            version = notebook.version
+            snapshot = nbformat.NotebookNode(notebook.notebook)
+            snapshot.cells = list(notebook.notebook.cells)
+            delta, stat = await asyncio.to_thread(self._write, notebook.path, snapshot)
+            notebook.saved_version = version
+            self.storage.record_write(int(notebook.user_id), delta)
+            user_dir = (self.root / notebook.user_id).resolve()
+            await self.index.update(
+                int(notebook.user_id),
+                notebook.path.relative_to(user_dir).as_posix(),
+                stat.st_size,
+                stat.st_mtime,
+                len(snapshot.cells)
+            )
+            logger.info(f"Notebook saved: {notebook.path} (version {version})")
+
+    async def close(self):
+        # Write out everything still pending, used at shutdown
+        for notebook in list(self._open.values()):
+            try:
+                await self.flush(notebook)
+            except Exception as e:
+                logger.error(f"Failed to save notebook {notebook.path}: {e}", exc_info=True)
+
+    def _schedule_flush(self, notebook: OpenNotebook):
+        if notebook.flush_task is not None:
+            notebook.flush_task.cancel()
+        notebook.flush_task = asyncio.create_task(self._flush_later(notebook))
+
+    async def _flush_later(self, notebook: OpenNotebook):
+        await asyncio.sleep(self.config.debounce_ms / 1000)
+        # Past the debounce the task must not be cancelled by a newer patch,
+        # that patch schedules its own flush
+        notebook.flush_task = None
+        try:
+            await self.flush(notebook)
+        except Exception as e:
+            logger.error(f"Failed to save notebook {notebook.path}: {e}", exc_info=True)
+        self._evict_idle()
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        for key, notebook in list(self._open.items()):
+            if (
+                not notebook.dirty
+                and notebook.flush_task is None
+                and now - notebook.last_access > self.config.idle_seconds
+            ):
+                del self._open[key]
+
+    def _apply(self, cells: List[nbformat.NotebookNode], op: dict):
+        kind = op.get('op')
+        if kind == 'insert':
+            cell = to_nbformat_cell(op.get('cell') or {})
+            if any(c.get('id') == cell.get('id') for c in cells):
+                raise NotebookPatchError(f"Duplicate cell id: {cell.get('id')}")
+            index = op.get('index', len(cells))
+            cells.insert(max(0, min(index, len(cells))), cell)
+            return
+
+        index = self._index(cells, op.get('id'))
+        if kind == 'update':
+            cell = nbformat.NotebookNode(cells[index])
+            if 'source' in op:
+                cell.source = op['source']
+            if cell.cell_type == 'code':
+                if 'outputs' in op:
+                    cell.outputs = [to_nbformat_output(output) for output in op['outputs'] or []]
+                if 'execution_count' in op:
+                    cell.execution_count = op['execution_count']
+            cells[index] = cell
+        elif kind == 'delete':
+            del cells[index]
+        elif kind == 'move':
+            cell = cells.pop(index)
+            target = op.get('index', len(cells))
+            cells.insert(max(0, min(target, len(cells))), cell)
+        else:
+            raise NotebookPatchError(f"Unknown patch op: {kind}")
+
+    def _index(self, cells: List[nbformat.NotebookNode], cell_id: Optional[str]) -> int:
+        for index, cell in enumerate(cells):
+            if cell.get('id') == cell_id:
+                return index
+        raise NotebookPatchError(f"Unknown cell id: {cell_id}")
+
+    def _read(self, path: Path) -> nbformat.NotebookNode:
+        if not path.exists():
+            return nbformat.v4.new_notebook()
+        with open(path, encoding='utf-8') as f:
+            notebook = nbformat.read(f, as_version=4)
+        # Patches address cells by id, which notebooks before 4.5 do not have
+        if notebook.nbformat_minor < 5:
+            notebook.nbformat_minor = 5
+            for cell in notebook.cells:
+                cell.setdefault('id', generate_corpus_id())
+        return notebook
+
+    def _write(self, path: Path, notebook: nbformat.NotebookNode) -> Tuple[int, os.stat_result]:
+        # Returns the change in file size for storage accounting and the
+        # stat of the new file for the index
+        path.parent.mkdir(parents=True, exist_ok=True)
+        old_size = path.stat().st_size if path.exists() else 0
+        data = nbformat.writes(notebook).encode('utf-8')
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        return len(data) - old_size, path.stat()
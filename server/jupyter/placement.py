@@ -0,0 +1,264 @@
+import time
+import asyncio
+import logging
+from typing import Dict, List, Optional
+import httpx
+import psutil
+from jupyter_client.asynchronous import AsyncKernelClient
+from config import PlacementConfig
+
+logger = logging.getLogger(__name__)
+
+LOCAL_NODE = 'local'
+
+class WorkerNode:
+    def __init__(self, name: str, url: Optional[str]):
+        self.name = name
+        # None for the server host itself
+        self.url = url.rstrip('/') if url else None
+        self.status: dict = {}
+        self.healthy = False
+        self.last_seen: Optional[float] = None
+        self.kernels = 0
+        # Limits of kernels placed since the last status, which the status
+        # does not reflect yet
+        self.pending_cpu = 0
+        self.pending_memory_mb = 0
+
+    @property
+    def is_local(self) -> bool:
+        return self.url is None
+
+    @property
+    def cpu_capacity(self) -> float:
+        # In psutil units, 100 is one full core
+        return self.status.get('cpu_count', 1) * 100
+
+    @property
+    def free_cpu(self) -> float:
+        used = self.cpu_capacity * self.status.get('cpu_percent', 0.0) / 100
+        return self.cpu_capacity - used - self.pending_cpu
+
+    @property
+    def free_memory_mb(self) -> float:
+        return self.status.get('memory_available_mb', 0.0) - self.pending_memory_mb
+
+    def fits(self, cpu_percent: int, memory_mb: int) -> bool:
+        return self.free_cpu >= cpu_percent and self.free_memory_mb >= memory_mb
+
+    def headroom(self, cpu_percent: int, memory_mb: int) -> float:
+        # Share of the node left free after placing the kernel, CPU and
+        # memory weighted equally
+        memory_total = self.status.get('memory_total_mb') or 1
+        return (
+            (self.free_cpu - cpu_percent) / self.cpu_capacity
+            + (self.free_memory_mb - memory_mb) / memory_total
+        )
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'url': self.url,
+            'healthy': self.healthy,
+            'last_seen': self.last_seen,
+            'kernels': self.kernels,
+            'cpu_count': self.status.get('cpu_count'),
+            'cpu_percent': self.status.get('cpu_percent'),
+            'free_cpu': round(self.free_cpu, 1),
+            'free_memory_mb': round(self.free_memory_mb, 1)
+        }
+
+class RemoteKernelManager:
+    # Stands in for AsyncKernelManager for a kernel running on a worker
+    # agent. The client talks to the kernel's ports directly; starting,
+    # stopping, interrupting and restarting go through the agent.
+    provisioner = None
+
+    def __init__(self, placement: 'KernelPlacement', node: WorkerNode, kernel_id: str, connection_info: dict):
+        self.placement = placement
+        self.node = node
+        self.kernel_id = kernel_id
+        self.connection_info = connection_info
+
+    @property
+    def worker_name(self) -> str:
+        return self.node.name
+
+    def client(self) -> AsyncKernelClient:
+        client = AsyncKernelClient()
+        client.load_connection_info(self.connection_info)
+        return client
+
+    async def is_alive(self) -> bool:
+        try:
+            response = await self.placement.request(self.node, 'GET', f'/kernels/{self.kernel_id}')
+        except httpx.HTTPError:
+            return False
+        return response.status_code == 200 and response.json().get('alive', False)
+
+    async def interrupt_kernel(self):
+        response = await self.placement.request(self.node, 'POST', f'/kernels/{self.kernel_id}/interrupt')
+        response.raise_for_status()
+
+    async def restart_kernel(self, now: bool = False):
+        # The agent puts the new process under the owner's limits again
+        response = await self.placement.request(self.node, 'POST', f'/kernels/{self.kernel_id}/restart')
+        response.raise_for_status()
+        self.connection_info = response.json()['connection_info']
+
+    async def shutdown_kernel(self, now: bool = False):
+        response = await self.placement.request(self.node, 'DELETE', f'/kernels/{self.kernel_id}')
+        response.raise_for_status()
+
+class KernelPlacement:
+    # Decides which host a new kernel runs on: the server itself or one of
+    # the worker agents (worker/agent.py) listed in the config. The status
+    # of every node (CPU load, available memory, per-kernel usage) is polled
+    # every poll_interval_seconds; a kernel goes to the node with the most
+    # headroom among those that can take the user's CPU and memory limits.
+    # If none can, the node with the most headroom is used anyway.
+    def __init__(self, config: PlacementConfig):
+        self.config = config
+        self.nodes: Dict[str, WorkerNode] = {}
+        workers = config.workers
+        if workers and not config.token:
+            # Agents refuse requests without the token
+            logger.error("placement.token is not set, the worker agents in placement.workers are not used")
+            workers = []
+        if config.local_kernels or not workers:
+            self.nodes[LOCAL_NODE] = WorkerNode(LOCAL_NODE, None)
+        for worker in workers:
+            self.nodes[worker.name] = WorkerNode(worker.name, worker.url)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._client is None:
+            headers = {'X-Worker-Token': self.config.token or ''}
+            self._client = httpx.AsyncClient(timeout=self.config.request_timeout_seconds, headers=headers)
+        psutil.cpu_percent(None)
+        await self.refresh()
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.config.poll_interval_seconds)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"Worker status poll failed: {e}", exc_info=True)
+
+    async def refresh(self):
+        await asyncio.gather(*(self._refresh_node(node) for node in self.nodes.values()))
+
+    async def _refresh_node(self, node: WorkerNode):
+        if node.is_local:
+            memory = psutil.virtual_memory()
+            status = {
+                'cpu_count': psutil.cpu_count() or 1,
+                'cpu_percent': psutil.cpu_percent(None),
+                'memory_total_mb': memory.total / (1024 * 1024),
+                'memory_available_mb': memory.available / (1024 * 1024)
+            }
+        else:
+            try:
+                response = await self.request(node, 'GET', '/status')
+                response.raise_for_status()
+                status = response.json()
+            except httpx.HTTPError as e:
+                if node.healthy:
+                    logger.warning(f"Worker {node.name} is unreachable: {e}")
+                node.healthy = False
+                return
+            if not node.healthy:
+                logger.info(f"Worker {node.name} is available at {node.url}")
+
+        node.status = status
+        node.healthy = True
+        node.last_seen = time.time()
+        node.pending_cpu = 0
+        node.pending_memory_mb = 0
+
+    async def request(self, node: WorkerNode, method: str, path: str, **kwargs) -> httpx.Response:
+        return await self._client.request(method, node.url + path, **kwargs)
+
+    def choose(self, cpu_percent: int, memory_mb: int) -> WorkerNode:
+        candidates = [node for node in self.nodes.values() if node.healthy]
+        if not candidates:
+            # Nothing has answered yet, the server host is always there
+            return self.nodes.get(LOCAL_NODE) or WorkerNode(LOCAL_NODE, None)
+
+        fitting = [node for node in candidates if node.fits(cpu_percent, memory_mb)]
+        if not fitting:
+            logger.warning(
+                f"No node has {cpu_percent}% CPU and {memory_mb} MB free, "
+                f"placing the kernel on the least loaded one"
+            )
+            fitting = candidates
+        return max(fitting, key=lambda node: node.headroom(cpu_percent, memory_mb))
+
+    async def start_kernel(
+        self, node: WorkerNode, kernel_name: str, user_id: str, cpu_percent: int, memory_mb: int
+    ) -> RemoteKernelManager:
+        try:
+            response = await self.request(node, 'POST', '/kernels', json={
+                'kernel_name': kernel_name,
+                'user_id': user_id,
+                'cpu_percent': cpu_percent,
+                'memory_mb': memory_mb
+            })
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            # Not chosen again until the next status poll succeeds
+            node.healthy = False
+            raise RuntimeError(f"Failed to start a kernel on worker {node.name}: {e}") from e
+
+        data = response.json()
+        logger.info(f"Kernel {data['kernel_id']} started on worker {node.name}")
+        return RemoteKernelManager(self, node, data['kernel_id'], data['connection_info'])
+
+    def placed(self, node: WorkerNode, cpu_percent: int, memory_mb: int):
+        node.kernels += 1
+        node.pending_cpu += cpu_percent
+        node.pending_memory_mb += memory_mb
+
+    def released(self, node_name: str):
+        node = self.nodes.get(node_name)
+        if node is not None:
+            node.kernels = max(node.kernels - 1, 0)
+
+    async def update_user_limits(self, user_id: str, cpu_percent: int, memory_mb: int):
+        remote = [node for node in self.nodes.values() if not node.is_local and node.healthy]
+        results = await asyncio.gather(*(
+            self.request(node, 'PUT', f'/users/{user_id}/limits', json={
+                'cpu_percent': cpu_percent,
+                'memory_mb': memory_mb
+            })
+            for node in remote
+        ), return_exceptions=True)
+        for node, result in zip(remote, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Failed to update limits of user {user_id} on worker {node.name}: {result}")
+
+    def kernel_usage(self, node_name: str, kernel_id: str) -> Optional[dict]:
+        # Last reported CPU and memory usage of a kernel on a worker
+        node = self.nodes.get(node_name)
+        if node is None:
+            return None
+        return node.status.get('kernels', {}).get(kernel_id)
+
+    def stats(self) -> List[dict]:
+        return [node.to_dict() for node in self.nodes.values()]
@@ -0,0 +1,153 @@
+import asyncio
+import time
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Set
+from config import KernelPoolConfig
+
+logger = logging.getLogger(__name__)
+
+class PooledKernel:
+    def __init__(self, kernel: Any, kernel_name: str):
+        self.kernel = kernel
+        self.kernel_name = kernel_name
+        self.started_at = time.monotonic()
+
+    def age(self) -> float:
+        return time.monotonic() - self.started_at
+
+class KernelPool:
+    # Keeps pre-started idle kernels per kernel spec so that a new
+    # user_id:notebook_path key does not pay the kernel cold start.
+    def __init__(
+        self,
+        config: KernelPoolConfig,
+        start_kernel: Callable[[str], Awaitable[Any]],
+        shutdown_kernel: Callable[[Any], Awaitable[None]],
+        is_alive: Callable[[Any], Awaitable[bool]]
+    ):
+        self.config = config
+        self._start_kernel = start_kernel
+        self._shutdown_kernel = shutdown_kernel
+        self._is_alive = is_alive
+        self._idle: Dict[str, Deque[PooledKernel]] = {name: deque() for name in config.kernel_specs}
+        self._starting: Dict[str, int] = {name: 0 for name in config.kernel_specs}
+        self.hits: Dict[str, int] = {name: 0 for name in config.kernel_specs}
+        self.misses: Dict[str, int] = {name: 0 for name in config.kernel_specs}
+        self.expired: Dict[str, int] = {name: 0 for name in config.kernel_specs}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        # Shutdowns of expired kernels, kept so that stop() can wait for them
+        self._shutdowns: Set[asyncio.Task] = set()
+        self._closed = False
+
+    async def start(self):
+        if not self.config.enabled or self._task is not None:
+            return
+        self._closed = False
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._refill_loop())
+        logger.info(f"Kernel pool started: {self.config.kernel_specs}")
+
+    async def stop(self):
+        # Let the refill loop finish any in-flight starts instead of cancelling
+        # it, otherwise a kernel that is half way through startup would leak
+        self._closed = True
+        if self._task is not None:
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        if self._shutdowns:
+            await asyncio.gather(*self._shutdowns, return_exceptions=True)
+
+        idle = [pooled for queue in self._idle.values() for pooled in queue]
+        for queue in self._idle.values():
+            queue.clear()
+        await asyncio.gather(*(self._shutdown_kernel(p.kernel) for p in idle), return_exceptions=True)
+        logger.info(f"Kernel pool stopped, {len(idle)} idle kernels shut down")
+
+    async def acquire(self, kernel_name: str) -> Optional[Any]:
+        queue = self._idle.get(kernel_name)
+        if queue is None:
+            return None
+
+        spec = self.config.kernel_specs[kernel_name]
+        kernel = None
+        while queue:
+            pooled = queue.popleft()
+            if pooled.age() > spec.max_age_seconds or not await self._is_alive(pooled.kernel):
+                self.expired[kernel_name] += 1
+                task = asyncio.create_task(self._shutdown_kernel(pooled.kernel))
+                self._shutdowns.add(task)
+                task.add_done_callback(self._shutdowns.discard)
+                continue
+            kernel = pooled.kernel
+            break
+
+        if kernel is None:
+            self.misses[kernel_name] += 1
+            logger.info(f"Kernel pool miss: {kernel_name}")
+        else:
+            self.hits[kernel_name] += 1
+            logger.info(f"Kernel pool hit: {kernel_name} ({len(queue)} idle left)")
+
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return kernel
+
+    def stats(self) -> dict:
+        return {
+            name: {
+                'size': spec.size,
+                'idle': len(self._idle[name]),
+                'starting': self._starting[name],
+                'hits': self.hits[name],
+                'misses': self.misses[name],
+                'expired': self.expired[name]
+            }
+            for name, spec in self.config.kernel_specs.items()
+        }
+
+    async def _refill_loop(self):
+        while not self._closed:
+            try:
+                await self._refill_once()
+            except Exception as e:
+                logger.error(f"Kernel pool refill failed: {e}", exc_info=True)
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.config.refill_interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def _refill_once(self):
+        starts = []
+        for name, spec in self.config.kernel_specs.items():
+            queue = self._idle[name]
+
+            # Retire kernels that sat in the pool for too long
+            while queue and queue[0].age() > spec.max_age_seconds:
+                pooled = queue.popleft()
+                self.expired[name] += 1
+                starts.append(self._shutdown_kernel(pooled.kernel))
+
+            missing = spec.size - len(queue) - self._starting[name]
+            for _ in range(max(missing, 0)):
+                starts.append(self._add_kernel(name))
+
+        if starts:
+            await asyncio.gather(*starts, return_exceptions=True)
+
+    async def _add_kernel(self, kernel_name: str):
+        self._starting[kernel_name] += 1
+        try:
+            kernel = await self._start_kernel(kernel_name)
+        except Exception as e:
+            logger.warning(f"Failed to pre-start {kernel_name} kernel: {e}")
+            return
+        finally:
+            self._starting[kernel_name] -= 1
+
+        self._idle[kernel_name].append(PooledKernel(kernel, kernel_name))
+        logger.info(f"Pre-started {kernel_name} kernel added to pool")
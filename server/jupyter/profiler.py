@@ -0,0 +1,66 @@
+import json
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Profiling a cell inside the kernel: a silent execute before the cell starts
+# a cProfile profiler, one after it stops the profiler and prints a summary.
+# Both run through exec() with their own globals so nothing is left in the
+# user's namespace, and silent executes do not count towards the
+# execution count or the history. The profiler lives on the sys module
+# between the two.
+
+MARKER = '__distributed_jupyter_profile__'
+
+START_CODE = '''exec("""
+import sys, cProfile
+sys._distributed_jupyter_profiler = cProfile.Profile()
+sys._distributed_jupyter_profiler.enable()
+""", {})'''
+
+STOP_CODE = '''exec("""
+import os, sys, json, pstats
+profiler = getattr(sys, '_distributed_jupyter_profiler', None)
+if profiler is not None:
+    profiler.disable()
+    del sys._distributed_jupyter_profiler
+    stats = pstats.Stats(profiler).stats
+    kernel_packages = tuple(os.sep + name + os.sep for name in KERNEL_PACKAGES)
+    rows = [
+        (key, value) for key, value in stats.items()
+        if key[0] != '<string>' and '_lsprof.Profiler' not in key[2]
+        and not any(package in key[0] for package in kernel_packages)
+    ]
+    rows.sort(key=lambda row: row[1][2], reverse=True)
+    print(MARKER + json.dumps({
+        'total_ms': round(sum(value[2] for _, value in rows) * 1000, 3),
+        'functions': len(rows),
+        'top': [
+            {
+                'file': file, 'line': line, 'function': function,
+                'ncalls': ncalls, 'primitive_calls': primitive,
+                'tottime_ms': round(tottime * 1000, 3), 'cumtime_ms': round(cumtime * 1000, 3)
+            }
+            for (file, line, function), (primitive, ncalls, tottime, cumtime, _) in rows[:TOP_N]
+        ]
+    }))
+""", {'TOP_N': %d, 'MARKER': %r, 'KERNEL_PACKAGES': %r})'''
+
+# The kernel's own machinery runs while the profiler is on, it is left out
+# of the summary
+KERNEL_PACKAGES = ('ipykernel', 'IPython', 'zmq', 'jupyter_client', 'traitlets', 'tornado', 'comm', 'asyncio')
+
+def stop_code(top_n: int) -> str:
+    return STOP_CODE % (top_n, MARKER, KERNEL_PACKAGES)
+
+def parse_summary(text: str) -> Optional[dict]:
+    # Hot functions by own time: total_ms, functions and the top entries
+    for line in text.splitlines():
+        if line.startswith(MARKER):
+            try:
+                return json.loads(line[len(MARKER):])
+            except ValueError as e:
+                logger.warning(f"Unreadable profile summary: {e}")
+                return None
+    return None
@@ -0,0 +1,106 @@
+import logging
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+from config import ReplayConfig
+from api.streaming import output_size
+
+logger = logging.getLogger(__name__)
+
+# Allowance for the fields of an event besides its outputs
+EVENT_OVERHEAD_BYTES = 256
+
+def event_size(data: dict) -> int:
+    outputs = data.get('outputs') or []
+    return EVENT_OVERHEAD_BYTES + sum(output_size(output) for output in outputs)
+
+class ReplayBuffer:
+    # The events sent about one kernel's cells (queued, started, output
+    # chunks, results), numbered with kernel_seq from 1. They go to the
+    # kernel's subscriber: the socket that last ran a cell on it or
+    # resubscribed to it, not necessarily the one that started the cell. A
+    # client whose connection dropped reconnects with a new sid,
+    # resubscribes, and is sent everything after the last kernel_seq it
+    # saw, as far as it is still in the buffer.
+    #
+    # The buffer keeps at most max_events events and max_bytes of output,
+    # oldest first out.
+    def __init__(self, key: str, notebook_path: str, config: ReplayConfig):
+        self.key = key
+        self.notebook_path = notebook_path
+        self.config = config
+        self.sid: Optional[str] = None
+        self.seq = 0
+        self.bytes = 0
+        self._events: Deque[Tuple[int, str, dict, int]] = deque()
+        # Output streamers of running cells, reset when the subscriber changes
+        # since acknowledgements from the previous one will not come
+        self.streamers: Set[Any] = set()
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def append(self, event: str, data: dict) -> dict:
+        # Numbers the event, keeps it and returns what to send
+        self.seq += 1
+        data = dict(data, notebook_path=self.notebook_path, kernel_seq=self.seq)
+        size = event_size(data)
+        self._events.append((self.seq, event, data, size))
+        self.bytes += size
+        while len(self._events) > 1 and (
+            len(self._events) > self.config.max_events or self.bytes > self.config.max_bytes
+        ):
+            self.bytes -= self._events.popleft()[3]
+        return data
+
+    def since(self, seq: Optional[int]) -> Tuple[List[Tuple[str, dict]], bool]:
+        # Events after seq, and whether some of them have already been
+        # dropped. None is a client that has seen nothing it needs replayed.
+        if seq is None:
+            return [], False
+        if seq > self.seq:
+            # Numbered by an earlier buffer of this key, e.g. before a
+            # server restart; everything here is new to the client
+            seq = 0
+        first = self._events[0][0] if self._events else self.seq + 1
+        events = [(event, data) for number, event, data, _ in self._events if number > seq]
+        return events, seq + 1 < first
+
+class ReplayStore:
+    # Replay buffers of the kernels owned by this server worker
+    def __init__(self, config: ReplayConfig):
+        self.config = config
+        self.buffers: Dict[str, ReplayBuffer] = {}
+        self.replayed = 0
+
+    def get(self, key: str, notebook_path: str) -> ReplayBuffer:
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            buffer = self.buffers[key] = ReplayBuffer(key, notebook_path, self.config)
+        return buffer
+
+    def subscribe(self, key: str, notebook_path: str, sid: str) -> ReplayBuffer:
+        buffer = self.get(key, notebook_path)
+        if buffer.sid != sid:
+            buffer.sid = sid
+            for streamer in list(buffer.streamers):
+                streamer.retarget()
+        return buffer
+
+    def detach(self, sid: str):
+        # The socket is gone: keep buffering until someone resubscribes
+        for buffer in self.buffers.values():
+            if buffer.sid == sid:
+                buffer.sid = None
+                for streamer in list(buffer.streamers):
+                    streamer.retarget()
+
+    def forget(self, key: str):
+        self.buffers.pop(key, None)
+
+    def stats(self) -> dict:
+        return {
+            'kernels': len(self.buffers),
+            'events': sum(len(buffer) for buffer in self.buffers.values()),
+            'bytes': sum(buffer.bytes for buffer in self.buffers.values()),
+            'replayed': self.replayed
+        }
@@ -0,0 +1,198 @@
+import os
+import asyncio
+import time
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Sequence, Set
+from config import SchedulerConfig
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Stride scheduling: each dispatch advances the user's pass by STRIDE / weight,
+# the waiting user with the lowest pass goes next
+STRIDE = 1_000_000.0
+
+QueuedCallback = Callable[[int, int], Awaitable[None]]
+
+class ExecutionCancelled(Exception):
+    pass
+
+class ExecutionRequest:
+    def __init__(
+        self,
+        user_id: str,
+        kernel_key: str,
+        weight: int,
+        run: Callable[[], Awaitable[Any]],
+        on_queued: Optional[QueuedCallback],
+        on_start: Optional[Callable[[], Awaitable[None]]],
+        cell_ids: Sequence[str]
+    ):
+        self.user_id = user_id
+        self.kernel_key = kernel_key
+        self.weight = max(weight or 1, 1)
+        self.run = run
+        self.on_queued = on_queued
+        self.on_start = on_start
+        self.cell_ids = set(cell_ids)
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+
+class ExecutionScheduler:
+    # Sits between the websocket handlers and JupyterManager. Cells for the
+    # same kernel run in FIFO order, one at a time; at most
+    # max_concurrent_executions cells run at once across all kernels and free
+    # slots are handed out by per-user weighted fair share.
+    def __init__(self, config: SchedulerConfig):
+        self.max_concurrent = config.max_concurrent_executions or os.cpu_count() or 1
+        self._queues: Dict[str, Deque[ExecutionRequest]] = {}
+        self._busy_kernels: Set[str] = set()
+        self._running = 0
+        self._running_by_user: Dict[str, int] = {}
+        self._pass: Dict[str, float] = {}
+        # Running cells and queue position notices, kept until they finish
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def submit(
+        self,
+        user_id: str,
+        kernel_key: str,
+        weight: int,
+        run: Callable[[], Awaitable[Any]],
+        on_queued: Optional[QueuedCallback] = None,
+        on_start: Optional[Callable[[], Awaitable[None]]] = None,
+        cell_ids: Sequence[str] = ()
+    ) -> Any:
+        # Raises ExecutionCancelled if cancel() takes the request out of the
+        # queue before it runs
+        request = ExecutionRequest(user_id, kernel_key, weight, run, on_queued, on_start, cell_ids)
+        self._queues.setdefault(kernel_key, deque()).append(request)
+        self._dispatch()
+
+        if not request.future.done() and request in self._queues.get(kernel_key, ()):
+            self._notify_position(request)
+        return await request.future
+
+    async def stop(self):
+        # Cells still running when the server shuts down are cancelled
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def cancel(self, kernel_key: str, cell_id: str) -> bool:
+        # Drops the queued request holding cell_id, all of its cells
+        queue = self._queues.get(kernel_key)
+        request = next((r for r in queue or () if cell_id in r.cell_ids), None)
+        if request is None:
+            return False
+        queue.remove(request)
+        if not queue:
+            del self._queues[kernel_key]
+        if request.user_id not in self._running_by_user:
+            self._forget_if_idle(request.user_id)
+        request.future.set_exception(ExecutionCancelled())
+        for waiting in self._queues.get(kernel_key, ()):
+            self._notify_position(waiting)
+        return True
+
+    def stats(self) -> dict:
+        return {
+            'max_concurrent': self.max_concurrent,
+            'running': self._running,
+            'queue_depth': self.queue_depth,
+            'queued_kernels': {key: len(queue) for key, queue in self._queues.items() if queue}
+        }
+
+    def _dispatch(self):
+        while self._running < self.max_concurrent:
+            request = self._pick_next()
+            if request is None:
+                return
+
+            queue = self._queues[request.kernel_key]
+            queue.popleft()
+            if not queue:
+                del self._queues[request.kernel_key]
+
+            self._charge(request)
+            self._busy_kernels.add(request.kernel_key)
+            self._running += 1
+            self._running_by_user[request.user_id] = self._running_by_user.get(request.user_id, 0) + 1
+            self._spawn(self._run(request))
+
+            for waiting in self._queues.get(request.kernel_key, ()):
+                self._notify_position(waiting)
+
+    def _pick_next(self) -> Optional[ExecutionRequest]:
+        best = None
+        best_pass = None
+        for key, queue in self._queues.items():
+            if key in self._busy_kernels or not queue:
+                continue
+            head = queue[0]
+            user_pass = self._pass.get(head.user_id, self._min_pass())
+            # Ties go to whoever has been waiting longest
+            if best is None or (user_pass, head.enqueued_at) < (best_pass, best.enqueued_at):
+                best = head
+                best_pass = user_pass
+        return best
+
+    def _min_pass(self) -> float:
+        return min(self._pass.values(), default=0.0)
+
+    def _charge(self, request: ExecutionRequest):
+        # A user who was idle does not get to bank credit, they start from
+        # the current minimum pass
+        current = self._pass.get(request.user_id, self._min_pass())
+        self._pass[request.user_id] = current + STRIDE / request.weight
+
+    async def _run(self, request: ExecutionRequest):
+        metrics.QUEUE_WAIT_SECONDS.observe(time.monotonic() - request.enqueued_at)
+        try:
+            if request.on_start is not None:
+                await request.on_start()
+            result = await request.run()
+        except Exception as e:
+            if not request.future.done():
+                request.future.set_exception(e)
+        else:
+            if not request.future.done():
+                request.future.set_result(result)
+        finally:
+            self._running -= 1
+            self._busy_kernels.discard(request.kernel_key)
+            self._running_by_user[request.user_id] -= 1
+            if not self._running_by_user[request.user_id]:
+                del self._running_by_user[request.user_id]
+                self._forget_if_idle(request.user_id)
+            self._dispatch()
+
+    def _forget_if_idle(self, user_id: str):
+        # Users without queued or running cells leave the pass table, so the
+        # minimum pass only reflects users that are competing right now
+        for queue in self._queues.values():
+            if any(r.user_id == user_id for r in queue):
+                return
+        self._pass.pop(user_id, None)
+
+    def _notify_position(self, request: ExecutionRequest):
+        if request.on_queued is None:
+            return
+        queue = self._queues.get(request.kernel_key, ())
+        position = list(queue).index(request) + 1
+        self._spawn(request.on_queued(position, self.queue_depth))
+
+    def _spawn(self, coro: Awaitable[None]):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Scheduler task failed", exc_info=task.exception())
@@ -0,0 +1,178 @@
+import uuid
+import asyncio
+import shutil
+import logging
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Optional
+from config import OutputSpillConfig, settings
+
+logger = logging.getLogger(__name__)
+
+class SpilledOutput:
+    def __init__(self, handle: str, user_id: str, session_id: Optional[int], path: Path):
+        self.handle = handle
+        self.user_id = user_id
+        self.session_id = session_id
+        self.path = path
+        self.total_bytes = 0
+
+class CellSpill:
+    # Stream text of one cell execution. Up to threshold_bytes is passed on
+    # as usual; past that the text goes to a file in the spill store and only
+    # the last tail_bytes are kept in memory. The file holds the cell's
+    # whole stream text from the start, so byte offsets in it line up with
+    # what the client has already been sent.
+    def __init__(self, store: 'OutputSpillStore', user_id: str, session_id: Optional[int]):
+        self.store = store
+        self.user_id = user_id
+        self.session_id = session_id
+        self._passed = 0
+        self._head: List[str] = []
+        self._head_bytes = 0
+        self._tail = ''
+        self._file: Optional[BinaryIO] = None
+        self._spilled: Optional[SpilledOutput] = None
+
+    async def feed(self, item: dict) -> Optional[dict]:
+        # Returns what should still be sent on for this item, None once the
+        # cell is past the threshold
+        if item.get('output_type') != 'stream':
+            return item
+
+        text = item['text']
+        if self._spilled is not None:
+            await self._append(text)
+            return None
+
+        data = text.encode('utf-8')
+        room = self.store.config.threshold_bytes - self._passed
+        if len(data) <= room:
+            self._passed += len(data)
+            self._head.append(text)
+            return item
+
+        # Cut at the last whole character that fits
+        passed = data[:room].decode('utf-8', 'ignore')
+        rest = text[len(passed):]
+        head = ''.join(self._head) + passed
+        self._head = []
+        await self._start()
+        await self._write(head)
+        self._head_bytes = self._spilled.total_bytes
+        await self._append(rest)
+        return dict(item, text=passed) if passed else None
+
+    async def finish(self) -> Optional[dict]:
+        # Summary for the client: the handle, where the part it has not seen
+        # starts and ends in the file, and the tail text
+        if self._spilled is None:
+            return None
+        await asyncio.to_thread(self._file.close)
+        self._file = None
+        total = self._spilled.total_bytes
+        return {
+            'handle': self._spilled.handle,
+            'total_bytes': total,
+            'head_bytes': self._head_bytes,
+            'tail_offset': total - len(self._tail.encode('utf-8')),
+            'tail': self._tail
+        }
+
+    async def _start(self):
+        self._spilled = await asyncio.to_thread(self.store.create, self.user_id, self.session_id)
+        self._file = await asyncio.to_thread(open, self._spilled.path, 'wb', buffering=1024 * 1024)
+
+    async def _append(self, text: str):
+        await self._write(text)
+        # The last tail_bytes, less a character cut in half at the start.
+        # No character is shorter than a byte, so slicing the text first
+        # keeps everything needed
+        limit = self.store.config.tail_bytes
+        tail = (self._tail + text)[-limit:].encode('utf-8')[-limit:]
+        self._tail = tail.decode('utf-8', 'ignore')
+
+    async def _write(self, text: str):
+        data = text.encode('utf-8')
+        await asyncio.to_thread(self._file.write, data)
+        self._spilled.total_bytes += len(data)
+
+class OutputSpillStore:
+    # Disk-backed store for stream output that is too large to send at once,
+    # under <storage.base_path>/spill/<user_id>/<session_id>/. Spilled
+    # outputs are read back in pages through the REST API and deleted when
+    # their session ends; anything left over from a previous run is removed
+    # at startup. With several server workers the page request may reach a
+    # worker that did not write the output, which finds it by its path.
+    def __init__(self, config: OutputSpillConfig):
+        self.config = config
+        self.root = Path(settings.storage.base_path) / 'spill'
+        self._outputs: Dict[str, SpilledOutput] = {}
+
+    def start(self, clear: bool = True):
+        # Workers of a cluster share the directory, it is cleared once by
+        # the process that starts them
+        if clear:
+            self.clear()
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def open_cell(self, user_id: str, session_id: Optional[int]) -> CellSpill:
+        return CellSpill(self, user_id, session_id)
+
+    def create(self, user_id: str, session_id: Optional[int]) -> SpilledOutput:
+        handle = uuid.uuid4().hex
+        directory = self.root / str(user_id) / str(session_id)
+        directory.mkdir(parents=True, exist_ok=True)
+        spilled = SpilledOutput(handle, str(user_id), session_id, directory / f'{handle}.txt')
+        self._outputs[handle] = spilled
+        logger.info(f"Spilling output of session {session_id} to {spilled.path}")
+        return spilled
+
+    def get(self, handle: str, user_id: int) -> Optional[SpilledOutput]:
+        spilled = self._outputs.get(handle)
+        if spilled is None:
+            return self._find(handle, str(user_id))
+        if spilled.user_id != str(user_id):
+            return None
+        return spilled
+
+    def _find(self, handle: str, user_id: str) -> Optional[SpilledOutput]:
+        # Written by another server worker
+        if not handle.isalnum():
+            return None
+        for path in (self.root / user_id).glob(f'*/{handle}.txt'):
+            spilled = SpilledOutput(handle, user_id, None, path)
+            spilled.total_bytes = path.stat().st_size
+            return spilled
+        return None
+
+    def read(self, spilled: SpilledOutput, offset: int, limit: int) -> dict:
+        limit = min(limit, self.config.max_page_bytes)
+        with open(spilled.path, 'rb') as f:
+            f.seek(offset)
+            data = f.read(limit)
+        # Do not cut a multi-byte character in half, the next page starts
+        # where this one ends
+        try:
+            text = data.decode('utf-8')
+        except UnicodeDecodeError as e:
+            if e.start < len(data) - 3:
+                raise
+            data = data[:e.start]
+            text = data.decode('utf-8')
+        next_offset = offset + len(data)
+        return {
+            'handle': spilled.handle,
+            'offset': offset,
+            'next_offset': next_offset,
+            'total_bytes': spilled.total_bytes,
+            'text': text,
+            'eof': next_offset >= spilled.total_bytes
+        }
+
+    def release_session(self, user_id: str, session_id: Optional[int]):
+        for handle in [h for h, s in self._outputs.items() if s.session_id == session_id]:
+            del self._outputs[handle]
+        shutil.rmtree(self.root / str(user_id) / str(session_id), ignore_errors=True)
@@ -2,15 +2,22 @@ import uvicorn
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response
 import socketio
 import logging
 import os
+import sys
+import shutil
+import argparse
+from contextlib import asynccontextmanager
 from pathlib import Path
 from api.routes import router
-from api.websocket import sio
-from database import engine, Base
+from api.websocket import sio, jupyter_manager, scheduler
+from database import engine, async_engine, Base, add_missing_columns
 from config import settings
+from cluster.bus import BusRelay, relay_address
+import metrics
+from tracing import tracer
 
 # Setup logging
 logging.basicConfig(
@@ -22,8 +29,26 @@ logger = logging.getLogger(__name__)
 # Create tables
 logger.info("Creating database tables...")
 Base.metadata.create_all(bind=engine)
+add_missing_columns(engine)
 
-app = FastAPI(title="Distributed Jupyter System")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await tracer.start()
+    await jupyter_manager.start()
+    # Listen on the message queue from the start, not only after the first
+    # client connects: this worker may run kernels for clients of other workers
+    if not sio.manager_initialized:
+        sio.manager_initialized = True
+        sio.manager.initialize()
+    yield
+    await scheduler.stop()
+    await jupyter_manager.shutdown()
+    await tracer.stop()
+    # aiosqlite keeps a thread per pooled connection that would hold up exit
+    await async_engine.dispose()
+    metrics.mark_process_dead(os.getpid())
+
+app = FastAPI(title="Distributed Jupyter System", lifespan=lifespan)
 
 # CORS
 app.add_middleware(
@@ -49,6 +74,12 @@ except Exception as e:
 app.include_router(router, prefix="/api", tags=["api"])
 logger.info(f"API routes: {[route.path for route in router.routes]}")
 
+if settings.metrics.enabled:
+    @app.get("/metrics", include_in_schema=False)
+    async def prometheus_metrics():
+        body, content_type = metrics.render()
+        return Response(body, headers={'Content-Type': content_type})
+
 # Check if client build exists
 client_dist = Path(__file__).parent.parent / "client" / "dist"
 if client_dist.exists():
@@ -84,10 +115,36 @@ else:
 socket_app = socketio.ASGIApp(sio, app)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Distributed Jupyter Server")
+    parser.add_argument('--production', action='store_true',
+                        help="Run without auto-reload, with server.workers worker processes")
+    parser.add_argument('--workers', type=int, default=None, help="Overrides server.workers")
+    args = parser.parse_args()
+    workers = (args.workers or settings.server.workers) if args.production else 1
+    
+    if workers > 1 and settings.cluster.message_queue is None:
+        logger.error("server.workers > 1 needs cluster.message_queue (e.g. local://127.0.0.1:8765)")
+        sys.exit(1)
+    if settings.cluster.message_queue is not None:
+        # Shared by all workers, cleared once here instead of by each of them
+        jupyter_manager.spill.clear()
+        address = relay_address(settings.cluster.message_queue)
+        if address is not None:
+            BusRelay(*address).start_in_thread()
+    if workers > 1 and settings.metrics.enabled and not metrics.multiprocess_enabled():
+        # Workers inherit the environment and share their metrics through
+        # files here (see metrics.py)
+        metrics_dir = Path(settings.storage.base_path) / 'metrics'
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        metrics_dir.mkdir(parents=True)
+        os.environ['PROMETHEUS_MULTIPROC_DIR'] = str(metrics_dir)
+    
     logger.info("=" * 60)
     logger.info("Distributed Jupyter Server")
     logger.info("=" * 60)
     logger.info(f"Starting server on {settings.server.host}:{settings.server.port}")
+    if args.production:
+        logger.info(f"Production mode, {workers} worker(s)")
     logger.info("")
     logger.info("Access the application at:")
     logger.info(f"  → http://localhost:{settings.server.port}")
@@ -101,6 +158,7 @@ if __name__ == "__main__":
         "main:socket_app",
         host=settings.server.host,
         port=settings.server.port,
-        reload=True,
+        reload=not args.production,
+        workers=workers if args.production else None,
         log_level="info"
     )
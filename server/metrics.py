@@ -0,0 +1,123 @@
+import os
+from typing import Dict, Set, Tuple
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+)
+from prometheus_client import multiprocess
+
+# Prometheus metrics of this server, served at /metrics. Everything here is
+# updated in place (an observe or inc takes a lock and a few additions), so
+# collection costs nothing until Prometheus scrapes. Label values are bounded:
+# iopub message types come from the Jupyter protocol, users from the users
+# table.
+#
+# With several server workers main.py sets PROMETHEUS_MULTIPROC_DIR before
+# they start; every worker then writes its values to files there and a
+# scrape of any worker reports the sum over all of them. Gauges are
+# therefore always set explicitly and use the livesum mode, which drops
+# workers that have exited.
+
+KERNEL_START_SECONDS = Histogram(
+    'jupyter_kernel_start_seconds',
+    'Time for get_or_create_kernel to hand out a new kernel',
+    ['source'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    'jupyter_queue_wait_seconds',
+    'Time a cell waits in the execution scheduler',
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+)
+EXECUTION_SECONDS = Histogram(
+    'jupyter_cell_execution_seconds',
+    'Time from sending a cell to the kernel until it is idle again',
+    ['status'],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800)
+)
+OUTPUT_BYTES = Histogram(
+    'jupyter_cell_output_bytes',
+    'Output produced by one cell, before spilling and truncation',
+    buckets=(0, 1024, 16 * 1024, 128 * 1024, 1024 ** 2, 8 * 1024 ** 2, 64 * 1024 ** 2, 512 * 1024 ** 2)
+)
+IOPUB_MESSAGES = Counter(
+    'jupyter_iopub_messages_total',
+    'Messages read from kernel iopub channels',
+    ['msg_type']
+)
+KERNEL_CRASHES = Counter(
+    'jupyter_kernel_crashes_total',
+    'Kernels that died while starting or executing a cell',
+    ['phase']
+)
+KERNEL_TIMEOUTS = Counter(
+    'jupyter_kernel_timeouts_total',
+    'Kernels that were alive but did not answer in time',
+    ['phase']
+)
+CELL_INTERRUPTS = Counter(
+    'jupyter_cell_interrupts_total',
+    'Cells stopped by an interrupt or their deadline, and whether that took a kernel restart',
+    ['reason', 'outcome']
+)
+LIMIT_REJECTIONS = Counter(
+    'jupyter_limit_rejections_total',
+    'Cells refused by ResourceMonitor.check_limits',
+    ['reason']
+)
+LIVE_KERNELS = Gauge(
+    'jupyter_live_kernels',
+    'Kernels handed out to notebooks',
+    multiprocess_mode='livesum'
+)
+CONNECTED_SOCKETS = Gauge(
+    'jupyter_connected_sockets',
+    'Connected Socket.IO clients',
+    multiprocess_mode='livesum'
+)
+USER_USAGE = Gauge(
+    'jupyter_user_usage',
+    "Last sampled usage of a user's kernels (cpu in percent of a core, others in MB)",
+    ['user_id', 'resource'],
+    multiprocess_mode='livesum'
+)
+
+# Children of IOPUB_MESSAGES by message type, labels() is a dict lookup
+# under a lock that the iopub reader would otherwise pay for every message
+_iopub_children: Dict[str, Counter] = {}
+
+# (user_id, resource) pairs set by the last report_user_usage call
+_reported_usage: Set[Tuple[str, str]] = set()
+
+def count_iopub(msg_type: str):
+    child = _iopub_children.get(msg_type)
+    if child is None:
+        child = _iopub_children[msg_type] = IOPUB_MESSAGES.labels(msg_type)
+    child.inc()
+
+def report_user_usage(totals: Dict[str, Dict[str, float]]):
+    # totals: user id -> resource -> value. Users that no longer have kernels
+    # are set to 0 rather than removed, removing is not possible across
+    # worker processes.
+    reported = set()
+    for user_id, usage in totals.items():
+        for resource, value in usage.items():
+            USER_USAGE.labels(user_id, resource).set(value)
+            reported.add((user_id, resource))
+    for user_id, resource in _reported_usage - reported:
+        USER_USAGE.labels(user_id, resource).set(0)
+    _reported_usage.clear()
+    _reported_usage.update(reported)
+
+def multiprocess_enabled() -> bool:
+    return 'PROMETHEUS_MULTIPROC_DIR' in os.environ
+
+def render() -> Tuple[bytes, str]:
+    if multiprocess_enabled():
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+def mark_process_dead(pid: int):
+    if multiprocess_enabled():
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,30 @@
+import os
+import sys
+
+# Kernel launcher: joins the given cgroup and then execs the real kernel
+# command, so the kernel process is inside its cgroup from its first
+# instruction on. Runs as a standalone script and must not import anything
+# from the server.
+#
+#   python cgroup_launcher.py /sys/fs/cgroup/.../cgroup.procs -- python -m ipykernel_launcher ...
+
+def main():
+    if len(sys.argv) < 4 or sys.argv[2] != '--':
+        print("usage: cgroup_launcher.py CGROUP_PROCS -- COMMAND...", file=sys.stderr)
+        sys.exit(2)
+
+    procs_file = sys.argv[1]
+    cmd = sys.argv[3:]
+
+    try:
+        with open(procs_file, 'w') as f:
+            f.write(str(os.getpid()))
+    except OSError as e:
+        # The server moves the kernel into its cgroup again when it is
+        # assigned, so a failure here is not fatal
+        print(f"Failed to join cgroup {procs_file}: {e}", file=sys.stderr)
+
+    os.execvp(cmd[0], cmd)
+
+if __name__ == '__main__':
+    main()
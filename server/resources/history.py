@@ -0,0 +1,59 @@
+from array import array
+from typing import Dict, List, Optional
+
+class RingBuffer:
+    # Fixed number of floats in one preallocated array. Once full, each
+    # append overwrites the oldest value; nothing is allocated per sample.
+    def __init__(self, capacity: int):
+        self.capacity = max(capacity, 1)
+        self._values = array('d', bytes(8 * self.capacity))
+        self._next = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, value: float):
+        self._values[self._next] = value
+        self._next = (self._next + 1) % self.capacity
+        if self._count < self.capacity:
+            self._count += 1
+
+    def last(self) -> Optional[float]:
+        if not self._count:
+            return None
+        return self._values[self._next - 1]
+
+    def values(self) -> List[float]:
+        # Oldest first
+        if self._count < self.capacity:
+            return self._values[:self._count].tolist()
+        return (self._values[self._next:] + self._values[:self._next]).tolist()
+
+class StatsHistory:
+    # Series sampled together: one timestamp and one value per series at
+    # each tick. A series that appears later is padded with zeros so all of
+    # them line up with the timestamps.
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.times = RingBuffer(capacity)
+        self.series: Dict[str, RingBuffer] = {}
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    def append(self, timestamp: float, values: Dict[str, float]):
+        for name in values:
+            if name not in self.series:
+                ring = self.series[name] = RingBuffer(self.capacity)
+                for _ in range(len(self.times)):
+                    ring.append(0.0)
+        self.times.append(timestamp)
+        for name, ring in self.series.items():
+            ring.append(values.get(name, 0.0))
+
+    def snapshot(self) -> dict:
+        return {
+            'times': self.times.values(),
+            'series': {name: ring.values() for name, ring in self.series.items()}
+        }
@@ -0,0 +1,190 @@
+import sys
+import logging
+from pathlib import Path
+from typing import Dict, List, Optional
+import psutil
+from config import IsolationConfig, settings
+
+logger = logging.getLogger(__name__)
+
+LAUNCHER = str(Path(__file__).parent / 'cgroup_launcher.py')
+CONTROLLERS = ('cpu', 'memory')
+
+def nice_for_cpu_percent(cpu_percent: int) -> int:
+    # 100% (a full core) or more keeps the default priority, lower limits
+    # map linearly onto nice 0..19
+    share = min(max(cpu_percent, 0), 100)
+    return round((100 - share) / 100 * 19)
+
+class KernelIsolator:
+    # Puts kernel processes under kernel-level CPU/memory limits.
+    #
+    # With a writable cgroup v2 hierarchy every kernel gets its own leaf
+    # cgroup. Pre-started kernels are launched (through cgroup_launcher.py)
+    # into <cgroup_name>/pool/kernel-<id>, and when a kernel is assigned to a
+    # user it moves to <cgroup_name>/user-<user_id>/kernel-<id>. cpu.max and
+    # memory.max are set on the user-<user_id> group, so a user's limits
+    # cover all of their kernels together.
+    #
+    # Without cgroups the fallback applies RLIMIT_AS and a nice value to each
+    # kernel process. These limits are per process, and once lowered they
+    # cannot be raised again.
+    def __init__(self, config: IsolationConfig):
+        self.config = config
+        self.base = Path(config.cgroup_root) / config.cgroup_name
+        self.pool_group = self.base / 'pool'
+        self._assigned: Dict[str, Path] = {}
+        self.cgroups_available = config.enabled and sys.platform.startswith('linux') and self._setup_cgroups()
+
+    @property
+    def mode(self) -> str:
+        if not self.config.enabled:
+            return 'disabled'
+        return 'cgroup' if self.cgroups_available else 'rlimit'
+
+    def wrap_command(self, kernel_id: str, cmd: List[str]) -> List[str]:
+        if not self.cgroups_available:
+            return cmd
+
+        group = self._assigned.get(kernel_id)
+        if group is None:
+            group = self.pool_group / f'kernel-{kernel_id}'
+        try:
+            group.mkdir(exist_ok=True)
+        except OSError as e:
+            logger.warning(f"Failed to create cgroup {group}: {e}")
+            return cmd
+        return [sys.executable, LAUNCHER, str(group / 'cgroup.procs'), '--'] + cmd
+
+    def assign(self, kernel_id: str, pid: Optional[int], user_id: str, cpu_percent: int, memory_mb: int):
+        if not self.config.enabled:
+            return
+
+        if not self.cgroups_available:
+            if pid is not None:
+                self._apply_rlimits(pid, cpu_percent, memory_mb)
+            return
+
+        try:
+            user_group = self._user_group(user_id)
+            self._write_limits(user_group, cpu_percent, memory_mb)
+            leaf = user_group / f'kernel-{kernel_id}'
+            leaf.mkdir(exist_ok=True)
+
+            old = self.pool_group / f'kernel-{kernel_id}'
+            pids = self._read_procs(old)
+            if pid is not None and pid not in pids:
+                pids.append(pid)
+            for p in pids:
+                (leaf / 'cgroup.procs').write_text(str(p))
+            self._remove_group(old)
+            self._assigned[kernel_id] = leaf
+            logger.info(f"Kernel {kernel_id} placed in cgroup {leaf}")
+        except OSError as e:
+            logger.error(f"Failed to place kernel {kernel_id} in its cgroup: {e}")
+            if pid is not None:
+                self._apply_rlimits(pid, cpu_percent, memory_mb)
+
+    def update_user_limits(self, user_id: str, cpu_percent: int, memory_mb: int, pids: List[int]):
+        if not self.config.enabled:
+            return
+
+        if self.cgroups_available:
+            group = self.base / f'user-{user_id}'
+            if group.exists():
+                try:
+                    self._write_limits(group, cpu_percent, memory_mb)
+                except OSError as e:
+                    logger.error(f"Failed to update cgroup limits for user {user_id}: {e}")
+            return
+
+        for pid in pids:
+            self._apply_rlimits(pid, cpu_percent, memory_mb)
+
+    def release(self, kernel_id: str):
+        group = self._assigned.pop(kernel_id, None) or self.pool_group / f'kernel-{kernel_id}'
+        if self.cgroups_available:
+            self._remove_group(group)
+
+    def _setup_cgroups(self) -> bool:
+        root = Path(self.config.cgroup_root)
+        if not (root / 'cgroup.controllers').exists():
+            logger.warning(f"No cgroup v2 hierarchy at {root}, falling back to rlimit/nice")
+            return False
+
+        try:
+            self._enable_controllers(root)
+            self.base.mkdir(exist_ok=True)
+            self._enable_controllers(self.base)
+            self.pool_group.mkdir(exist_ok=True)
+            self._enable_controllers(self.pool_group)
+            # Pre-started kernels are bounded by the default user limits
+            self._write_limits(
+                self.pool_group,
+                settings.default_limits.cpu_percent,
+                settings.default_limits.memory_mb
+            )
+        except OSError as e:
+            logger.warning(f"cgroup v2 at {root} is not writable ({e}), falling back to rlimit/nice")
+            return False
+
+        logger.info(f"Kernel isolation using cgroup v2 at {self.base}")
+        return True
+
+    def _user_group(self, user_id: str) -> Path:
+        group = self.base / f'user-{user_id}'
+        if not group.exists():
+            group.mkdir()
+            self._enable_controllers(group)
+        return group
+
+    def _enable_controllers(self, group: Path):
+        enabled = (group / 'cgroup.subtree_control').read_text().split()
+        missing = [c for c in CONTROLLERS if c not in enabled]
+        if missing:
+            (group / 'cgroup.subtree_control').write_text(' '.join(f'+{c}' for c in missing))
+
+    def _write_limits(self, group: Path, cpu_percent: int, memory_mb: int):
+        # cpu_percent follows psutil: 100 is one full core
+        period = self.config.cpu_period_us
+        if cpu_percent and cpu_percent > 0:
+            quota = max(int(period * cpu_percent / 100), 1000)
+            (group / 'cpu.max').write_text(f'{quota} {period}')
+        else:
+            (group / 'cpu.max').write_text(f'max {period}')
+
+        if memory_mb and memory_mb > 0:
+            (group / 'memory.max').write_text(str(memory_mb * 1024 * 1024))
+        else:
+            (group / 'memory.max').write_text('max')
+
+    def _read_procs(self, group: Path) -> List[int]:
+        try:
+            return [int(line) for line in (group / 'cgroup.procs').read_text().split()]
+        except OSError:
+            return []
+
+    def _remove_group(self, group: Path):
+        try:
+            group.rmdir()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Failed to remove cgroup {group}: {e}")
+
+    def _apply_rlimits(self, pid: int, cpu_percent: int, memory_mb: int):
+        if not hasattr(psutil, 'RLIMIT_AS'):
+            logger.warning("rlimit fallback is not supported on this platform, kernel limits are not enforced")
+            return
+        try:
+            process = psutil.Process(pid)
+            if memory_mb and memory_mb > 0:
+                limit = memory_mb * 1024 * 1024
+                process.rlimit(psutil.RLIMIT_AS, (limit, limit))
+            if cpu_percent is not None:
+                nice = nice_for_cpu_percent(cpu_percent)
+                if nice > process.nice():
+                    process.nice(nice)
+            logger.info(f"Applied rlimit/nice to kernel process {pid}")
+        except (psutil.Error, OSError, ValueError) as e:
+            logger.warning(f"Failed to apply rlimit/nice to kernel process {pid}: {e}")
@@ -1,109 +1,77 @@
-import psutil
-import os
+import asyncio
+from pathlib import Path
 from typing import Optional
-from database import SessionLocal, User, ResourceLimit, Session as DBSession
-
-try:
-    import GPUtil
-    GPU_AVAILABLE = True
-except:
-    GPU_AVAILABLE = False
+from sqlalchemy import select
+from database import AsyncSessionLocal, Session as DBSession
+from config import settings
+from cache import user_cache
+from resources.sampler import UsageSampler
+from resources.storage import StorageAccountant, directory_size
+import metrics
 
 class ResourceMonitor:
-    def __init__(self):
-        self.process = psutil.Process(os.getpid())
+    def __init__(self, sampler: Optional[UsageSampler] = None, storage: Optional[StorageAccountant] = None):
+        # With a sampler, usage of running kernels comes from its latest
+        # tick instead of the Session rows; with a storage accountant, storage
+        # comes from its running totals instead of a directory walk
+        self.sampler = sampler
+        self.storage = storage
     
     async def check_limits(self, user_id: int) -> bool:
-        db = SessionLocal()
-        try:
-            user = db.query(User).filter(User.id == user_id).first()
-            if not user:
-                return False
-            
-            limits = db.query(ResourceLimit).filter(ResourceLimit.user_id == user_id).first()
-            if not limits:
-                return True
-            
-            # Check CPU
-            cpu_percent = self.process.cpu_percent()
-            if cpu_percent > limits.cpu_percent:
-                return False
-            
-            # Check Memory
-            memory_info = self.process.memory_info()
-            memory_mb = memory_info.rss / (1024 * 1024)
-            if memory_mb > limits.memory_mb:
-                return False
-            
-            # Check Storage
-            storage_usage = await self.get_user_storage(user_id)
-            if storage_usage > limits.storage_mb:
-                return False
-            
+        # CPU and memory are enforced on the kernel processes themselves
+        # (see resources/isolation.py), only storage is checked up front
+        user = await user_cache.get_user(user_id)
+        if not user or user.is_banned or not user.is_whitelisted:
+            metrics.LIMIT_REJECTIONS.labels('not_allowed').inc()
+            return False
+        
+        limits = await user_cache.get_limits(user_id)
+        if not limits:
             return True
-        finally:
-            db.close()
+        
+        # Check Storage
+        storage_usage = await self.get_user_storage(user_id)
+        if storage_usage > limits.storage_mb:
+            metrics.LIMIT_REJECTIONS.labels('storage').inc()
+            return False
+        
+        return True
+    
+    async def get_cpu_weight(self, user_id: int) -> int:
+        # Fair-share weight for the execution scheduler
+        limits = await user_cache.get_limits(user_id)
+        if not limits or not limits.cpu_percent:
+            return settings.default_limits.cpu_percent
+        return limits.cpu_percent
     
     async def get_user_storage(self, user_id: int) -> float:
-        from pathlib import Path
-        from config import settings
+        if self.storage is not None:
+            return await self.storage.usage_mb(user_id)
         
         user_dir = Path(settings.storage.notebooks_path) / str(user_id)
-        if not user_dir.exists():
-            return 0.0
-        
-        total_size = 0
-        for file in user_dir.rglob('*'):
-            if file.is_file():
-                total_size += file.stat().st_size
-        
+        total_size = await asyncio.to_thread(directory_size, user_dir)
         return total_size / (1024 * 1024)  # Convert to MB
     
-    async def get_system_stats(self) -> dict:
-        stats = {
-            'cpu_percent': psutil.cpu_percent(interval=1),
-            'memory': psutil.virtual_memory()._asdict(),
-            'disk': psutil.disk_usage('/')._asdict()
-        }
-        
-        if GPU_AVAILABLE:
-            try:
-                gpus = GPUtil.getGPUs()
-                stats['gpus'] = [
-                    {
-                        'id': gpu.id,
-                        'name': gpu.name,
-                        'load': gpu.load * 100,
-                        'memory_used': gpu.memoryUsed,
-                        'memory_total': gpu.memoryTotal
-                    }
-                    for gpu in gpus
-                ]
-            except:
-                stats['gpus'] = []
-        else:
-            stats['gpus'] = []
-        
-        return stats
-    
     async def get_user_usage(self, user_id: int) -> dict:
-        db = SessionLocal()
-        try:
-            sessions = db.query(DBSession).filter(
-                DBSession.user_id == user_id,
+        if self.sampler is not None:
+            usage = self.sampler.user_usage(user_id)
+            usage['storage_usage'] = await self.get_user_storage(user_id)
+            return usage
+        
+        async with AsyncSessionLocal() as db:
+            sessions = (await db.execute(select(DBSession).where(
+                DBSession.user_id == int(user_id),
                 DBSession.is_active == True
-            ).all()
-            
-            total_cpu = sum(s.cpu_usage for s in sessions)
-            total_memory = sum(s.memory_usage for s in sessions)
-            total_gpu = sum(s.gpu_usage for s in sessions)
-            storage = await self.get_user_storage(user_id)
-            
-            return {
-                'cpu_usage': total_cpu,
-                'memory_usage': total_memory,
-                'gpu_usage': total_gpu,
-                'storage_usage': storage
-            }
-        finally:
-            db.close()
+            ))).scalars().all()
+        
+        total_cpu = sum(s.cpu_usage for s in sessions)
+        total_memory = sum(s.memory_usage for s in sessions)
+        total_gpu = sum(s.gpu_usage for s in sessions)
+        storage = await self.get_user_storage(user_id)
+        
+        return {
+            'cpu_usage': total_cpu,
+            'memory_usage': total_memory,
+            'gpu_usage': total_gpu,
+            'storage_usage': storage
+        }
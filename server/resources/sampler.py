@@ -0,0 +1,230 @@
+import os
+import time
+import shutil
+import asyncio
+import logging
+import subprocess
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+import psutil
+from sqlalchemy import update
+from config import UsageSamplerConfig, settings
+from database import AsyncSessionLocal, Session as DBSession
+import metrics
+
+if TYPE_CHECKING:
+    from jupyter.manager import JupyterManager
+
+logger = logging.getLogger(__name__)
+
+USAGE_COLUMNS = ('cpu_usage', 'memory_usage', 'gpu_usage', 'storage_usage')
+
+# (kernel key, session id, user id, kernel pid, notebook file)
+KernelTarget = Tuple[str, int, str, int, str]
+
+class UsageSampler:
+    # Samples the CPU, memory, GPU memory and notebook size of every running
+    # kernel (including processes it spawned) every interval_seconds and
+    # writes them to the Session usage columns.
+    #
+    # One tick reads the process table once and walks each kernel's tree from
+    # that snapshot, so the cost grows with the number of processes on the
+    # host rather than with kernels x processes. psutil.Process objects are
+    # kept between ticks so cpu_percent() measures the interval since the
+    # previous tick without blocking. All sessions are written with a single
+    # executemany UPDATE.
+    def __init__(self, manager: 'JupyterManager', config: UsageSamplerConfig):
+        self.manager = manager
+        self.config = config
+        self.latest: Dict[str, dict] = {}
+        self.last_duration = 0.0
+        self._procs: Dict[int, psutil.Process] = {}
+        self._gpu_available = config.gpu_enabled and shutil.which('nvidia-smi') is not None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.config.interval_seconds)
+            try:
+                await self.sample()
+            except Exception as e:
+                logger.error(f"Kernel usage sampling failed: {e}", exc_info=True)
+
+    async def sample(self):
+        targets: List[KernelTarget] = [
+            (
+                key,
+                kernel.session_id,
+                kernel.user_id,
+                kernel.pid,
+                str(Path(settings.storage.notebooks_path) / kernel.user_id / kernel.notebook_path)
+            )
+            for key, kernel in self.manager.kernels.items()
+            if kernel.session_id is not None and kernel.pid is not None
+        ]
+
+        started = time.monotonic()
+        usage = await asyncio.to_thread(self._collect, targets)
+        sessions = {key: session_id for key, session_id, _, _, _ in targets}
+        # Kernels on worker agents are measured by the agent
+        for key, kernel in self.manager.kernels.items():
+            if kernel.session_id is None or kernel.worker is None:
+                continue
+            remote = self.manager.placement.kernel_usage(kernel.worker, kernel.kernel_id)
+            if remote is None:
+                continue
+            notebook_file = Path(settings.storage.notebooks_path) / kernel.user_id / kernel.notebook_path
+            try:
+                storage = notebook_file.stat().st_size / (1024 * 1024)
+            except OSError:
+                storage = 0.0
+            usage[key] = {
+                'user_id': kernel.user_id,
+                'cpu_usage': remote.get('cpu_usage', 0.0),
+                'memory_usage': remote.get('memory_usage', 0.0),
+                'gpu_usage': 0.0,
+                'storage_usage': storage
+            }
+            sessions[key] = kernel.session_id
+        if usage:
+            await self._flush([
+                {'id': sessions[key], **{column: value[column] for column in USAGE_COLUMNS}}
+                for key, value in usage.items()
+            ])
+        self.last_duration = time.monotonic() - started
+        # Kernels removed while the tick was running are not reported
+        self.latest = {key: value for key, value in usage.items() if key in self.manager.kernels}
+        if self.config.export_metrics:
+            metrics.report_user_usage(self._user_totals())
+
+    def forget(self, key: str):
+        self.latest.pop(key, None)
+
+    def user_usage(self, user_id: int) -> dict:
+        totals = {column: 0.0 for column in USAGE_COLUMNS}
+        for usage in self.latest.values():
+            if usage['user_id'] == str(user_id):
+                for column in USAGE_COLUMNS:
+                    totals[column] += usage[column]
+        return totals
+
+    def user_totals(self) -> Dict[str, Dict[str, float]]:
+        # Latest usage of every user with sampled kernels, by user id
+        totals: Dict[str, Dict[str, float]] = {}
+        for usage in self.latest.values():
+            user = totals.setdefault(usage['user_id'], {column: 0.0 for column in USAGE_COLUMNS})
+            for column in USAGE_COLUMNS:
+                user[column] += usage[column]
+        return totals
+
+    def _user_totals(self) -> Dict[str, Dict[str, float]]:
+        # cpu_usage -> cpu, the metric has a resource label
+        return {
+            user_id: {column[:-len('_usage')]: value for column, value in user.items()}
+            for user_id, user in self.user_totals().items()
+        }
+
+    def stats(self) -> dict:
+        return {
+            'kernels': len(self.latest),
+            'processes': len(self._procs),
+            'last_duration_ms': round(self.last_duration * 1000, 1),
+            'gpu': self._gpu_available
+        }
+
+    def _collect(self, targets: List[KernelTarget]) -> Dict[str, dict]:
+        if not targets:
+            self._procs = {}
+            return {}
+
+        children: Dict[int, List[int]] = {}
+        table: Dict[int, psutil.Process] = {}
+        for proc in psutil.process_iter(['ppid']):
+            table[proc.pid] = proc
+            children.setdefault(proc.info['ppid'], []).append(proc.pid)
+
+        gpu_memory = self._gpu_memory_by_pid() if self._gpu_available else {}
+
+        procs: Dict[int, psutil.Process] = {}
+        usage: Dict[str, dict] = {}
+        for key, _, user_id, pid, notebook_file in targets:
+            cpu = 0.0
+            rss = 0
+            gpu = 0.0
+            stack = [pid]
+            while stack:
+                current = stack.pop()
+                stack.extend(children.get(current, ()))
+                proc = table.get(current)
+                if proc is None:
+                    continue
+
+                # Reuse last tick's object so cpu_percent() has a baseline,
+                # unless the pid now belongs to a different process
+                cached = self._procs.get(current)
+                if cached is not None and cached == proc:
+                    proc = cached
+                procs[current] = proc
+                try:
+                    with proc.oneshot():
+                        cpu += proc.cpu_percent(None)
+                        rss += proc.memory_info().rss
+                except psutil.Error:
+                    continue
+                gpu += gpu_memory.get(current, 0.0)
+
+            try:
+                storage = os.stat(notebook_file).st_size / (1024 * 1024)
+            except OSError:
+                storage = 0.0
+
+            usage[key] = {
+                'user_id': user_id,
+                'cpu_usage': cpu,
+                'memory_usage': rss / (1024 * 1024),
+                'gpu_usage': gpu,
+                'storage_usage': storage
+            }
+
+        self._procs = procs
+        return usage
+
+    def _gpu_memory_by_pid(self) -> Dict[int, float]:
+        # One nvidia-smi call per tick for all processes, in MB
+        try:
+            result = subprocess.run(
+                ['nvidia-smi', '--query-compute-apps=pid,used_memory', '--format=csv,noheader,nounits'],
+                capture_output=True, text=True, timeout=5
+            )
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.warning(f"nvidia-smi failed: {e}")
+            return {}
+
+        memory: Dict[int, float] = {}
+        for line in result.stdout.splitlines():
+            try:
+                pid, used = (field.strip() for field in line.split(','))
+                memory[int(pid)] = memory.get(int(pid), 0.0) + float(used)
+            except ValueError:
+                continue
+        return memory
+
+    async def _flush(self, rows: List[dict]):
+        if not rows:
+            return
+        async with AsyncSessionLocal() as db:
+            await db.execute(update(DBSession), rows)
+            await db.commit()
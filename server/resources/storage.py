@@ -0,0 +1,92 @@
+import os
+import time
+import asyncio
+import logging
+from pathlib import Path
+from typing import Dict, Optional
+from config import StorageAccountingConfig, settings
+
+logger = logging.getLogger(__name__)
+
+def directory_size(path: Path) -> int:
+    total = 0
+    stack = [str(path)]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    continue
+    return total
+
+class StorageAccountant:
+    # Keeps a running byte total per user directory so the storage limit can
+    # be checked without walking the directory on every cell. Writes made
+    # by the server report their size change through record_write; files
+    # written by kernel code are picked up by a full rescan every
+    # reconcile_interval_seconds, which also corrects any drift.
+    def __init__(self, config: StorageAccountingConfig):
+        self.config = config
+        self.root = Path(settings.storage.notebooks_path)
+        self.last_reconcile_duration = 0.0
+        self._totals: Dict[str, int] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logger.error(f"Storage reconciliation failed: {e}", exc_info=True)
+            await asyncio.sleep(self.config.reconcile_interval_seconds)
+
+    async def usage_mb(self, user_id: int) -> float:
+        key = str(user_id)
+        if key not in self._totals:
+            # First check for this user before the background scan got to it
+            self._totals[key] = await asyncio.to_thread(directory_size, self.root / key)
+        return self._totals[key] / (1024 * 1024)
+
+    def record_write(self, user_id: int, delta_bytes: int):
+        key = str(user_id)
+        if key in self._totals:
+            self._totals[key] = max(self._totals[key] + delta_bytes, 0)
+
+    async def reconcile(self):
+        started = time.monotonic()
+        users = await asyncio.to_thread(
+            lambda: [entry.name for entry in os.scandir(self.root) if entry.is_dir()] if self.root.exists() else []
+        )
+        for user in users:
+            size = await asyncio.to_thread(directory_size, self.root / user)
+            if self._totals.get(user) not in (None, size):
+                logger.debug(f"Storage total for user {user} corrected to {size} bytes")
+            self._totals[user] = size
+        self.last_reconcile_duration = time.monotonic() - started
+
+    def stats(self) -> dict:
+        return {
+            'users': len(self._totals),
+            'last_reconcile_ms': round(self.last_reconcile_duration * 1000, 1)
+        }
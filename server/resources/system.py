@@ -0,0 +1,214 @@
+import time
+import shutil
+import asyncio
+import logging
+import subprocess
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, List, Optional, Tuple
+import psutil
+from config import SystemSamplerConfig, settings
+from resources.history import StatsHistory
+
+if TYPE_CHECKING:
+    from jupyter.manager import JupyterManager
+
+logger = logging.getLogger(__name__)
+
+# Per-user totals from another server worker are dropped after this many
+# intervals without an update
+REMOTE_EXPIRY_INTERVALS = 3
+
+class SystemSampler:
+    # Samples the host (CPU, memory, disk, GPUs) every interval_seconds and
+    # passes each sample, with the per-user usage from the UsageSampler, to
+    # on_sample (the admin room on Socket.IO). The last history_size samples
+    # are kept in ring buffers for admins that subscribe later.
+    #
+    # cpu_percent() is read without an interval, as the load since the
+    # previous tick, and all GPUs come from one nvidia-smi call; both run in
+    # a thread so the event loop never waits on them.
+    #
+    # With several server workers each one shares its users' totals over
+    # the cluster bus, so every worker has the full picture for the
+    # dashboards connected to it.
+    def __init__(self, manager: 'JupyterManager', config: SystemSamplerConfig):
+        self.manager = manager
+        self.config = config
+        self.latest: Optional[dict] = None
+        self.history = StatsHistory(config.history_size)
+        self.user_history: Dict[str, StatsHistory] = {}
+        # Returns whether the sample was sent to anyone
+        self.on_sample: Optional[Callable[[dict], Awaitable[bool]]] = None
+        self.last_duration = 0.0
+        self.published = 0
+        self._gpu_available = config.gpu_enabled and shutil.which('nvidia-smi') is not None
+        self._idle_ticks: Dict[str, int] = {}
+        self._remote: Dict[str, Tuple[float, Dict[str, dict]]] = {}
+        self._task: Optional[asyncio.Task] = None
+        manager.cluster.register('user_usage', self._receive_user_usage)
+
+    async def start(self):
+        if self._task is None:
+            psutil.cpu_percent(None)
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.config.interval_seconds)
+            try:
+                await self.sample()
+            except Exception as e:
+                logger.error(f"System sampling failed: {e}", exc_info=True)
+
+    async def sample(self) -> dict:
+        started = time.monotonic()
+        system = await asyncio.to_thread(self._collect)
+        local = self._local_users()
+        if self.manager.cluster.enabled:
+            await self.manager.cluster.broadcast('user_usage', {
+                'worker_id': self.manager.cluster.worker_id,
+                'users': local
+            })
+        users = self._merge_users(local)
+
+        timestamp = time.time()
+        self.history.append(timestamp, self._system_series(system))
+        self._record_users(timestamp, users)
+        self.latest = {'time': timestamp, 'system': system, 'users': users}
+        self.last_duration = time.monotonic() - started
+
+        if self.on_sample is not None and await self.on_sample(self.latest):
+            self.published += 1
+        return self.latest
+
+    def snapshot(self) -> dict:
+        # Everything an admin view needs to draw its charts
+        return {
+            'interval_seconds': self.config.interval_seconds,
+            'history_size': self.config.history_size,
+            'latest': self.latest,
+            'system': self.history.snapshot(),
+            'users': {user_id: history.snapshot() for user_id, history in self.user_history.items()}
+        }
+
+    def stats(self) -> dict:
+        return {
+            'samples': len(self.history),
+            'users': len(self.user_history),
+            'published': self.published,
+            'last_duration_ms': round(self.last_duration * 1000, 1),
+            'gpu': self._gpu_available
+        }
+
+    def _collect(self) -> dict:
+        memory = psutil.virtual_memory()
+        try:
+            disk = psutil.disk_usage(settings.storage.base_path)
+        except OSError:
+            disk = psutil.disk_usage('/')
+        return {
+            'cpu_percent': psutil.cpu_percent(None),
+            'cpu_count': psutil.cpu_count() or 1,
+            'memory_percent': memory.percent,
+            'memory_used_mb': (memory.total - memory.available) / (1024 * 1024),
+            'memory_total_mb': memory.total / (1024 * 1024),
+            'disk_percent': disk.percent,
+            'disk_used_mb': disk.used / (1024 * 1024),
+            'disk_total_mb': disk.total / (1024 * 1024),
+            'gpus': self._gpus() if self._gpu_available else []
+        }
+
+    def _gpus(self) -> List[dict]:
+        try:
+            result = subprocess.run(
+                ['nvidia-smi', '--query-gpu=index,name,utilization.gpu,memory.used,memory.total',
+                 '--format=csv,noheader,nounits'],
+                capture_output=True, text=True, timeout=5
+            )
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.warning(f"nvidia-smi failed: {e}")
+            return []
+
+        gpus = []
+        for line in result.stdout.splitlines():
+            try:
+                index, name, load, used, total = (field.strip() for field in line.split(','))
+                gpus.append({
+                    'index': int(index),
+                    'name': name,
+                    'load': float(load),
+                    'memory_used_mb': float(used),
+                    'memory_total_mb': float(total)
+                })
+            except ValueError:
+                continue
+        return gpus
+
+    @staticmethod
+    def _system_series(system: dict) -> Dict[str, float]:
+        series = {
+            'cpu_percent': system['cpu_percent'],
+            'memory_percent': system['memory_percent'],
+            'disk_percent': system['disk_percent']
+        }
+        for gpu in system['gpus']:
+            series[f"gpu{gpu['index']}_load"] = gpu['load']
+            series[f"gpu{gpu['index']}_memory_mb"] = gpu['memory_used_mb']
+        return series
+
+    def _local_users(self) -> Dict[str, dict]:
+        users = {
+            user_id: dict(usage, kernels=0)
+            for user_id, usage in self.manager.sampler.user_totals().items()
+        }
+        for kernel in self.manager.kernels.values():
+            if kernel.user_id is None:
+                continue
+            user = users.setdefault(kernel.user_id, {
+                'cpu_usage': 0.0, 'memory_usage': 0.0, 'gpu_usage': 0.0, 'storage_usage': 0.0, 'kernels': 0
+            })
+            user['kernels'] += 1
+        return users
+
+    def _merge_users(self, local: Dict[str, dict]) -> Dict[str, dict]:
+        if not self._remote:
+            return local
+        expiry = time.monotonic() - REMOTE_EXPIRY_INTERVALS * self.config.interval_seconds
+        users = {user_id: dict(usage) for user_id, usage in local.items()}
+        for worker_id, (received, remote) in list(self._remote.items()):
+            if received < expiry:
+                del self._remote[worker_id]
+                continue
+            for user_id, usage in remote.items():
+                user = users.setdefault(user_id, {name: 0 for name in usage})
+                for name, value in usage.items():
+                    user[name] = user.get(name, 0) + value
+        return users
+
+    def _record_users(self, timestamp: float, users: Dict[str, dict]):
+        for user_id, usage in users.items():
+            history = self.user_history.get(user_id)
+            if history is None:
+                history = self.user_history[user_id] = StatsHistory(self.config.history_size)
+            history.append(timestamp, {name: usage[name] for name in ('cpu_usage', 'memory_usage', 'gpu_usage')})
+            self._idle_ticks[user_id] = 0
+        # A user without kernels keeps a flat line until it has scrolled out
+        for user_id in list(self.user_history):
+            if user_id in users:
+                continue
+            self.user_history[user_id].append(timestamp, {})
+            self._idle_ticks[user_id] = self._idle_ticks.get(user_id, 0) + 1
+            if self._idle_ticks[user_id] >= self.config.history_size:
+                del self.user_history[user_id]
+                del self._idle_ticks[user_id]
+
+    async def _receive_user_usage(self, payload: dict):
+        self._remote[payload['worker_id']] = (time.monotonic(), payload['users'])
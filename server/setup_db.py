@@ -1,9 +1,10 @@
-from database import engine, Base, SessionLocal, User, ResourceLimit
+from database import engine, Base, SessionLocal, add_missing_columns, User, ResourceLimit
 from config import settings
 
 def setup_database():
     print("Creating database tables...")
     Base.metadata.create_all(bind=engine)
+    add_missing_columns(engine)
     
     db = SessionLocal()
     try:
@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# Modules under server/ import each other as top-level packages
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# The database and storage paths in config.yaml are relative to the working
+# directory, so the tests run in a scratch directory of their own
+os.chdir(tempfile.mkdtemp(prefix='jupyter-tests-'))
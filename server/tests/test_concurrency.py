@@ -0,0 +1,30 @@
+import asyncio
+import time
+from database import Base, async_engine, engine
+from jupyter.manager import JupyterManager
+
+def test_cells_on_different_kernels_overlap():
+    # Two cells sleeping 2s on two kernels finish together, not one after
+    # the other
+    Base.metadata.create_all(bind=engine)
+
+    async def run():
+        manager = JupyterManager()
+        try:
+            await asyncio.gather(
+                manager.get_or_create_kernel(1, 'a.ipynb'),
+                manager.get_or_create_kernel(1, 'b.ipynb')
+            )
+            started = time.monotonic()
+            results = await asyncio.gather(
+                manager.execute_code(1, 'a.ipynb', 'import time; time.sleep(2)', 'a'),
+                manager.execute_code(1, 'b.ipynb', 'import time; time.sleep(2)', 'b')
+            )
+            return results, time.monotonic() - started
+        finally:
+            await manager.shutdown()
+            await async_engine.dispose()
+
+    results, elapsed = asyncio.run(run())
+    assert [result['status'] for result in results] == ['ok', 'ok']
+    assert elapsed < 3.5
@@ -0,0 +1,49 @@
+from resources.history import RingBuffer, StatsHistory
+
+def test_ring_buffer_keeps_the_last_values_oldest_first():
+    ring = RingBuffer(3)
+    assert len(ring) == 0
+    assert ring.last() is None
+    assert ring.values() == []
+
+    ring.append(1)
+    ring.append(2)
+    assert ring.values() == [1.0, 2.0]
+    assert ring.last() == 2.0
+
+    for value in range(3, 8):
+        ring.append(value)
+    assert len(ring) == 3
+    assert ring.values() == [5.0, 6.0, 7.0]
+    assert ring.last() == 7.0
+
+def test_ring_buffer_wraps_at_every_position():
+    ring = RingBuffer(4)
+    for value in range(1, 20):
+        ring.append(value)
+        assert ring.values() == [float(v) for v in range(max(1, value - 3), value + 1)]
+
+def test_ring_buffer_storage_does_not_grow():
+    ring = RingBuffer(5)
+    for value in range(1000):
+        ring.append(value)
+    assert len(ring._values) == 5
+    assert ring._values.typecode == 'd'
+
+def test_history_pads_series_to_the_timestamps():
+    history = StatsHistory(4)
+    history.append(1, {'cpu': 10})
+    history.append(2, {'cpu': 20, 'gpu0': 5})
+    history.append(3, {})
+    assert len(history) == 3
+    assert history.snapshot() == {
+        'times': [1.0, 2.0, 3.0],
+        'series': {'cpu': [10.0, 20.0, 0.0], 'gpu0': [0.0, 5.0, 0.0]}
+    }
+
+    for timestamp in range(4, 7):
+        history.append(timestamp, {'cpu': timestamp * 10})
+    snapshot = history.snapshot()
+    assert snapshot['times'] == [3.0, 4.0, 5.0, 6.0]
+    assert snapshot['series']['cpu'] == [0.0, 40.0, 50.0, 60.0]
+    assert all(len(values) == 4 for values in snapshot['series'].values())
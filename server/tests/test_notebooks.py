@@ -0,0 +1,93 @@
+import asyncio
+import nbformat
+import pytest
+from config import NotebookIndexConfig, NotebookSaveConfig, StorageAccountingConfig
+from jupyter.notebook_index import NotebookIndex
+from jupyter.notebooks import NotebookPatchError, NotebookStore
+from resources.storage import StorageAccountant
+
+def new_store() -> NotebookStore:
+    # A long debounce, the tests flush explicitly
+    return NotebookStore(
+        StorageAccountant(StorageAccountingConfig()),
+        NotebookIndex(NotebookIndexConfig()),
+        NotebookSaveConfig(debounce_ms=60_000)
+    )
+
+def code_cell(cell_id: str, source: str) -> dict:
+    return {'id': cell_id, 'cell_type': 'code', 'source': source}
+
+def sources(notebook) -> list:
+    return [(cell.id, cell.source) for cell in notebook.cells]
+
+def test_patches_and_atomic_write():
+    async def run():
+        store = new_store()
+        await store.apply_patch(1, 'patch.ipynb', [
+            {'op': 'insert', 'cell': code_cell('a', 'x = 1')},
+            {'op': 'insert', 'cell': code_cell('b', 'y = 2')},
+            {'op': 'insert', 'cell': code_cell('c', 'z = 3'), 'index': 0}
+        ])
+        version = await store.apply_patch(1, 'patch.ipynb', [
+            {'op': 'update', 'id': 'a', 'source': 'x = 10', 'execution_count': 4,
+             'outputs': [{'output_type': 'stream', 'name': 'stdout', 'text': 'hi\n'}]},
+            {'op': 'move', 'id': 'c', 'index': 2},
+            {'op': 'delete', 'id': 'b'}
+        ])
+        notebook = await store.open(1, 'patch.ipynb')
+        path = await store.current_path(1, 'patch.ipynb')
+        return version, notebook, path
+
+    version, notebook, path = asyncio.run(run())
+    assert version == 2
+    assert not notebook.dirty
+    assert sources(notebook.notebook) == [('a', 'x = 10'), ('c', 'z = 3')]
+
+    saved = nbformat.read(str(path), as_version=4)
+    assert sources(saved) == [('a', 'x = 10'), ('c', 'z = 3')]
+    assert saved.cells[0].execution_count == 4
+    assert saved.cells[0].outputs[0].text == 'hi\n'
+    # The temporary file was renamed over the notebook
+    assert [p.name for p in path.parent.iterdir() if p.name.startswith('.patch.ipynb.')] == []
+
+def test_bad_patch_leaves_model_untouched():
+    async def run():
+        store = new_store()
+        await store.apply_patch(1, 'bad.ipynb', [{'op': 'insert', 'cell': code_cell('a', 'x = 1')}])
+        errors = []
+        for ops in (
+            [{'op': 'update', 'id': 'a', 'source': 'changed'}, {'op': 'delete', 'id': 'missing'}],
+            [{'op': 'insert', 'cell': code_cell('a', 'again')}],
+            [{'op': 'frobnicate', 'id': 'a'}]
+        ):
+            with pytest.raises(NotebookPatchError) as e:
+                await store.apply_patch(1, 'bad.ipynb', ops)
+            errors.append(str(e.value))
+        notebook = await store.open(1, 'bad.ipynb')
+        return errors, notebook
+
+    errors, notebook = asyncio.run(run())
+    assert errors == ['Unknown cell id: missing', 'Duplicate cell id: a', 'Unknown patch op: frobnicate']
+    assert sources(notebook.notebook) == [('a', 'x = 1')]
+    assert notebook.version == 1
+
+def test_paths_stay_in_the_user_directory():
+    store = new_store()
+    for name in ('', '../2/other.ipynb', '/etc/passwd'):
+        with pytest.raises(NotebookPatchError):
+            store.resolve(1, name)
+    assert store.resolve(1, 'sub/ok.ipynb').name == 'ok.ipynb'
+
+def test_old_notebooks_get_cell_ids():
+    # Patches address cells by id, which nbformat 4.4 does not have
+    store = new_store()
+    path = store.resolve(1, 'old.ipynb')
+    path.parent.mkdir(parents=True, exist_ok=True)
+    old = nbformat.v4.new_notebook(cells=[nbformat.v4.new_code_cell('print(1)')])
+    old.nbformat_minor = 4
+    del old.cells[0]['id']
+    path.write_text(nbformat.writes(old, version=4), encoding='utf-8')
+
+    notebook = asyncio.run(store.open(1, 'old.ipynb'))
+    assert notebook.notebook.nbformat_minor == 5
+    assert notebook.notebook.cells[0].get('id')
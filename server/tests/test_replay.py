@@ -0,0 +1,73 @@
+from config import ReplayConfig
+from jupyter.replay import EVENT_OVERHEAD_BYTES, ReplayBuffer, ReplayStore, event_size
+
+def started(cell_id: str) -> dict:
+    return {'cell_id': cell_id}
+
+def chunk(cell_id: str, text: str) -> dict:
+    return {'cell_id': cell_id, 'outputs': [{'output_type': 'stream', 'name': 'stdout', 'text': text}]}
+
+def test_events_are_numbered_and_replayed_after_a_seq():
+    buffer = ReplayBuffer('1:a.ipynb', 'a.ipynb', ReplayConfig())
+    sent = [buffer.append('cell_started', started(f'c{n}')) for n in range(3)]
+    assert [data['kernel_seq'] for data in sent] == [1, 2, 3]
+    assert sent[0]['notebook_path'] == 'a.ipynb'
+
+    events, missed = buffer.since(1)
+    assert [data['kernel_seq'] for _, data in events] == [2, 3]
+    assert not missed
+    assert buffer.since(3) == ([], False)
+    # A client that has seen nothing to replay gets nothing
+    assert buffer.since(None) == ([], False)
+
+def test_oldest_events_go_first_past_max_events():
+    buffer = ReplayBuffer('1:a.ipynb', 'a.ipynb', ReplayConfig(max_events=3))
+    for n in range(5):
+        buffer.append('cell_started', started(f'c{n}'))
+    assert len(buffer) == 3
+
+    events, missed = buffer.since(0)
+    assert [data['cell_id'] for _, data in events] == ['c2', 'c3', 'c4']
+    assert missed
+    events, missed = buffer.since(2)
+    assert [data['cell_id'] for _, data in events] == ['c2', 'c3', 'c4']
+    assert not missed
+
+def test_max_bytes_evicts_but_keeps_the_latest_event():
+    text = 'x' * 1000
+    size = event_size(chunk('c', text))
+    assert size > EVENT_OVERHEAD_BYTES
+    buffer = ReplayBuffer('1:a.ipynb', 'a.ipynb', ReplayConfig(max_bytes=size * 2))
+    for n in range(4):
+        buffer.append('cell_output_chunk', chunk(f'c{n}', text))
+    assert len(buffer) == 2
+    assert buffer.bytes <= size * 2
+
+    # An event larger than the whole budget is still kept on its own
+    buffer.append('cell_output_chunk', chunk('big', text * 10))
+    assert len(buffer) == 1
+    assert buffer.since(0)[0][0][1]['cell_id'] == 'big'
+
+def test_seq_from_an_earlier_buffer_replays_everything():
+    # e.g. after a server restart the client's last seq is from a buffer
+    # that no longer exists
+    buffer = ReplayBuffer('1:a.ipynb', 'a.ipynb', ReplayConfig())
+    buffer.append('cell_started', started('c0'))
+    events, missed = buffer.since(50)
+    assert [data['cell_id'] for _, data in events] == ['c0']
+    assert not missed
+
+def test_store_subscribe_and_detach():
+    store = ReplayStore(ReplayConfig())
+    buffer = store.subscribe('1:a.ipynb', 'a.ipynb', 'sid-1')
+    assert buffer.sid == 'sid-1'
+    assert store.subscribe('1:a.ipynb', 'a.ipynb', 'sid-2') is buffer
+    assert buffer.sid == 'sid-2'
+
+    store.detach('sid-2')
+    assert buffer.sid is None
+    buffer.append('cell_started', started('c0'))
+    assert store.stats()['events'] == 1
+
+    store.forget('1:a.ipynb')
+    assert store.stats()['kernels'] == 0
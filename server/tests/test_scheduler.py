@@ -0,0 +1,101 @@
+import asyncio
+import pytest
+from config import SchedulerConfig
+from jupyter.scheduler import ExecutionCancelled, ExecutionScheduler
+
+async def run_with_one_slot(requests):
+    # Submits (user_id, kernel_key, weight) requests while a first request
+    # holds the only slot, then returns the order they ran in
+    scheduler = ExecutionScheduler(SchedulerConfig(max_concurrent_executions=1))
+    gate = asyncio.Event()
+    order = []
+
+    async def record(name):
+        order.append(name)
+
+    blocker = asyncio.create_task(scheduler.submit('blocker', 'blocker', 100, gate.wait))
+    await asyncio.sleep(0)
+    submitted = [
+        asyncio.create_task(scheduler.submit(user_id, key, weight, lambda key=key: record(key)))
+        for user_id, key, weight in requests
+    ]
+    await asyncio.sleep(0)
+    gate.set()
+    await asyncio.gather(blocker, *submitted)
+    return order
+
+def test_slots_follow_cpu_weight():
+    # Twice the weight, twice the turns while both users are waiting
+    requests = []
+    for n in range(6):
+        requests.append(('a', f'a{n}', 200))
+        requests.append(('b', f'b{n}', 100))
+    order = asyncio.run(run_with_one_slot(requests))
+    assert sum(key.startswith('a') for key in order[:9]) == 6
+    # Each user's cells on their own kernels still run in submission order
+    assert [key for key in order if key.startswith('a')] == [f'a{n}' for n in range(6)]
+
+def test_equal_weights_alternate():
+    requests = []
+    for n in range(3):
+        requests.append(('a', f'a{n}', 100))
+        requests.append(('b', f'b{n}', 100))
+    order = asyncio.run(run_with_one_slot(requests))
+    assert order == ['a0', 'b0', 'a1', 'b1', 'a2', 'b2']
+
+def test_queue_positions_on_one_kernel():
+    async def run():
+        scheduler = ExecutionScheduler(SchedulerConfig(max_concurrent_executions=4))
+        gate = asyncio.Event()
+        positions = {'second': [], 'third': []}
+
+        def on_queued(name):
+            async def notify(position, queue_depth):
+                positions[name].append((position, queue_depth))
+            return notify
+
+        async def noop():
+            pass
+
+        first = asyncio.create_task(scheduler.submit('u', 'k', 100, gate.wait))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(scheduler.submit('u', 'k', 100, noop, on_queued=on_queued('second')))
+        await asyncio.sleep(0)
+        third = asyncio.create_task(scheduler.submit('u', 'k', 100, noop, on_queued=on_queued('third')))
+        await asyncio.sleep(0.01)
+        assert scheduler.stats()['queued_kernels'] == {'k': 2}
+        gate.set()
+        await asyncio.gather(first, second, third)
+        await asyncio.sleep(0.01)
+        return positions
+
+    positions = asyncio.run(run())
+    assert positions['second'][0] == (1, 1)
+    # Moves up once the first cell is done and the second one starts
+    assert positions['third'][0] == (2, 2)
+    assert positions['third'][-1] == (1, 1)
+
+def test_cancel_drops_queued_request():
+    async def run():
+        scheduler = ExecutionScheduler(SchedulerConfig(max_concurrent_executions=1))
+        gate = asyncio.Event()
+        ran = []
+
+        async def record():
+            ran.append('queued')
+
+        first = asyncio.create_task(scheduler.submit('u', 'k', 100, gate.wait, cell_ids=['c1']))
+        await asyncio.sleep(0)
+        queued = asyncio.create_task(scheduler.submit('u', 'k', 100, record, cell_ids=['c2', 'c3']))
+        await asyncio.sleep(0)
+        assert not scheduler.cancel('k', 'c1')
+        assert scheduler.cancel('k', 'c3')
+        gate.set()
+        await first
+        with pytest.raises(ExecutionCancelled):
+            await queued
+        return ran, scheduler.stats()
+
+    ran, stats = asyncio.run(run())
+    assert ran == []
+    assert stats['running'] == 0 and stats['queue_depth'] == 0
@@ -0,0 +1,63 @@
+import asyncio
+from config import OutputSpillConfig
+from jupyter.spill import OutputSpillStore
+
+def stream(text: str) -> dict:
+    return {'output_type': 'stream', 'name': 'stdout', 'text': text}
+
+async def spill_cell(store: OutputSpillStore, chunks):
+    cell = store.open_cell('1', 7)
+    passed = [await cell.feed(stream(chunk)) for chunk in chunks]
+    return passed, await cell.finish()
+
+def test_small_output_is_not_spilled():
+    store = OutputSpillStore(OutputSpillConfig(threshold_bytes=100, tail_bytes=10))
+    store.start()
+    passed, info = asyncio.run(spill_cell(store, ['abc', 'def']))
+    assert [item['text'] for item in passed] == ['abc', 'def']
+    assert info is None
+
+def test_threshold_and_offsets_count_bytes():
+    store = OutputSpillStore(OutputSpillConfig(threshold_bytes=10, tail_bytes=7))
+    store.start()
+    # 2 + 9 + 9 + 6 bytes, the threshold falls inside the second chunk
+    passed, info = asyncio.run(spill_cell(store, ['ab', 'あいう', 'えおか', 'きく']))
+
+    assert [item and item['text'] for item in passed] == ['ab', 'あい', None, None]
+    assert info['head_bytes'] == len('abあい'.encode('utf-8'))
+    assert info['total_bytes'] == len('abあいうえおかきく'.encode('utf-8'))
+    # The tail is cut at a whole character
+    assert info['tail'] == 'きく'
+    assert info['tail_offset'] == info['total_bytes'] - len('きく'.encode('utf-8'))
+
+def test_pages_cover_the_whole_output():
+    store = OutputSpillStore(OutputSpillConfig(threshold_bytes=8, tail_bytes=16, max_page_bytes=7))
+    store.start()
+    text = ''.join(f'{n} ü\n' for n in range(50))
+    _, info = asyncio.run(spill_cell(store, [text]))
+    spilled = store.get(info['handle'], 1)
+
+    pages = []
+    offset = 0
+    while True:
+        page = store.read(spilled, offset, 1000)
+        assert len(page['text'].encode('utf-8')) <= 7
+        pages.append(page['text'])
+        offset = page['next_offset']
+        if page['eof']:
+            break
+    # No page splits a multi-byte character, together they are the text
+    assert ''.join(pages) == text
+    assert offset == info['total_bytes']
+
+def test_outputs_are_per_user_and_session():
+    store = OutputSpillStore(OutputSpillConfig(threshold_bytes=1, tail_bytes=4))
+    store.start()
+    _, info = asyncio.run(spill_cell(store, ['hello world']))
+    assert store.get(info['handle'], 2) is None
+    assert store.get('../' + info['handle'], 1) is None
+
+    spilled = store.get(info['handle'], 1)
+    store.release_session('1', 7)
+    assert store.get(info['handle'], 1) is None
+    assert not spilled.path.exists()
@@ -0,0 +1,242 @@
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import contextvars
+from collections import deque
+from pathlib import Path
+from typing import Any, Deque, Dict, List, NamedTuple, Optional
+import httpx
+from config import TracingConfig, settings
+
+logger = logging.getLogger(__name__)
+
+class SpanContext(NamedTuple):
+    # What a child span needs from its parent. Plain tuple so it can travel
+    # in cluster payloads.
+    trace_id: str
+    span_id: str
+    sampled: bool = True
+
+# Parent for spans that are not sampled, so their children are not either
+UNSAMPLED = SpanContext('', '', False)
+
+_current: contextvars.ContextVar[Optional[SpanContext]] = contextvars.ContextVar('current_span', default=None)
+
+class Span:
+    def __init__(self, tracer: 'Tracer', name: str, parent: Optional[SpanContext], attributes: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.context = SpanContext(parent.trace_id if parent else os.urandom(16).hex(), os.urandom(8).hex())
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[str] = None
+        self._token: Optional[contextvars.Token] = None
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def __enter__(self) -> 'Span':
+        self._token = _current.set(self.context)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current.reset(self._token)
+        if exc is not None and not isinstance(exc, asyncio.CancelledError):
+            self.error = f'{exc_type.__name__}: {exc}'
+        self.end_ns = time.time_ns()
+        self.tracer.export(self)
+        return False
+
+    def to_dict(self) -> dict:
+        return {
+            'trace_id': self.context.trace_id,
+            'span_id': self.context.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start_unix_nano': self.start_ns,
+            'end_unix_nano': self.end_ns,
+            'duration_ms': round((self.end_ns - self.start_ns) / 1e6, 3),
+            'error': self.error,
+            'attributes': self.attributes
+        }
+
+class _NoopSpan:
+    # Stands in for a span that is not recorded. With a context it becomes
+    # the current span, so children of an unsampled span are skipped too.
+    def __init__(self, context: Optional[SpanContext] = None):
+        self.context = context
+        self._token: Optional[contextvars.Token] = None
+
+    def set_attribute(self, key: str, value: Any):
+        pass
+
+    def __enter__(self) -> '_NoopSpan':
+        if self.context is not None:
+            self._token = _current.set(self.context)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._token is not None:
+            _current.reset(self._token)
+        return False
+
+_DISABLED = _NoopSpan()
+
+class Tracer:
+    # Span-based tracing of the cell execution path. Spans nest through a
+    # context variable, so a span opened while another one is current (in
+    # the same task or a task created under it) becomes its child; code that
+    # hands work to another task or server worker passes current() along
+    # and opens its span with that as the parent.
+    #
+    # Finished spans are queued in memory and written out every
+    # flush_interval_seconds by a background task, to a JSON-lines file or
+    # as OTLP/HTTP JSON to a collector (Jaeger, Tempo, the OpenTelemetry
+    # collector). With tracing disabled span() returns a shared no-op
+    # object. sample_rate is applied per trace, at its root span.
+    def __init__(self, config: TracingConfig):
+        self.config = config
+        self.enabled = config.enabled
+        self.file_path = Path(config.file_path or Path(settings.storage.base_path) / 'traces.jsonl')
+        self.exported = 0
+        self.dropped = 0
+        self._queue: Deque[Span] = deque()
+        self._client: Optional[httpx.AsyncClient] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def span(self, name: str, parent: Optional[SpanContext] = None, **attributes):
+        if not self.enabled:
+            return _DISABLED
+        if parent is None:
+            parent = _current.get()
+        if parent is None:
+            if random.random() >= self.config.sample_rate:
+                return _NoopSpan(UNSAMPLED)
+        elif not parent.sampled:
+            return _NoopSpan(UNSAMPLED)
+        return Span(self, name, parent, attributes)
+
+    def record(self, name: str, start_ns: int, end_ns: int, parent: Optional[SpanContext] = None, **attributes):
+        # A span for something that has already happened, e.g. time spent
+        # waiting in a queue
+        span = self.span(name, parent, **attributes)
+        if isinstance(span, Span):
+            span.start_ns = start_ns
+            span.end_ns = end_ns
+            self.export(span)
+
+    def current(self) -> Optional[SpanContext]:
+        return _current.get() if self.enabled else None
+
+    def export(self, span: Span):
+        if len(self._queue) >= self.config.max_queued_spans:
+            self.dropped += 1
+            return
+        self._queue.append(span)
+
+    async def start(self):
+        if not self.enabled or self._task is not None:
+            return
+        if self.config.exporter == 'otlp':
+            self._client = httpx.AsyncClient(timeout=10)
+        else:
+            self.file_path.parent.mkdir(parents=True, exist_ok=True)
+        self._task = asyncio.create_task(self._loop())
+        logger.info(f"Tracing enabled, exporting to {self._destination()}")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await self.flush()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'destination': self._destination() if self.enabled else None,
+            'exported': self.exported,
+            'dropped': self.dropped,
+            'queued': len(self._queue)
+        }
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.config.flush_interval_seconds)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Failed to export spans: {e}", exc_info=True)
+
+    async def flush(self):
+        spans = list(self._queue)
+        self._queue.clear()
+        if not spans:
+            return
+        if self.config.exporter == 'otlp':
+            response = await self._client.post(self.config.otlp_endpoint, json=self._otlp(spans))
+            response.raise_for_status()
+        else:
+            lines = ''.join(json.dumps(span.to_dict(), default=str) + '\n' for span in spans)
+            await asyncio.to_thread(self._append, lines)
+        self.exported += len(spans)
+
+    def _append(self, lines: str):
+        # One write per batch, O_APPEND keeps batches of several server
+        # workers from interleaving
+        with open(self.file_path, 'a', encoding='utf-8') as f:
+            f.write(lines)
+
+    def _destination(self) -> str:
+        return self.config.otlp_endpoint if self.config.exporter == 'otlp' else str(self.file_path)
+
+    def _otlp(self, spans: List[Span]) -> dict:
+        return {
+            'resourceSpans': [{
+                'resource': {'attributes': [_otlp_attribute('service.name', self.config.service_name)]},
+                'scopeSpans': [{
+                    'scope': {'name': 'distributed-jupyter'},
+                    'spans': [
+                        {
+                            'traceId': span.context.trace_id,
+                            'spanId': span.context.span_id,
+                            'parentSpanId': span.parent_id or '',
+                            'name': span.name,
+                            # SPAN_KIND_INTERNAL
+                            'kind': 1,
+                            'startTimeUnixNano': str(span.start_ns),
+                            'endTimeUnixNano': str(span.end_ns),
+                            'attributes': [_otlp_attribute(key, value) for key, value in span.attributes.items()],
+                            # STATUS_CODE_ERROR / STATUS_CODE_UNSET
+                            'status': {'code': 2, 'message': span.error} if span.error else {'code': 0}
+                        }
+                        for span in spans
+                    ]
+                }]
+            }]
+        }
+
+def _otlp_attribute(key: str, value: Any) -> dict:
+    if isinstance(value, bool):
+        typed = {'boolValue': value}
+    elif isinstance(value, int):
+        typed = {'intValue': str(value)}
+    elif isinstance(value, float):
+        typed = {'doubleValue': value}
+    else:
+        typed = {'stringValue': str(value)}
+    return {'key': key, 'value': typed}
+
+tracer = Tracer(settings.tracing)
@@ -0,0 +1,273 @@
+import os
+import hmac
+import socket
+import asyncio
+import logging
+import argparse
+from typing import Dict, Optional, Tuple
+import psutil
+import uvicorn
+from fastapi import FastAPI, Header, HTTPException, Depends
+from contextlib import asynccontextmanager
+from pydantic import BaseModel
+from config import settings
+from jupyter.kernel import IsolatedKernelManager
+from resources.isolation import KernelIsolator
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger('worker.agent')
+
+class KernelStartRequest(BaseModel):
+    kernel_name: str = 'python3'
+    user_id: str
+    cpu_percent: int
+    memory_mb: int
+
+class LimitsUpdate(BaseModel):
+    cpu_percent: int
+    memory_mb: int
+
+class WorkerAgent:
+    # Launches kernels on this host for the JupyterManager on the server.
+    # The server connects to the kernels' ZMQ ports directly with the
+    # connection info returned here; the agent only starts, stops and
+    # limits them, and reports how much of the host is free.
+    #
+    # Kernels listen on advertise_host, which must be reachable from the
+    # server. Usage of each kernel's process tree is sampled by the status
+    # loop so /status never blocks on cpu_percent().
+    def __init__(self, name: str, advertise_host: str, isolator: KernelIsolator):
+        self.name = name
+        self.advertise_host = advertise_host
+        self.isolator = isolator
+        self.kernels: Dict[str, IsolatedKernelManager] = {}
+        self.owners: Dict[str, str] = {}
+        # Last limits of each user, for kernels restarted later
+        self.limits: Dict[str, Tuple[int, int]] = {}
+        self.usage: Dict[str, dict] = {}
+        self.cpu_percent = 0.0
+        self._procs: Dict[int, psutil.Process] = {}
+        self._task: Optional[asyncio.Task] = None
+        psutil.cpu_percent(None)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for kernel_id in list(self.kernels):
+            await self.shutdown_kernel(kernel_id)
+
+    async def start_kernel(self, request: KernelStartRequest) -> dict:
+        km = IsolatedKernelManager(kernel_name=request.kernel_name)
+        km.isolator = self.isolator
+        km.ip = self.advertise_host
+        await km.start_kernel()
+        kernel_id = km.kernel_id
+        self.kernels[kernel_id] = km
+        self.owners[kernel_id] = request.user_id
+        self.limits[request.user_id] = (request.cpu_percent, request.memory_mb)
+        self.isolator.assign(
+            kernel_id,
+            getattr(km.provisioner, 'pid', None),
+            request.user_id,
+            request.cpu_percent,
+            request.memory_mb
+        )
+        logger.info(f"Kernel {kernel_id} started for user {request.user_id}")
+        return {'kernel_id': kernel_id, 'connection_info': self._connection_info(km)}
+
+    async def restart_kernel(self, kernel_id: str) -> dict:
+        km = self.kernels[kernel_id]
+        await km.restart_kernel(now=True)
+        user_id = self.owners[kernel_id]
+        cpu_percent, memory_mb = self.limits[user_id]
+        # The new process starts outside the user's group
+        self.isolator.assign(kernel_id, getattr(km.provisioner, 'pid', None), user_id, cpu_percent, memory_mb)
+        logger.info(f"Kernel {kernel_id} restarted")
+        return {'kernel_id': kernel_id, 'connection_info': self._connection_info(km)}
+
+    @staticmethod
+    def _connection_info(km: IsolatedKernelManager) -> dict:
+        info = km.get_connection_info(session=False)
+        # bytes are not JSON serializable
+        info['key'] = info['key'].decode('ascii') if isinstance(info['key'], bytes) else info['key']
+        return info
+
+    async def shutdown_kernel(self, kernel_id: str):
+        km = self.kernels.pop(kernel_id, None)
+        self.owners.pop(kernel_id, None)
+        self.usage.pop(kernel_id, None)
+        if km is None:
+            return
+        try:
+            await km.shutdown_kernel(now=True)
+        except Exception as e:
+            logger.warning(f"Failed to shut down kernel {kernel_id}: {e}")
+        self.isolator.release(kernel_id)
+        logger.info(f"Kernel {kernel_id} stopped")
+
+    def update_user_limits(self, user_id: str, cpu_percent: int, memory_mb: int):
+        self.limits[user_id] = (cpu_percent, memory_mb)
+        pids = [
+            pid for kernel_id, pid in self._pids().items()
+            if self.owners.get(kernel_id) == user_id
+        ]
+        self.isolator.update_user_limits(user_id, cpu_percent, memory_mb, pids)
+
+    def status(self) -> dict:
+        memory = psutil.virtual_memory()
+        return {
+            'name': self.name,
+            'cpu_count': psutil.cpu_count() or 1,
+            'cpu_percent': self.cpu_percent,
+            'memory_total_mb': memory.total / (1024 * 1024),
+            'memory_available_mb': memory.available / (1024 * 1024),
+            'kernels': {
+                kernel_id: {'user_id': self.owners.get(kernel_id), **self.usage.get(kernel_id, {})}
+                for kernel_id in self.kernels
+            }
+        }
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(settings.placement.poll_interval_seconds)
+            try:
+                self.cpu_percent = psutil.cpu_percent(None)
+                self.usage = await asyncio.to_thread(self._collect, self._pids())
+            except Exception as e:
+                logger.error(f"Kernel usage sampling failed: {e}", exc_info=True)
+
+    def _pids(self) -> Dict[str, int]:
+        return {
+            kernel_id: km.provisioner.pid
+            for kernel_id, km in self.kernels.items()
+            if getattr(km.provisioner, 'pid', None) is not None
+        }
+
+    def _collect(self, pids: Dict[str, int]) -> Dict[str, dict]:
+        procs: Dict[int, psutil.Process] = {}
+        usage: Dict[str, dict] = {}
+        for kernel_id, pid in pids.items():
+            cpu = 0.0
+            rss = 0
+            try:
+                tree = [psutil.Process(pid)]
+                tree += tree[0].children(recursive=True)
+            except psutil.Error:
+                continue
+            for proc in tree:
+                cached = self._procs.get(proc.pid)
+                if cached is not None and cached == proc:
+                    proc = cached
+                procs[proc.pid] = proc
+                try:
+                    with proc.oneshot():
+                        cpu += proc.cpu_percent(None)
+                        rss += proc.memory_info().rss
+                except psutil.Error:
+                    continue
+            usage[kernel_id] = {'cpu_usage': cpu, 'memory_usage': rss / (1024 * 1024)}
+        self._procs = procs
+        return usage
+
+def create_app(agent: WorkerAgent, token: str) -> FastAPI:
+    # POST /kernels hands out connection info with the kernel's HMAC key,
+    # so every request has to carry the token shared with the server
+    if not token:
+        raise ValueError("The worker agent needs a token")
+
+    def check_token(x_worker_token: Optional[str] = Header(None)):
+        if x_worker_token is None or not hmac.compare_digest(x_worker_token, token):
+            raise HTTPException(status_code=401, detail="Invalid worker token")
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        await agent.start()
+        yield
+        await agent.stop()
+
+    app = FastAPI(title="Distributed Jupyter Worker", lifespan=lifespan, dependencies=[Depends(check_token)])
+
+    @app.get("/status")
+    async def get_status():
+        return agent.status()
+
+    @app.post("/kernels")
+    async def start_kernel(request: KernelStartRequest):
+        try:
+            return await agent.start_kernel(request)
+        except Exception as e:
+            logger.error(f"Failed to start kernel: {e}", exc_info=True)
+            raise HTTPException(status_code=500, detail=str(e))
+
+    @app.get("/kernels/{kernel_id}")
+    async def kernel_status(kernel_id: str):
+        km = agent.kernels.get(kernel_id)
+        if km is None:
+            raise HTTPException(status_code=404, detail="Kernel not found")
+        return {'kernel_id': kernel_id, 'alive': await km.is_alive()}
+
+    @app.post("/kernels/{kernel_id}/interrupt")
+    async def interrupt_kernel(kernel_id: str):
+        km = agent.kernels.get(kernel_id)
+        if km is None:
+            raise HTTPException(status_code=404, detail="Kernel not found")
+        await km.interrupt_kernel()
+        return {'kernel_id': kernel_id}
+
+    @app.post("/kernels/{kernel_id}/restart")
+    async def restart_kernel(kernel_id: str):
+        if kernel_id not in agent.kernels:
+            raise HTTPException(status_code=404, detail="Kernel not found")
+        try:
+            return await agent.restart_kernel(kernel_id)
+        except Exception as e:
+            logger.error(f"Failed to restart kernel {kernel_id}: {e}", exc_info=True)
+            raise HTTPException(status_code=500, detail=str(e))
+
+    @app.delete("/kernels/{kernel_id}")
+    async def shutdown_kernel(kernel_id: str):
+        await agent.shutdown_kernel(kernel_id)
+        return {'kernel_id': kernel_id}
+
+    @app.put("/users/{user_id}/limits")
+    async def update_user_limits(user_id: str, limits: LimitsUpdate):
+        agent.update_user_limits(user_id, limits.cpu_percent, limits.memory_mb)
+        return {'user_id': user_id}
+
+    return app
+
+def main():
+    # Run as `python -m worker.agent` from the server directory
+    parser = argparse.ArgumentParser(description="Distributed Jupyter worker agent")
+    parser.add_argument('--name', default=socket.gethostname(), help="Worker name shown in the admin view")
+    parser.add_argument('--host', default='0.0.0.0', help="Address the agent API listens on")
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--advertise-host', default='127.0.0.1',
+                        help="Address of this host as seen from the server, kernels listen on it")
+    parser.add_argument('--token', default=os.environ.get('WORKER_TOKEN') or settings.placement.token)
+    args = parser.parse_args()
+    if not args.token:
+        parser.error("a worker token is required: --token, WORKER_TOKEN or placement.token")
+
+    # Agents sharing a host must not share cgroups
+    isolation = settings.isolation.model_copy(update={
+        'cgroup_name': f"{settings.isolation.cgroup_name}-{args.name}"
+    })
+    agent = WorkerAgent(args.name, args.advertise_host, KernelIsolator(isolation))
+    logger.info(f"Worker {args.name} listening on {args.host}:{args.port}, kernels on {args.advertise_host}")
+    uvicorn.run(create_app(agent, args.token), host=args.host, port=args.port, log_level="info")
+
+if __name__ == "__main__":
+    main()
@@ -109,6 +109,6 @@ echo ========================================
 echo.
 
 cd server
-python main.py
+python main.py %*
 
 pause
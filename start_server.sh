@@ -104,4 +104,4 @@ echo "========================================"
 echo ""
 
 cd server
-python3 main.py
+python3 main.py "$@"